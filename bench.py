@@ -0,0 +1,308 @@
+"""Benchmarks for epd.py
+
+Runs against an in-memory loopback panel (epd_transport, loop://), so
+no EPD is needed:
+
+    legacy    the bytes-native frame encoder against the hex-string
+              encoder it replaced, checking both produce identical frames
+    encode    frames encoded per second for every primitive
+    screens   commands and bytes on the wire for typical screens (a
+              clock, a paragraph, block digits) and the peak memory
+              drawing them takes
+    link      commands per second at each baud rate: end to end, the
+              loopback holding writes back as a serial port would, and
+              what encoding and queueing alone would allow
+
+    python bench.py                         everything
+    python bench.py encode screens          some of it
+    python bench.py --save                  store the results as the baseline
+    python bench.py --compare               compare with the baseline, exit
+                                            status 1 if anything got worse
+"""
+import argparse
+import json
+import os
+import sys
+import tracemalloc
+from time import monotonic, sleep
+from timeit import repeat
+
+import epd
+import epd_metrics
+from epd_transport import LoopbackTransport
+
+_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+_TOLERANCE = 0.1  # share a result may get worse by before --compare fails
+
+
+# the hex-string encoder as it was, kept as a reference
+def _legacy_verify(cmd):
+    result = 0
+    cmd_split = [int(cmd[start:start + 2], 16) for start in range(0, len(cmd), 2)]
+    for i in range(len(cmd_split)):
+        result ^= cmd_split[i]
+    return ("0" + (hex(result)[2:]))[-2:]
+
+
+def _legacy_hex(v):
+    return "0" + str(((v >> 8) & 0xFF)) + ("0" + str(hex(v & 0xFF)[2:]))[-2:]
+
+
+def _legacy_frame(size, cmd, args):
+    _cmd = "A5" + size + cmd + args + "CC33C33C"
+    _cmd += _legacy_verify(_cmd)
+    return bytes.fromhex(_cmd)
+
+
+def legacy_fill_rect(x0, y0, x1, y1):
+    return _legacy_frame("0011", "24", _legacy_hex(x0) + _legacy_hex(y0) + _legacy_hex(x1) + _legacy_hex(y1))
+
+
+def legacy_fill_triangle(x0, y0, x1, y1, x2, y2):
+    return _legacy_frame("0015", "29", _legacy_hex(x0) + _legacy_hex(y0) + _legacy_hex(x1) + _legacy_hex(y1)
+                         + _legacy_hex(x2) + _legacy_hex(y2))
+
+
+def legacy_circle(x0, y0, r):
+    return _legacy_frame("000F", "26", _legacy_hex(x0) + _legacy_hex(y0) + _legacy_hex(r))
+
+
+def legacy_set_color(fg, bg):
+    return _legacy_frame("000B", "10", fg + bg)
+
+
+def legacy_ascii(x0, y0, txt):
+    hex_txt = "".join(hex(ord(c))[-2:] for c in txt) + "00"
+    return _legacy_frame(_legacy_hex(len(txt) + 14), "30", _legacy_hex(x0) + _legacy_hex(y0) + hex_txt)
+
+
+_TEXT = "The quick brown fox jumps over the lazy dog"
+
+_CASES = [
+    ("fill_rect", lambda: legacy_fill_rect(12, 345, 799, 599),
+     lambda: epd._enc_fill_rect(12, 345, 799, 599)),
+    ("fill_triangle", lambda: legacy_fill_triangle(0, 600, 400, 0, 799, 599),
+     lambda: epd._enc_fill_triangle(0, 600, 400, 0, 799, 599)),
+    ("circle", lambda: legacy_circle(400, 300, 256),
+     lambda: epd._enc_circle(400, 300, 256)),
+    ("set_color", lambda: legacy_set_color(epd.BLACK, epd.WHITE),
+     lambda: epd._enc_set_color(epd._COLORS[epd.BLACK], epd._COLORS[epd.WHITE])),
+    ("ascii", lambda: legacy_ascii(100, 100, _TEXT),
+     lambda: epd._string_frame(epd._CMD_DRAW_STRING, 100, 100, epd._a2b(_TEXT))),
+]
+
+
+def check_identical():
+    for name, legacy, current in _CASES:
+        assert legacy() == current(), "%s: frames differ" % name
+
+
+def bench_legacy(number=20000):
+    check_identical()
+    print("%-15s %12s %12s %8s" % ("frame", "legacy/s", "current/s", "speedup"))
+    for name, legacy, current in _CASES:
+        t_legacy = min(repeat(legacy, number=number, repeat=3))
+        t_current = min(repeat(current, number=number, repeat=3))
+        print("%-15s %12d %12d %7.1fx" % (name, number / t_legacy, number / t_current, t_legacy / t_current))
+
+
+_PRIMITIVES = [
+    ("pixel", lambda: epd._enc_pixel(400, 300)),
+    ("line", lambda: epd._enc_line(0, 0, 799, 599)),
+    ("rect", lambda: epd._enc_rect(12, 345, 799, 599)),
+    ("fill_rect", lambda: epd._enc_fill_rect(12, 345, 799, 599)),
+    ("circle", lambda: epd._enc_circle(400, 300, 256)),
+    ("fill_circle", lambda: epd._enc_fill_circle(400, 300, 256)),
+    ("triangle", lambda: epd._enc_triangle(0, 600, 400, 0, 799, 599)),
+    ("fill_triangle", lambda: epd._enc_fill_triangle(0, 600, 400, 0, 799, 599)),
+    ("set_color", lambda: epd._enc_set_color(epd._COLORS[epd.BLACK], epd._COLORS[epd.WHITE])),
+    ("ascii", lambda: epd._ascii_frame(100, 100, _TEXT)),
+    ("bitmap", lambda: epd._bitmap_frame(0, 0, "PIC7.BMP")),
+    ("lcd_digit", lambda: list(epd._lcd_digit_frames(100, 100, "8", epd.LCD_MD))),
+    ("block_digit", lambda: list(epd._block_digit_frames(100, 100, "8", epd.BLOCK_MD))),
+]
+
+
+def bench_encode(number=20000):
+    """Calls per second of each primitive's encoder"""
+    results = {}
+    print("%-15s %12s" % ("primitive", "encodes/s"))
+    for name, encode in _PRIMITIVES:
+        rate = number / min(repeat(encode, number=number, repeat=3))
+        results[name] = rate
+        print("%-15s %12d" % (name, rate))
+    return results
+
+
+_PARAGRAPH = " ".join([_TEXT] * 12)
+
+_SCREENS = [
+    ("clock", lambda panel: panel.lcd_digits(100, 150, "12:48", epd.LCD_MD)),
+    ("paragraph", lambda panel: panel.wrap_ascii(20, 20, _PARAGRAPH, 760)),
+    ("block_digits", lambda panel: panel.block_digits(20, 200, "0123456789", epd.BLOCK_MD)),
+]
+
+
+def _loopback_panel():
+    panel = epd.EPD("loop://")
+    panel.soc = LoopbackTransport()
+    return panel
+
+
+def _count_frames(data):
+    count = at = 0
+    while at < len(data):
+        at += int.from_bytes(data[at + 1:at + 3], "big")
+        count += 1
+    return count
+
+
+def _clear_caches():
+    epd._glyph.cache_clear()
+    epd._lcd_digit_shapes.cache_clear()
+    for size in epd_metrics.SIZES:
+        epd_metrics.metrics(size).width.cache_clear()
+        epd_metrics.metrics(size)._prefix.cache_clear()
+
+
+def bench_screens():
+    """Commands, bytes on the wire and peak memory (KiB) per screen"""
+    results = {}
+    print("%-15s %10s %10s %10s" % ("screen", "commands", "bytes", "peak KiB"))
+    for name, draw in _SCREENS:
+        panel = _loopback_panel()
+        _clear_caches()  # count what a first screen takes
+        tracemalloc.start()
+        draw(panel)
+        panel.flush()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        sent = panel.soc.sent
+        results[name] = {"commands": _count_frames(sent), "bytes": len(sent), "peak_kib": peak / 1024}
+        print("%-15s %10d %10d %10.1f" % (name, results[name]["commands"], len(sent), peak / 1024))
+    return results
+
+
+class _PacedLoopback(LoopbackTransport):
+    # holds writes back as a serial port does once its output buffer of
+    # buffer_size bytes is full, 10 bits a byte on the wire (8N1)
+    fixed_rate = False
+
+    def __init__(self, baud_rate, buffer_size=4096):
+        super().__init__()
+        self.baud_rate = baud_rate
+        self.byte_time = 10 / baud_rate
+        self.buffer_time = buffer_size * self.byte_time
+        self.drained = monotonic()
+        self.held = 0  # seconds writes were held back, wire time not spent in epd.py
+
+    def write(self, data):
+        now = monotonic()
+        self.drained = max(now, self.drained) + len(data) * self.byte_time
+        if self.drained - now > self.buffer_time:
+            sleep(self.drained - now - self.buffer_time)
+            self.held += monotonic() - now
+        del self.sent[:]  # nothing to keep, only the time matters
+
+
+def bench_link(seconds=0.5, rates=None):
+    """Commands per second at each baud rate
+
+    fill_rect() is drawn for about seconds of wire time each, and as
+    fast as it goes without pacing. commands/s is end to end, bound by
+    the modelled wire at low rates; cpu/s leaves out the time writes
+    were held back, so it is what encoding and queueing in epd.py allow.
+    Forced updates are left out, they measure the EPD, not the link.
+    """
+    results = {}
+    size = len(epd._enc_fill_rect(12, 345, 799, 599))
+    print("%-15s %12s %12s %12s" % ("baud rate", "commands/s", "cpu/s", "wire max"))
+    for rate in rates or epd._BAUD_RATES + [None]:
+        panel = _loopback_panel()
+        if rate is not None:
+            panel.soc = _PacedLoopback(rate)
+        panel.device_limits(max_commands=float("inf"), max_bytes=float("inf"))
+        count = max(int(seconds * (rate or 1e7) / 10 / size), 1)
+        start = monotonic()
+        for _ in range(count):
+            panel.fill_rect(12, 345, 799, 599)
+        panel.flush()
+        end = monotonic()
+        elapsed = max(getattr(panel.soc, "drained", 0), end) - start
+        busy = end - start - getattr(panel.soc, "held", 0)
+        name = "unpaced" if rate is None else str(rate)
+        results[name] = {"end_to_end": count / elapsed, "cpu": count / busy}
+        print("%-15s %12.1f %12.1f %12s" % (name, count / elapsed, count / busy,
+                                            "%.1f" % (rate / 10 / size) if rate else "-"))
+    return results
+
+
+_BENCHES = {"legacy": bench_legacy, "encode": bench_encode, "screens": bench_screens, "link": bench_link}
+
+# results where lower is better, all others are rates
+_LOWER_BETTER = ("commands", "bytes", "peak_kib")
+
+
+def _flatten(results, prefix=""):
+    for key, value in results.items():
+        if isinstance(value, dict):
+            yield from _flatten(value, prefix + key + ".")
+        else:
+            yield prefix + key, value
+
+
+def compare(results, baseline, tolerance=_TOLERANCE):
+    """Print how results moved from baseline, returns what got worse"""
+    old = dict(_flatten(baseline))
+    worse = []
+    print("%-32s %12s %12s %8s" % ("result", "baseline", "now", "change"))
+    for key, value in _flatten(results):
+        if key not in old or not old[key]:
+            continue
+        change = value / old[key] - 1
+        if key.rsplit(".", 1)[-1] in _LOWER_BETTER:
+            change = -change
+        flag = ""
+        if change < -tolerance:
+            worse.append(key)
+            flag = "  worse"
+        print("%-32s %12.1f %12.1f %+7.0f%%%s" % (key, old[key], value, change * 100, flag))
+    return worse
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark epd.py against a loopback panel")
+    parser.add_argument("benches", nargs="*", help="any of %s, all by default" % ", ".join(_BENCHES))
+    parser.add_argument("--baseline", default=_BASELINE, help="baseline file, default %(default)s")
+    parser.add_argument("--save", action="store_true", help="store the results as the baseline")
+    parser.add_argument("--compare", action="store_true", help="compare with the baseline")
+    args = parser.parse_args(argv)
+    unknown = set(args.benches) - set(_BENCHES)
+    if unknown:
+        parser.error("unknown benchmarks %s" % ", ".join(sorted(unknown)))
+    if args.compare and not os.path.exists(args.baseline):
+        parser.error("no baseline at %s, make one with --save" % args.baseline)
+
+    results = {}
+    for name in args.benches or _BENCHES:
+        print("\n# %s" % name)
+        result = _BENCHES[name]()
+        if result is not None:
+            results[name] = result
+    if args.compare:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print("\n# compared with %s" % args.baseline)
+        worse = compare(results, baseline)
+        if worse:
+            print(">> %d results worse than the baseline by more than %d%%" % (len(worse), _TOLERANCE * 100))
+            return 1
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+        print("> Baseline saved to", args.baseline)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,19 +1,18 @@
 import sys
 
+import epd
 from epd import *
 
 if __name__ == "__main__":
-    try:
-        epd_connect()
-    except:
-        sys.exit()
+    epd_connect()
+    if epd._default.soc is None:
+        sys.exit(1)  # epd_connect() said why
 
-    epd_clear()
-    sleep(3)
+    # each wait ends as soon as the EPD is ready again
+    epd_clear(wait=True).result()
 
     epd_ascii(100, 100, "Hello world")
 
-    epd_update()
-    sleep(5)
+    epd_update(wait=True).result()
 
     epd_disconnect()
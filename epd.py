@@ -1,7 +1,42 @@
-import socket
-from time import sleep
+import json
+import logging
+import os
+import re
+import struct
+import sys
+import threading
+from collections import Counter, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache, reduce
+from itertools import combinations
+from operator import xor
+from time import monotonic, perf_counter, sleep
+from urllib.parse import parse_qs, urlsplit
+
+from epd_instruments import Instruments
+from epd_metrics import SIZES, layout, metrics
+from epd_transport import open_transport
+
+
+class _ConsoleFormatter(logging.Formatter):
+    def format(self, record):
+        return (">> " if record.levelno >= logging.WARNING else "> ") + super().format(record)
+
+
+# messages go to the "epd" logger, the records of an EPD carrying its
+# device. console prints them as ever, "> " for information and ">> "
+# for problems, and keeps them from the application's handlers too.
+# when the application sets up logging itself, remove it with
+# logging.getLogger("epd").removeHandler(epd.console) and set the
+# logger's propagate back to True
+_log = logging.getLogger("epd")
+_log.setLevel(logging.INFO)
+console = logging.StreamHandler(sys.stdout)
+console.setFormatter(_ConsoleFormatter())
+_log.addHandler(console)
+_log.propagate = False
 
-_DEBUG = False
 # assumed serial interfaces for different platforms
 _MAC = "/dev/cu.usbserial"
 _LINUX = "/dev/ttyUSB0"
@@ -22,23 +57,80 @@ if _DEV == "":
         _DEV = input('Define serial port for EPD connection (e.g. /dev/ttyUSB1 or just hit enter for none): ')
 
 
-def _verify(cmd):
-    result = 0
-    cmd_split = [int(cmd[start:start + 2], 16) for start in range(0, len(cmd), 2)]
-    for i in range(len(cmd_split)):
-        result ^= cmd_split[i]
-    return ("0" + (hex(result)[2:]))[-2:]
-
-
-_soc = None
 BAUD_RATE = 115200
 _BAUD_RATE_DEFAULT = 115200
 _BAUD_RATES = [1200, 2400, 4800, 9600, 19200, 38400, 57600, 115200]
 _MAX_STRING_LEN = 1024 - 4
 
+# the EPD only finds pictures named in capitals and digits, no more than
+# 10 characters including ".BMP", and fonts by these names
+_PIC_NAME_LEN = 10 - len(".BMP")
+_PIC_NAME = re.compile(r"[A-Z0-9]{1,%d}\.BMP" % _PIC_NAME_LEN)
+FONT_FILES = ("GBK32.FON", "GBK48.FON", "GBK64.FON")
+
+# epd_autotune() remembers the rate it chose for each device here, and
+# EPD(dev) starts from it
+_BAUD_FILE = os.path.join(os.path.expanduser("~"), ".epd_baud.json")
+_BAUD_SWITCH_TIMEOUT = 10  # seconds the EPD may take to restart at a new baud rate
+_READY_POLL = 0.2  # seconds between handshakes while waiting for the EPD
+_PROBE_FRAMES = 64  # handshakes in a throughput probe, all must be answered OK
+
+# outgoing frames are buffered and written to the connection in one go
+# by epd_update(), epd_flush() or once more than _FLUSH_THRESHOLD bytes
+# are pending
+_FLUSH_THRESHOLD = 4096
+
+# the EPD drops commands once its own buffer overflows. it is emptied by
+# an update, so commands sent since the last update are counted and an
+# update is forced before the next one would exceed either limit.
+# defaults are what 5 LCD digits of up to 30 triangles need, which was
+# known to work. tune them with epd_device_limits() and check the peaks
+# reached with epd_device_stats()
+_DEVICE_MAX_COMMANDS = 150
+_DEVICE_MAX_BYTES = 3200
+_DEVICE_REFRESH_WAIT = 2  # seconds the EPD needs to take commands again after a forced update
+
+# epd_update(wait=True) and epd_clear(wait=True) return a Future that
+# resolves once the EPD answers a handshake again after refreshing. the
+# first handshake goes out a bit before the refresh is expected to end,
+# by an estimate learned from the refreshes timed so far
+_REFRESH_TIMEOUT = 15  # seconds a refresh may take before giving up
+_REFRESH_EARLY = 0.8  # first handshake at this fraction of the estimate
+_REFRESH_LEARN = 0.3  # weight of the latest refresh in the estimate
+
+# the EPD answers every frame with "OK", "Error:N" or a value (read baud).
+# with epd_responses(True) a background thread reads the replies and
+# resolves them in order against the frames in flight, each of which
+# gets a Future. at most _RESPONSE_WINDOW frames go unanswered at a time
+_RESPONSE_WINDOW = 64
+_RESPONSE_TIMEOUT = 5  # seconds to wait for a reply before giving up on it
+
+# see docs/error_codes.txt
+_EPD_ERRORS = {
+    0: "invalid command",
+    1: "SD card initiation failed",
+    2: "invalid arguments",
+    3: "SD card not inserted",
+    4: "file not found",
+    20: "validation failed",
+    21: "invalid frame",
+    250: "undefined error",
+}
+
+
+class EPDError(Exception):
+    """Error:N reply of the EPD"""
+
+    def __init__(self, code):
+        self.code = code
+        super().__init__("Error:%d %s" % (code, _EPD_ERRORS.get(code, "unknown error")))
+
 # frame segments
-_FRAME_BEGIN = "A5"
-_FRAME_END = "CC33C33C"
+# A5 | length (2 bytes) | command | arguments | CC 33 C3 3C | XOR checksum
+# length counts the whole frame, checksum included
+_FRAME_BEGIN = 0xA5
+_FRAME_END = 0xCC33C33C
+_FRAME_OVERHEAD = 9
 
 # colours
 BLACK = "00"
@@ -47,35 +139,38 @@ GRAY = "02"
 WHITE = "03"
 
 # commands
-_CMD_HANDSHAKE = "00"  # handshake
-_CMD_SET_BAUD = "01"  # set baud
-_CMD_READ_BAUD = "02"  # read baud
-_CMD_MEMORYMODE = "07"  # set memory mode
-_CMD_STOPMODE = "08"  # enter stop mode
-_CMD_UPDATE = "0A"  # update
-_CMD_SCREEN_ROTATION = "0D"  # set screen rotation
-_CMD_LOAD_FONT = "0E"  # copy font files from SD card to NandFlash.
+_CMD_HANDSHAKE = 0x00  # handshake
+_CMD_SET_BAUD = 0x01  # set baud
+_CMD_READ_BAUD = 0x02  # read baud
+_CMD_MEMORYMODE = 0x07  # set memory mode
+_CMD_STOPMODE = 0x08  # enter stop mode
+_CMD_UPDATE = 0x0A  # update
+_CMD_SCREEN_ROTATION = 0x0D  # set screen rotation
+_CMD_LOAD_FONT = 0x0E  # copy font files from SD card to NandFlash.
 # Font files include GBK32/48/64.FON
 # 48MB allocated in NandFlash for fonts
 # LED will flicker 3 times when starts and ends.
-_CMD_LOAD_PIC = "0F"  # Import the image files from SD card to the NandFlash.
+_CMD_LOAD_PIC = 0x0F  # Import the image files from SD card to the NandFlash.
 # LED will flicker 3 times when starts and ends.
 # 80MB allocated in NandFlash for images
-_CMD_SET_COLOR = "10"  # set colour
-_CMD_SET_EN_FONT = "1E"  # set English font
-_CMD_SET_CH_FONT = "1F"  # set Chinese font
-
-_CMD_DRAW_PIXEL = "20"  # set pixel
-_CMD_DRAW_LINE = "22"  # draw line
-_CMD_FILL_RECT = "24"  # fill rectangle
-_CMD_DRAW_RECT = "25"  # draw rectangle
-_CMD_DRAW_CIRCLE = "26"  # draw circle
-_CMD_FILL_CIRCLE = "27"  # fill circle
-_CMD_DRAW_TRIANGLE = "28"  # draw triangle
-_CMD_FILL_TRIANGLE = "29"  # fill triangle
-_CMD_CLEAR = "2E"  # clear screen use back colour
-_CMD_DRAW_STRING = "30"  # draw string
-_CMD_DRAW_BITMAP = "70"  # draw bitmap
+_CMD_SET_COLOR = 0x10  # set colour
+_CMD_SET_EN_FONT = 0x1E  # set English font
+_CMD_SET_CH_FONT = 0x1F  # set Chinese font
+
+_CMD_DRAW_PIXEL = 0x20  # set pixel
+_CMD_DRAW_LINE = 0x22  # draw line
+_CMD_FILL_RECT = 0x24  # fill rectangle
+_CMD_DRAW_RECT = 0x25  # draw rectangle
+_CMD_DRAW_CIRCLE = 0x26  # draw circle
+_CMD_FILL_CIRCLE = 0x27  # fill circle
+_CMD_DRAW_TRIANGLE = 0x28  # draw triangle
+_CMD_FILL_TRIANGLE = 0x29  # fill triangle
+_CMD_CLEAR = 0x2E  # clear screen use back colour
+_CMD_DRAW_STRING = 0x30  # draw string
+_CMD_DRAW_BITMAP = 0x70  # draw bitmap
+
+# e.g. "fill_rect" for _CMD_FILL_RECT, as reported by epd_instrument()
+_COMMAND_NAMES = {v: k[5:].lower() for k, v in list(globals().items()) if k.startswith("_CMD_")}
 
 # FONT SIZE (32/48/64 dots)
 GBK32 = "01"
@@ -87,32 +182,101 @@ ASCII48 = "02"
 ASCII64 = "03"
 
 # Memory Mode
-_MEM_NAND = "00"
-_MEM_SD = "01"
+_MEM_NAND = 0x00
+_MEM_SD = 0x01
 
 # set screen rotation
-_EPD_NORMAL = "00"  # screen normal
-_EPD_INVERSION = "01"  # screen inversion
+_EPD_NORMAL = 0x00  # screen normal
+_EPD_INVERSION = 0x01  # screen inversion
+
+_COLORS = {BLACK: 0x00, DARK_GRAY: 0x01, GRAY: 0x02, WHITE: 0x03}
+
+# commands setting a state of the EPD. they are not sent again when the
+# EPD is known to be in that state already. what it is known to be in is
+# forgotten on reconnecting and clearing
+_STATE_COMMANDS = frozenset((_CMD_SET_COLOR, _CMD_SET_EN_FONT, _CMD_SET_CH_FONT,
+                             _CMD_MEMORYMODE, _CMD_SCREEN_ROTATION))
+
+
+# frame encoding
+#
+# frames are built directly as bytes. each command with fixed arguments
+# gets a precompiled template: one struct packing the whole frame and
+# the XOR of its constant bytes, so only the arguments are folded into
+# the checksum at encoding time.
+
+def _checksum(data, seed=0):
+    """XOR all bytes of data into seed"""
+    return reduce(xor, data, seed)
+
+
+def _template(cmd, fmt=""):
+    """Precompile the frame of a command with fixed-size arguments
+
+    fmt is a struct format of the arguments, e.g. "HHHH" for two points.
+    Returns a function taking the arguments and returning the frame.
+    """
+    args = struct.Struct(">" + fmt)
+    size = _FRAME_OVERHEAD + args.size
+    frame = struct.Struct(">BHB" + fmt + "IB")
+    seed = _checksum(struct.pack(">BHBI", _FRAME_BEGIN, size, cmd, _FRAME_END))
+
+    if fmt.strip("H") == "":
+        # coordinates only: fold both bytes of each argument arithmetically
+        def encode(*values):
+            values = [v & 0xFFFF for v in values]
+            chk = seed
+            for v in values:
+                chk ^= v ^ (v >> 8)
+            return frame.pack(_FRAME_BEGIN, size, cmd, *values, _FRAME_END, chk & 0xFF)
+    else:
+        def encode(*values):
+            chk = _checksum(args.pack(*values), seed)
+            return frame.pack(_FRAME_BEGIN, size, cmd, *values, _FRAME_END, chk)
+    return encode
+
+
+def _frame(cmd, payload=b""):
+    """Encode a frame with variable-length arguments"""
+    frame = bytearray(struct.pack(">BHB", _FRAME_BEGIN, _FRAME_OVERHEAD + len(payload), cmd))
+    frame += payload
+    frame += struct.pack(">I", _FRAME_END)
+    frame.append(_checksum(frame))
+    return bytes(frame)
+
+
+def _hex_byte(v):
+    # colour, font and mode constants are hex strings, e.g. "03"
+    return int(v, 16) if isinstance(v, str) else v
+
+
+_enc_set_baud = _template(_CMD_SET_BAUD, "I")
+_enc_memory = _template(_CMD_MEMORYMODE, "B")
+_enc_rotation = _template(_CMD_SCREEN_ROTATION, "B")
+_enc_set_color = _template(_CMD_SET_COLOR, "BB")
+_enc_en_font = _template(_CMD_SET_EN_FONT, "B")
+_enc_ch_font = _template(_CMD_SET_CH_FONT, "B")
+_enc_pixel = _template(_CMD_DRAW_PIXEL, "HH")
+_enc_line = _template(_CMD_DRAW_LINE, "HHHH")
+_enc_rect = _template(_CMD_DRAW_RECT, "HHHH")
+_enc_fill_rect = _template(_CMD_FILL_RECT, "HHHH")
+_enc_circle = _template(_CMD_DRAW_CIRCLE, "HHH")
+_enc_fill_circle = _template(_CMD_FILL_CIRCLE, "HHH")
+_enc_triangle = _template(_CMD_DRAW_TRIANGLE, "HHHHHH")
+_enc_fill_triangle = _template(_CMD_FILL_TRIANGLE, "HHHHHH")
 
 # command define
-_cmd_handshake = _FRAME_BEGIN + "0009" + _CMD_HANDSHAKE + _FRAME_END
-_cmd_handshake += _verify(_cmd_handshake)
-_cmd_read_baud = _FRAME_BEGIN + "0009" + _CMD_READ_BAUD + _FRAME_END
-_cmd_read_baud += _verify(_cmd_read_baud)
-_cmd_stopmode = _FRAME_BEGIN + "0009" + _CMD_STOPMODE + _FRAME_END
-_cmd_stopmode += _verify(_cmd_stopmode)
-_cmd_update = _FRAME_BEGIN + "0009" + _CMD_UPDATE + _FRAME_END
-_cmd_update += _verify(_cmd_update)
-_cmd_clear = _FRAME_BEGIN + "0009" + _CMD_CLEAR + _FRAME_END
-_cmd_clear += _verify(_cmd_clear)
-_cmd_import_font = _FRAME_BEGIN + "0009" + _CMD_LOAD_FONT + _FRAME_END
-_cmd_import_font += _verify(_cmd_import_font)
-_cmd_import_pic = _FRAME_BEGIN + "0009" + _CMD_LOAD_PIC + _FRAME_END
-_cmd_import_pic += _verify(_cmd_import_pic)
-_cmd_use_nand = _FRAME_BEGIN + "000A" + _CMD_MEMORYMODE + _MEM_NAND + _FRAME_END
-_cmd_use_nand += _verify(_cmd_use_nand)
-_cmd_use_sd = _FRAME_BEGIN + "000A" + _CMD_MEMORYMODE + _MEM_SD + _FRAME_END
-_cmd_use_sd += _verify(_cmd_use_sd)
+_cmd_handshake = _template(_CMD_HANDSHAKE)()
+_cmd_read_baud = _template(_CMD_READ_BAUD)()
+_cmd_stopmode = _template(_CMD_STOPMODE)()
+_cmd_update = _template(_CMD_UPDATE)()
+_cmd_clear = _template(_CMD_CLEAR)()
+_cmd_import_font = _template(_CMD_LOAD_FONT)()
+_cmd_import_pic = _template(_CMD_LOAD_PIC)()
+_cmd_use_nand = _enc_memory(_MEM_NAND)
+_cmd_use_sd = _enc_memory(_MEM_SD)
+_cmd_screen_normal = _enc_rotation(_EPD_NORMAL)
+_cmd_screen_invert = _enc_rotation(_EPD_INVERSION)
 
 # vector 7 segment LCD digits (calculator-like digits)
 #
@@ -210,52 +374,186 @@ LCD_LG = 1.15  # approx. 5 digits over entire width
 
 
 # NOTE:
-#   the EPD does not handle too many triangles at a time
-#   if it does not display the digits sent, there are too many
-#   send over a few segments until I fix it
+#   the EPD does not handle too many triangles at a time.
+#   send() forces an update before its buffer overflows, see
+#   _DEVICE_MAX_COMMANDS and epd_device_limits()
+
+# the triangles above are reduced per (digit, scale) before drawing:
+# duplicates are dropped, pairs and 4-triangle fans that make up an
+# axis-aligned rectangle become one fill_rect, right trapezoids are
+# split into a rectangle and a triangle so that rectangles of adjacent
+# strokes merge, triangles inside a rectangle are dropped and triangles
+# sharing a row or column edge are joined. Only rules that still hold
+# once the scaled coordinates are rounded are used, so the pixels drawn
+# stay the same with fewer commands (214 triangles for 0-9 become 157
+# shapes, 25 of them rectangles)
+
+def _area2(a, b, c):
+    return (b[0] - a[0]) * (c[1] - a[1]) - (b[1] - a[1]) * (c[0] - a[0])
+
+
+def _as_rect(points):
+    xs = sorted(set(p[0] for p in points))
+    ys = sorted(set(p[1] for p in points))
+    if len(xs) == 2 and len(ys) == 2 and set(points) == {(x, y) for x in xs for y in ys}:
+        return xs[0], ys[0], xs[1], ys[1]
+    return None
+
+
+def _edge_pairs(tris):
+    # pairs of triangles on either side of a shared edge (a, b opposite it)
+    for i, t1 in enumerate(tris):
+        for t2 in tris[i + 1:]:
+            shared = set(t1) & set(t2)
+            if len(shared) != 2:
+                continue
+            s1, s2 = sorted(shared)
+            a, = set(t1) - shared
+            b, = set(t2) - shared
+            if (_area2(s1, s2, a) > 0) != (_area2(s1, s2, b) > 0):
+                yield t1, t2, a, s1, b, s2
+
+
+def _split_trapezoid(quad):
+    # a quadrilateral with 3 axis-aligned sides as (rect, triangle)
+    for swap in (False, True):
+        q = [(p[1], p[0]) for p in quad] if swap else list(quad)
+        for i in range(4):
+            p0, p1, p2, p3 = q[i:] + q[:i]
+            # p0-p1 slanted, p1-p2 and p3-p0 parallel, p2-p3 square to them
+            if (p1[0] == p2[0] and p3[0] == p0[0] and p2[1] == p3[1]
+                    and p0[0] != p1[0] and p0[1] != p1[1]):
+                if abs(p0[1] - p3[1]) < abs(p1[1] - p2[1]):
+                    y, corner = p0[1], (p1[0], p0[1])
+                else:
+                    y, corner = p1[1], (p0[0], p1[1])
+                rect = [p2, p3, (p3[0], y), (p2[0], y)]
+                tri = (p0, p1, corner)
+                if swap:
+                    rect = [(b, a) for a, b in rect]
+                    tri = tuple((b, a) for a, b in tri)
+                return _as_rect(rect), tuple(sorted(tri))
+    return None
+
+
+def _reduce_triangles(tris):
+    tris = list(dict.fromkeys(tuple(sorted(t)) for t in tris if _area2(*t) != 0))
+    rects = []
+
+    def fuse():
+        for t1, t2, a, s1, b, s2 in _edge_pairs(tris):
+            rect = _as_rect([a, s1, b, s2])
+            if rect:
+                tris.remove(t1)
+                tris.remove(t2)
+                rects.append(rect)
+                return True
+        for c in set(p for t in tris for p in t):
+            fan = [t for t in tris if c in t]
+            for i in range(len(fan) - 3):
+                for quad in combinations(fan[i:], 4):
+                    if quad[0] != fan[i]:
+                        break
+                    outer = set(p for t in quad for p in t) - {c}
+                    rect = _as_rect(list(outer)) if len(outer) == 4 else None
+                    if rect and rect[0] < c[0] < rect[2] and rect[1] < c[1] < rect[3]:
+                        for t in quad:
+                            tris.remove(t)
+                        rects.append(rect)
+                        return True
+        return False
+
+    def split():
+        for t1, t2, a, s1, b, s2 in _edge_pairs(tris):
+            parts = _split_trapezoid([a, s1, b, s2])
+            if parts:
+                tris.remove(t1)
+                tris.remove(t2)
+                rects.append(parts[0])
+                tris.append(parts[1])
+                return True
+        return False
+
+    def merge():
+        # columns first, the strokes of a digit are taller than wide
+        for vertical in (True, False):
+            for i, r1 in enumerate(rects):
+                for r2 in rects[i + 1:]:
+                    if vertical and r1[0] == r2[0] and r1[2] == r2[2] and (r1[3] == r2[1] or r2[3] == r1[1]):
+                        merged = r1[0], min(r1[1], r2[1]), r1[2], max(r1[3], r2[3])
+                    elif not vertical and r1[1] == r2[1] and r1[3] == r2[3] and (r1[2] == r2[0] or r2[2] == r1[0]):
+                        merged = min(r1[0], r2[0]), r1[1], max(r1[2], r2[2]), r1[3]
+                    else:
+                        continue
+                    rects.remove(r1)
+                    rects.remove(r2)
+                    rects.append(merged)
+                    return True
+        return False
+
+    def tidy():
+        for t in tris:
+            if any(all(r[0] <= p[0] <= r[2] and r[1] <= p[1] <= r[3] for p in t) for r in rects):
+                tris.remove(t)
+                return True
+        for t1, t2, a, s1, b, s2 in _edge_pairs(tris):
+            for s, other in ((s1, s2), (s2, s1)):
+                # only along a row or column, that survives rounding
+                if a[0] == s[0] == b[0] or a[1] == s[1] == b[1]:
+                    tris.remove(t1)
+                    tris.remove(t2)
+                    tris.append(tuple(sorted((a, b, other))))
+                    return True
+        return False
+
+    for step in (fuse, split, merge, tidy):
+        while step():
+            pass
+    return rects, tris
+
+
+@lru_cache(maxsize=None)
+def _lcd_digit_shapes(d):
+    # reduced (rects, triangles) of a digit in font units
+    return _reduce_triangles(_LCD_DIGITS[d])
+
+
+def _lcd_glyph_frames(d, scale):
+    # frames of a digit at the origin, see _glyph()
+    if d == ':':
+        rects, tris = [p0 + p1 for p0, p1 in _LCD_COLON], []
+    else:
+        rects, tris = _lcd_digit_shapes(int(d))
+    for rect in rects:
+        yield _enc_fill_rect(*(_scaled(v, scale) for v in rect))
+    for tri in tris:
+        yield _enc_fill_triangle(*(_scaled(v, scale) for p in tri for v in p))
 
-def _lcd_digit(x, y, d, scale=LCD_MD):
+
+def _lcd_digit_frames(x, y, d, scale=LCD_MD):
     # draw digit over existing image with transparency like other hollow shapes
-    if d == ':':
-        for rect in _LCD_COLON:
-            (x0, y0), (x1, y1) = rect
-            epd_fill_rect(int(scale * x0 + x), int(scale * y0 + y),
-                          int(scale * x1 + x), int(scale * y1 + y))
-    elif d in [str(s) for s in range(0, 10)]:
-        for tri in _LCD_DIGITS[int(d)]:
-            (x0, y0), (x1, y1), (x2, y2) = tri
-            epd_fill_triangle(int(scale * x0 + x), int(scale * y0 + y),
-                              int(scale * x1 + x), int(scale * y1 + y),
-                              int(scale * x2 + x), int(scale * y2 + y))
+    if d == ':' or d in [str(s) for s in range(0, 10)]:
+        yield from _glyph("lcd", d, scale).move(x, y)
     else:
-        print("'%s' is not a digit or colon. Leaving it blank." % d)
+        _log.warning("'%s' is not a digit or colon. Leaving it blank.", d)
 
 
-def epd_lcd_digits(x, y, digits, scale=LCD_MD):
-    if digits == '':
-        return
+def _lcd_digits_frames(x, y, digits, scale=LCD_MD):
     # for now, the input is expected to be a sequence of digits
     # or a time with colon as the separator, e.g. 12:48
 
     # fill all background area including spacing with white rectangle
-    epd_set_color(WHITE, WHITE)
-    epd_fill_rect(x, y,
-                  int(x + (len(digits) - 1) * (_LCD_DIGIT_WIDTH + _LCD_SPACING) * scale + _LCD_DIGIT_WIDTH * scale),
-                  int(y + _LCD_DIGIT_HEIGHT * scale))
-    epd_set_color(BLACK, WHITE)
+    yield _enc_set_color(_COLORS[WHITE], _COLORS[WHITE])
+    yield _enc_fill_rect(x, y,
+                         int(x + (len(digits) - 1) * (_LCD_DIGIT_WIDTH + _LCD_SPACING) * scale
+                             + _LCD_DIGIT_WIDTH * scale),
+                         int(y + _LCD_DIGIT_HEIGHT * scale))
+    yield _enc_set_color(_COLORS[BLACK], _COLORS[WHITE])
 
     count = 0
     for d in digits:
-        _lcd_digit(int(x + count * scale * (_LCD_DIGIT_WIDTH + _LCD_SPACING)), y, d, scale)
+        yield from _lcd_digit_frames(int(x + count * scale * (_LCD_DIGIT_WIDTH + _LCD_SPACING)), y, d, scale)
         count += 1
-        if count % 5 == 0:
-            # force an update every 5 digits to avoid a no-display
-            # due to too many triangles filling up EPD's buffer
-            epd_update()
-            sleep(2)
-    if count % 5 != 0:
-        # so we don't refresh twice if we just did it by the last digit in the loop
-        epd_update()
 
 
 # lightweight (in terms of drawing) and scalable block digits
@@ -314,420 +612,1362 @@ BLOCK_MD = 2.5  # approx. 9 digits over entire width
 BLOCK_LG = 4.65  # approx. 5 digits over entire width
 
 
-def block_digit(x, y, d, scale=BLOCK_SM):
+def _block_glyph_frames(d, scale):
+    # frames of a digit at the origin, see _glyph()
     (x0, y0), (x1, y1) = BLK_BG
-
+    bg = (_scaled(x0, scale), _scaled(y0, scale), _scaled(x1, scale), _scaled(y1, scale))
     if d == ':':
-        epd_set_color(WHITE, WHITE)
-        epd_fill_rect(int(scale * x0 + x), int(scale * y0 + y),
-                      int(scale * x1 + x), int(scale * y1 + y))
-        epd_set_color(BLACK, WHITE)
+        yield _enc_set_color(_COLORS[WHITE], _COLORS[WHITE])
+        yield _enc_fill_rect(*bg)
+        yield _enc_set_color(_COLORS[BLACK], _COLORS[WHITE])
         d = '8'
-    elif d in [str(s) for s in range(0, 10)]:
-        epd_set_color(BLACK, WHITE)
-        epd_fill_rect(int(scale * x0 + x), int(scale * y0 + y),
-                      int(scale * x1 + x), int(scale * y1 + y))
-        epd_set_color(WHITE, WHITE)
     else:
-        print("'%s' is not a digit or colon. Leaving it blank." % d)
-        return
+        yield _enc_set_color(_COLORS[BLACK], _COLORS[WHITE])
+        yield _enc_fill_rect(*bg)
+        yield _enc_set_color(_COLORS[WHITE], _COLORS[WHITE])
 
     for rect in BLK_DIGITS[int(d)]:
         (x0, y0), (x1, y1) = rect
-        epd_fill_rect(int(scale * x0 + x), int(scale * y0 + y),
-                      int(scale * x1 + x), int(scale * y1 + y))
-    epd_set_color(BLACK, WHITE)
+        yield _enc_fill_rect(_scaled(x0, scale), _scaled(y0, scale), _scaled(x1, scale), _scaled(y1, scale))
+    yield _enc_set_color(_COLORS[BLACK], _COLORS[WHITE])
 
 
-def epd_block_digits(x, y, digits, scale=BLOCK_SM):
-    if digits == '':
-        return
+def _block_digit_frames(x, y, d, scale=BLOCK_SM):
+    if d == ':' or d in [str(s) for s in range(0, 10)]:
+        yield from _glyph("block", d, scale).move(x, y)
+    else:
+        _log.warning("'%s' is not a digit or colon. Leaving it blank.", d)
+
+
+def _block_digits_frames(x, y, digits, scale=BLOCK_SM):
     # fill all background area including spacing with white rectangle
-    epd_set_color(WHITE, WHITE)
-    epd_fill_rect(x, y,
-                  int(x + (len(digits) - 1) * (
-                          BLOCK_DIGIT_SPACING + BLOCK_DIGIT_WIDTH) * scale + BLOCK_DIGIT_WIDTH * scale),
-                  int(y + BLOCK_DIGIT_HEIGHT * scale))
+    yield _enc_set_color(_COLORS[WHITE], _COLORS[WHITE])
+    yield _enc_fill_rect(x, y,
+                         int(x + (len(digits) - 1) * (
+                                 BLOCK_DIGIT_SPACING + BLOCK_DIGIT_WIDTH) * scale + BLOCK_DIGIT_WIDTH * scale),
+                         int(y + BLOCK_DIGIT_HEIGHT * scale))
+    # digits do not overlap, so all black areas are drawn first and all
+    # white ones after, switching colours only twice. the background is
+    # white already, so a colon is just the holes of an 8 in black
+    black = []
+    white = []
     count = 0
     for d in digits:
-        block_digit(int(x + count * scale * (BLOCK_DIGIT_SPACING + BLOCK_DIGIT_WIDTH)), y, d, scale)
+        dx = int(x + count * scale * (BLOCK_DIGIT_SPACING + BLOCK_DIGIT_WIDTH))
         count += 1
+        if d == ':':
+            holes = black
+            d = '8'
+        elif d in [str(s) for s in range(0, 10)]:
+            (x0, y0), (x1, y1) = BLK_BG
+            black.append((int(scale * x0 + dx), int(scale * y0 + y), int(scale * x1 + dx), int(scale * y1 + y)))
+            holes = white
+        else:
+            _log.warning("'%s' is not a digit or colon. Leaving it blank.", d)
+            continue
+        for rect in BLK_DIGITS[int(d)]:
+            (x0, y0), (x1, y1) = rect
+            holes.append((int(scale * x0 + dx), int(scale * y0 + y), int(scale * x1 + dx), int(scale * y1 + y)))
+
+    yield _enc_set_color(_COLORS[BLACK], _COLORS[WHITE])
+    for rect in black:
+        yield _enc_fill_rect(*rect)
+    if white:
+        yield _enc_set_color(_COLORS[WHITE], _COLORS[WHITE])
+        for rect in white:
+            yield _enc_fill_rect(*rect)
+        yield _enc_set_color(_COLORS[BLACK], _COLORS[WHITE])
+
+
+def _scaled(v, scale):
+    # a font coordinate in pixels. rounded first, so that e.g.
+    # 1.15 * 20 == 22.999999999999996 lands on 23 wherever it is drawn
+    return int(round(scale * v, 6))
+
+
+class _Glyph:
+    """Encoded frames of a digit at the origin
+
+    move() copies them and patches the coordinates and checksums for
+    the new position instead of encoding every frame again. The frames
+    of the last few positions are kept, a clock draws each digit at the
+    same place every time.
+    """
+
+    _POSITIONS = 16
+
+    def __init__(self, frames):
+        self._data = b"".join(frames)
+        self._moved = {}
+        self._spans = []
+        self._coords = []
+        start = 0
+        for frame in frames:
+            end = start + len(frame)
+            self._spans.append((start, end))
+            if frame[3] in (_CMD_FILL_RECT, _CMD_FILL_TRIANGLE):
+                args = struct.Struct(">%dH" % ((len(frame) - _FRAME_OVERHEAD) // 2))
+                values = args.unpack_from(frame, 4)
+                # checksum of everything but the coordinates
+                seed = frame[-1]
+                for v in values:
+                    seed ^= v ^ (v >> 8)
+                self._coords.append((args, start + 4, end - 1, values, seed))
+            start = end
+
+    def move(self, x, y):
+        x, y = int(x), int(y)
+        frames = self._moved.get((x, y))
+        if frames is None:
+            if len(self._moved) >= self._POSITIONS:
+                self._moved.clear()
+            frames = self._moved[x, y] = self._patch(x, y)
+        return frames
+
+    def _patch(self, x, y):
+        data = bytearray(self._data)
+        offsets = (x, y) * 3
+        for args, at, chk_at, values, chk in self._coords:
+            moved = [(v + o) & 0xFFFF for v, o in zip(values, offsets)]
+            args.pack_into(data, at, *moved)
+            for v in moved:
+                chk ^= v ^ (v >> 8)
+            data[chk_at] = chk & 0xFF
+        data = bytes(data)
+        return [data[start:end] for start, end in self._spans]
+
+
+_GLYPH_FONTS = {"lcd": _lcd_glyph_frames, "block": _block_glyph_frames}
+
+
+@lru_cache(maxsize=256)
+def _glyph(font, d, scale):
+    # a clock redraws the same few glyphs at the same scale over and over
+    return _Glyph(list(_GLYPH_FONTS[font](d, scale)))
+
+
+# ASCII string to bytes. e.g. "World" => b"World\x00"
+def _a2b(string):
+    try:
+        data = string.encode("latin-1")
+    except UnicodeEncodeError:
+        data = bytes(ord(c) & 0xFF for c in string)
+    return data + b"\x00"  # append "00" to string as required
 
 
-# ASCII string to Hex string. e.g. "World" => "576F726C64"
+# ASCII string to Hex string. e.g. "World" => "576f726c6400"
 def a2h(string):
-    hex_str = ""
-    for c in string:
-        hex_str = hex_str + hex(ord(c))[-2:]
-    return hex_str + "00"  # append "00" to string as required
+    return _a2b(string).hex()
 
 
-def send(cmd):
-    if soc is None:
-        print(">> EPD not connected. Try epd_connect()")
-    elif type(soc) == socket.socket(socket.AF_INET, socket.SOCK_STREAM):
-        soc.send(bytes.fromhex(cmd))
-    else:
-        soc.write(bytes.fromhex(cmd))
-        if _DEBUG:
-            print(">", soc.readline())
+def _string_frame(cmd, x0, y0, data):
+    return _frame(cmd, struct.pack(">HH", x0 & 0xFFFF, y0 & 0xFFFF) + data)
+
+
+def _ascii_frame(x0, y0, txt):
+    if len(txt) <= _MAX_STRING_LEN:
+        return _string_frame(_CMD_DRAW_STRING, x0, y0, _a2b(txt))
+    _log.warning("Too many characters. Max length = %d", _MAX_STRING_LEN)
 
 
-def epd_connect(rate=BAUD_RATE):
-    global soc, BAUD_RATE
-    import serial
+def pic_name(name):
+    """Name of a picture as the EPD has it, None if it cannot have it
+
+    e.g. "pic7" and "pic7.bmp" are "PIC7.BMP", "photo_1.bmp" is None.
+    """
+    name = name.strip().upper()
+    if not name.endswith(".BMP"):
+        name += ".BMP"
+    return name if _PIC_NAME.fullmatch(name) else None
+
+
+def _bitmap_frame(x0, y0, name):
+    pic = pic_name(name)
+    if pic is not None:
+        return _string_frame(_CMD_DRAW_BITMAP, x0, y0, _a2b(pic))
+    _log.warning("Invalid picture name %r: capitals and digits, at most %d characters before .BMP",
+                 name, _PIC_NAME_LEN)
+
+
+def _chinese_frame(x0, y0, gb2312_hex):
+    data = bytes.fromhex(gb2312_hex) + b"\x00"
+    if len(data) <= _MAX_STRING_LEN:
+        return _string_frame(_CMD_DRAW_STRING, x0, y0, data)
+    _log.warning("Too many characters. Max length = %d", _MAX_STRING_LEN)
+
+
+def _parse_reply(line):
+    reply = line.decode("ascii", "replace").strip()
+    if reply.startswith("Error:"):
+        try:
+            return EPDError(int(reply[6:]))
+        except ValueError:
+            return EPDError(250)
+    return reply
+
+
+# differential updates
+#
+# screens drawn inside EPD.frame() are recorded as (state, frame) items,
+# state being the colours and fonts in effect, and compared with the
+# previous screen. only the areas of items that appeared or disappeared
+# are cleared and redrawn, and nothing is sent if the screen is the same
+_DIFF_FULL_AREA = 0.5  # share of the screen changed above which it is redrawn entirely
+_SCREEN_AREA = 800 * 600
+_TEXT_MARGIN = 2  # pixels around the estimated text area, glyphs can overhang
+_FONT_SIZES = {0x01: 32, 0x02: 48, 0x03: 64}
+
+
+def _frame_bbox(frame, font=32):
+    # area drawn by a frame as (x0, y0, x1, y1), None when unknown
+    cmd = frame[3]
+    if cmd == _CMD_DRAW_PIXEL:
+        x, y = struct.unpack_from(">HH", frame, 4)
+        return x, y, x, y
+    if cmd in (_CMD_DRAW_LINE, _CMD_DRAW_RECT, _CMD_FILL_RECT):
+        x0, y0, x1, y1 = struct.unpack_from(">4H", frame, 4)
+        return min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1)
+    if cmd in (_CMD_DRAW_CIRCLE, _CMD_FILL_CIRCLE):
+        x, y, r = struct.unpack_from(">3H", frame, 4)
+        return x - r, y - r, x + r, y + r
+    if cmd in (_CMD_DRAW_TRIANGLE, _CMD_FILL_TRIANGLE):
+        x0, y0, x1, y1, x2, y2 = struct.unpack_from(">6H", frame, 4)
+        return min(x0, x1, x2), min(y0, y1, y2), max(x0, x1, x2), max(y0, y1, y2)
+    if cmd == _CMD_DRAW_STRING:
+        x, y = struct.unpack_from(">HH", frame, 4)
+        txt = frame[8:-6].decode("latin-1")
+        return (x - _TEXT_MARGIN, y - _TEXT_MARGIN,
+                x + get_width(txt, font) + _TEXT_MARGIN, y + font + _TEXT_MARGIN)
+    return None  # bitmaps
+
+
+def _item_bbox(item):
+    (fg, bg, en_font, ch_font), frame = item
+    return _frame_bbox(frame, max(_FONT_SIZES.get(en_font, 32), _FONT_SIZES.get(ch_font, 32)))
+
+
+def _overlaps(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+def _area(box):
+    return (box[2] - box[0] + 1) * (box[3] - box[1] + 1)
+
+
+def _stored_baud_rates():
     try:
-        soc = serial.Serial(
-            port=_DEV,
-            baudrate=rate,
-            timeout=1
-        )
-        print("> EPD connected via serial port")
-        if BAUD_RATE != rate:
-            BAUD_RATE = rate
-            print("> Client-side BAUD_RATE is now %d" % rate)
-        return
-    except:
-        print(">> Unable to connect to USB serial port", _DEV)
-        soc = None
+        with open(_BAUD_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _store_baud_rate(dev, rate):
+    rates = _stored_baud_rates()
+    rates[dev] = rate
+    try:
+        with open(_BAUD_FILE, "w") as f:
+            json.dump(rates, f, indent=1)
+    except OSError as e:
+        _log.warning("Unable to save baud rate: %s", e)
+
+
+class EPD:
+    """Connection to one EPD and everything sent to it
+
+    The epd_* functions drive a default instance. Create more to drive
+    several panels from one process, e.g.
+
+        left, right = EPD("/dev/ttyUSB0"), EPD("/dev/ttyUSB1")
+        left.connect()
+        left.ascii(0, 0, "Hello")
+        left.update()
+    """
+
+    def __init__(self, dev=None, baud_rate=None):
+        self.dev = _DEV if dev is None else dev
+        if baud_rate is None:
+            baud_rate = _stored_baud_rates().get(self.dev, BAUD_RATE)
+        self.baud_rate = baud_rate
+        self.throughput = {}  # bytes/s measured by probe() at each baud rate
+        self.soc = None
+        self.debug = False
+        self.log = logging.LoggerAdapter(_log, {"device": self.dev})
+        self.instruments = None  # see instrument()
+        self.flush_threshold = _FLUSH_THRESHOLD
+        self._buffer = bytearray()
+        self._lock = threading.RLock()
+
+        self.max_commands = _DEVICE_MAX_COMMANDS
+        self.max_bytes = _DEVICE_MAX_BYTES
+        self.refresh_wait = _DEVICE_REFRESH_WAIT
+        self.refresh_time = _DEVICE_REFRESH_WAIT  # learned, see update()
+        self._refresh_waiter = None
+        self._pending_commands = 0
+        self._pending_bytes = 0
+        self._device_stats = {"forced_updates": 0, "peak_commands": 0, "peak_bytes": 0, "redundant": 0}
+        self._state = {}
+
+        self.response_window = _RESPONSE_WINDOW
+        self._responses = False
+        self._reader = None
+        self._inflight = deque()
+        self._inflight_cond = threading.Condition()
+        self._on_response = None
+
+        self._capture = None
+        self._shadow = None
+        self._diff_stats = {"screens": 0, "unchanged": 0, "partial": 0, "full": 0}
+
+    # connection
+
+    def connect(self, url=None, rate=None):
+        """Connect to the EPD
+
+        url picks the transport, see epd_transport, e.g.
+        "serial:///dev/ttyUSB0?baud=115200" or "tcp://192.168.1.50:8899".
+        It defaults to dev, a bare path being a serial port.
+        """
+        if isinstance(url, int):  # connect(rate)
+            url, rate = None, url
+        if url is not None:
+            self.dev = url
+            self.log.extra["device"] = url
+            if self.instruments is not None:
+                self.instruments.labels["device"] = url
+        parts = urlsplit(self.dev)
+        if rate is None and parts.scheme in ("", "serial") and "baud" not in parse_qs(parts.query):
+            rate = self.baud_rate
+        self._pending_commands = self._pending_bytes = 0
+        self._shadow = None
+        self._state.clear()
+        try:
+            self.soc = open_transport(self.dev, rate)
+        except Exception:
+            self.log.warning("Unable to connect to %s", self.dev)
+            self.soc = None
+            return
+        self.log.info("EPD connected via %r", self.soc)
+        if self._responses:
+            self._start_reader()
+        rate = getattr(self.soc, "baud_rate", None)
+        if rate is not None and self.baud_rate != rate:
+            self.baud_rate = rate
+            self.log.info("Client-side BAUD_RATE is now %d", rate)
+
+    def disconnect(self):
+        if self.soc is not None:
+            self.flush()
+            self._stop_reader()
+            self.soc.close()
+            self.soc = None
+        self.log.info("EPD connection closed.")
+
+    def send(self, cmd):
+        """Queue a frame for the EPD
+
+        Returns a Future resolving to the EPD's reply when replies are
+        read (see responses()), None otherwise.
+        """
+        if isinstance(cmd, str):
+            cmd = bytes.fromhex(cmd)
+        with self._lock:
+            # under the lock, so only the thread in frame() is captured
+            if self._capture is not None:
+                self._capture.append(cmd)
+                return
+            if self.soc is None:
+                self.log.warning("EPD not connected. Try epd_connect()")
+                return
+            if cmd[3] in _STATE_COMMANDS:
+                if self._state.get(cmd[3]) == cmd[4:-5]:
+                    self._device_stats["redundant"] += 1
+                    return self._done()
+                self._state[cmd[3]] = cmd[4:-5]
+            elif cmd[3] >= _CMD_DRAW_PIXEL:
+                # drawn outside frame(), the shadow screen no longer matches
+                self._shadow = None
+                if cmd[3] == _CMD_CLEAR:
+                    self._state.clear()
+            if self.instruments is not None:
+                self.instruments.sent(cmd)
+            if cmd[3] == _CMD_UPDATE:
+                future = self._track(cmd)
+                self._buffer.extend(cmd)
+                self.flush()
+                self._pending_commands = self._pending_bytes = 0
+                return future
+            if self._pending_commands and (self._pending_commands >= self.max_commands
+                                           or self._pending_bytes + len(cmd) > self.max_bytes):
+                # let the EPD draw what it has before it starts dropping commands
+                self.send(_cmd_update)
+                self._device_stats["forced_updates"] += 1
+                sleep(self.refresh_wait)
+            future = self._track(cmd)
+            self._buffer.extend(cmd)
+            self._pending_commands += 1
+            self._pending_bytes += len(cmd)
+            if self._pending_commands > self._device_stats["peak_commands"]:
+                self._device_stats["peak_commands"] = self._pending_commands
+            if self._pending_bytes > self._device_stats["peak_bytes"]:
+                self._device_stats["peak_bytes"] = self._pending_bytes
+            if self.debug or len(self._buffer) >= self.flush_threshold:
+                self.flush()
+            return future
+
+    def _done(self):
+        # reply to a command that did not need sending
+        if self._reader is None:
+            return None
+        future = Future()
+        future.set_result("OK")
+        return future
+
+    def _send_all(self, frames):
+        for frame in frames:
+            self.send(frame)
+
+    def _send_frames(self, data, size):
+        # frames of size bytes each back to back in data, e.g. from
+        # epd_bulk. queued like send() does, but a run at a time
+        with self._lock:
+            if self._capture is not None or self._reader is not None:
+                # frame() records single frames, replies are tracked one by one
+                return [self.send(data[at:at + size]) for at in range(0, len(data), size)]
+            if self.soc is None:
+                self.log.warning("EPD not connected. Try epd_connect()")
+                return
+            self._shadow = None
+            at = 0
+            while at < len(data):
+                room = min((len(data) - at) // size, self.max_commands - self._pending_commands,
+                           (self.max_bytes - self._pending_bytes) // size)
+                if room < 1:
+                    if self._pending_commands:
+                        self.send(_cmd_update)
+                        self._device_stats["forced_updates"] += 1
+                        sleep(self.refresh_wait)
+                        continue
+                    room = 1  # a frame over max_bytes is sent all the same, as by send()
+                end = at + int(room) * size
+                self._buffer += data[at:end]
+                if self.instruments is not None:
+                    self.instruments.sent_many(data[at + 3], int(room), end - at)
+                self._pending_commands += int(room)
+                self._pending_bytes += end - at
+                at = end
+                if self._pending_commands > self._device_stats["peak_commands"]:
+                    self._device_stats["peak_commands"] = self._pending_commands
+                if self._pending_bytes > self._device_stats["peak_bytes"]:
+                    self._device_stats["peak_bytes"] = self._pending_bytes
+                if self.debug or len(self._buffer) >= self.flush_threshold:
+                    self.flush()
+
+    def flush(self):
+        """Write all buffered frames to the EPD"""
+        with self._lock:
+            if self._buffer and self.soc is not None:
+                if self.instruments is None:
+                    self.soc.write(self._buffer)
+                else:
+                    self._instrumented_write()
+                del self._buffer[:]
+                if self.debug and self._reader is None:
+                    self.log.info("%s", self.soc.readline())
+
+    def _instrumented_write(self):
+        start = perf_counter()
+        try:
+            self.soc.write(self._buffer)
+        except Exception:
+            self.instruments.write_failed()
+            raise
+        self.instruments.flushed(len(self._buffer), perf_counter() - start)
+
+    def instrument(self, enable=True):
+        """Count what is sent, see epd_instruments
+
+        Returns the Instruments counting, None once disabled. Enabling
+        again keeps counting where it was.
+        """
+        if not enable:
+            self.instruments = None
+        elif self.instruments is None:
+            self.instruments = Instruments(_COMMAND_NAMES, {"device": self.dev})
+        return self.instruments
+
+    @contextmanager
+    def batch(self):
+        """Hold back writes until the end of the block
+
+        Commands sent by other threads wait until the block ends, so the
+        batch reaches the EPD uninterrupted. e.g.
+
+            with epd.batch():
+                epd.ascii(0, 0, "Hello")
+                epd.ascii(0, 40, "world")
+                epd.update()
+        """
+        with self._lock:
+            try:
+                yield
+            finally:
+                self.flush()
+
+    def device_limits(self, max_commands=None, max_bytes=None, refresh_wait=None):
+        """Set how many commands/bytes the EPD buffers between updates
+
+        Returns the limits in effect. refresh_wait is the pause in seconds
+        after an update forced by reaching a limit.
+        """
+        if max_commands is not None:
+            self.max_commands = max_commands
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        if refresh_wait is not None:
+            self.refresh_wait = refresh_wait
+        return self.max_commands, self.max_bytes, self.refresh_wait
+
+    def device_stats(self, reset=False):
+        """Forced updates, the most commands/bytes sent between two updates
+        and the state commands left out as redundant
+        """
+        stats = dict(self._device_stats)
+        if reset:
+            for k in self._device_stats:
+                self._device_stats[k] = 0
+        return stats
+
+    # differential updates
+
+    @contextmanager
+    def frame(self):
+        """Draw a whole screen, sending only what changed since the last one
+
+        Everything drawn in the block makes up the screen, on a blank
+        background, and is updated at the end. e.g.
+
+            with epd.frame():
+                epd.ascii(0, 0, "Status: OK")
+                epd.ascii(0, 40, time.strftime("%H:%M"))
+
+        Areas of the previous screen that differ are cleared and redrawn,
+        and nothing is sent if it is the same. Screens start BLACK on
+        WHITE.
+        """
+        with self._lock:
+            self._capture = []
+            try:
+                yield
+            except BaseException:
+                self._capture = None
+                raise
+            frames, self._capture = self._capture, None
+            self._send_diff(frames)
+
+    def invalidate(self):
+        """Forget the previous screen so the next frame() redraws entirely"""
+        self._shadow = None
+
+    def frame_stats(self, reset=False):
+        """How many screens drawn with frame() were unchanged, partial or full redraws"""
+        stats = dict(self._diff_stats)
+        if reset:
+            for k in self._diff_stats:
+                self._diff_stats[k] = 0
+        return stats
+
+    def _send_diff(self, frames):
+        state = (0x00, 0x03, None, None)
+        background = 0x03
+        items = []
+        for f in frames:
+            cmd = f[3]
+            if cmd == _CMD_SET_COLOR:
+                state = (f[4], f[5]) + state[2:]
+            elif cmd == _CMD_SET_EN_FONT:
+                state = state[:2] + (f[4], state[3])
+            elif cmd == _CMD_SET_CH_FONT:
+                state = state[:3] + (f[4],)
+            elif cmd == _CMD_CLEAR:
+                items = []
+                background = state[1]
+            elif cmd != _CMD_UPDATE:
+                items.append((state, f))
+        screen = (background, items)
+        self._diff_stats["screens"] += 1
+
+        old, self._shadow = self._shadow, None
+        if old == screen:
+            self._shadow = screen
+            self._diff_stats["unchanged"] += 1
+            return
+        redraw = None
+        if old is not None and old[0] == background:
+            redraw = self._diff_items(old[1], items)
+        if redraw is None:
+            self._diff_stats["full"] += 1
+            self.send(_enc_set_color(background, background))
+            self.send(_cmd_clear)
+            self._send_items(items, (background, background, None, None), state)
+        else:
+            dirty, redraw = redraw
+            self._diff_stats["partial"] += 1
+            self.send(_enc_set_color(background, background))
+            for x0, y0, x1, y1 in dirty:
+                self.send(_enc_fill_rect(x0, y0, x1, y1))
+            self._send_items(redraw, (background, background, None, None), state)
+        self.update()
+        self._shadow = screen
+
+    @staticmethod
+    def _diff_items(old, new):
+        # (areas to clear, items to redraw), None when redrawing all is better
+        old_count, new_count = Counter(old), Counter(new)
+        changed = list((old_count - new_count).elements()) + list((new_count - old_count).elements())
+        if not changed:
+            return None  # same items in another order
+        dirty = [_item_bbox(item) for item in changed]
+        if None in dirty or sum(_area(box) for box in dirty) > _DIFF_FULL_AREA * _SCREEN_AREA:
+            return None
+        # items over a cleared area are redrawn, and so is whatever was
+        # drawn over them afterwards. filled rectangles are only redrawn
+        # where needed so they do not spread the redrawn area
+        touched = list(dirty)
+        redraw = []
+        for item in new:
+            box = _item_bbox(item)
+            if box is None:
+                return None  # a bitmap might be anywhere
+            if item[1][3] == _CMD_FILL_RECT:
+                for t in touched:
+                    if _overlaps(box, t):
+                        redraw.append((item[0], _enc_fill_rect(max(box[0], t[0]), max(box[1], t[1]),
+                                                               min(box[2], t[2]), min(box[3], t[3]))))
+            elif any(_overlaps(box, t) for t in touched):
+                redraw.append(item)
+                touched.append(box)
+        if len(dirty) + len(redraw) >= len(new):
+            return None
+        return dirty, redraw
+
+    def _send_items(self, items, current, final):
+        fg, bg, en_font, ch_font = current
+        for (item_fg, item_bg, item_en, item_ch), frame in items + [(final, None)]:
+            if (item_fg, item_bg) != (fg, bg):
+                fg, bg = item_fg, item_bg
+                self.send(_enc_set_color(fg, bg))
+            if item_en is not None and item_en != en_font:
+                en_font = item_en
+                self.send(_enc_en_font(en_font))
+            if item_ch is not None and item_ch != ch_font:
+                ch_font = item_ch
+                self.send(_enc_ch_font(ch_font))
+            if frame is not None:
+                self.send(frame)
+
+    # replies
+
+    def _resolve(self, cmd, future, reply):
+        if isinstance(reply, BaseException):
+            future.set_exception(reply)
+        else:
+            future.set_result(reply)
+        if self.instruments is not None and isinstance(reply, BaseException):
+            self.instruments.replied(reply)
+        if self._on_response is not None:
+            self._on_response(cmd, reply)
+
+    def _track(self, cmd):
+        # register a frame about to be queued, waiting while the window is full
+        if self._reader is None:
+            return None
+        future = Future()
+        with self._inflight_cond:
+            while len(self._inflight) >= self.response_window:
+                # replies only come for frames that were actually written
+                self.flush()
+                if not self._inflight_cond.wait(_RESPONSE_TIMEOUT) and \
+                        len(self._inflight) >= self.response_window:
+                    self._resolve(*self._inflight.popleft(), TimeoutError("no reply from EPD"))
+            self._inflight.append((cmd[3], future))
+        return future
+
+    def _read_replies(self):
+        while self._reader is threading.current_thread():
+            try:
+                line = self.soc.readline()
+            except Exception:  # connection closed
+                break
+            if not line:
+                continue
+            if self.debug:
+                self.log.info("%s", line)
+            reply = _parse_reply(line)
+            with self._inflight_cond:
+                if not self._inflight:
+                    continue  # nothing in flight to answer
+                cmd, future = self._inflight.popleft()
+                self._inflight_cond.notify_all()
+            self._resolve(cmd, future, reply)
+
+    def _start_reader(self):
+        if self._reader is None and self.soc is not None:
+            self._reader = threading.Thread(target=self._read_replies, name="epd-reader", daemon=True)
+            self._reader.start()
+
+    def _stop_reader(self):
+        reader, self._reader = self._reader, None
+        if reader is not None:
+            reader.join()
+        with self._inflight_cond:
+            while self._inflight:
+                self._resolve(*self._inflight.popleft(), ConnectionError("EPD connection closed"))
+            self._inflight_cond.notify_all()
+
+    def responses(self, enable=True, window=None, callback=None):
+        """Read the EPD's replies in the background
+
+        Frames no longer wait for their reply: send() and the drawing
+        methods return a Future resolving to the reply ("OK" or a value)
+        or failing with EPDError. callback(command, reply) is also called
+        for every reply, reply being an EPDError on failure. window limits
+        how many frames may be unanswered at a time.
+        """
+        if window is not None:
+            self.response_window = window
+        self._on_response = callback
+        self._responses = enable
+        if enable:
+            self._start_reader()
+        else:
+            self.flush()
+            self._stop_reader()
+
+    # commands
+
+    def handshake(self):
+        self.log.debug("EPD handshake")
+        future = self.send(_cmd_handshake)
+        self.flush()
+        return future
+
+    def update(self, wait=False, timeout=_REFRESH_TIMEOUT):
+        """Show what was drawn
+
+        With wait, returns a Future resolving to the seconds the refresh
+        took once the EPD is ready for more, or failing with
+        TimeoutError after timeout seconds.
+        """
+        future = self.send(_cmd_update)
+        self.flush()
+        if wait:
+            return self._refreshed(future, timeout)
+        return future
+
+    def clear(self, wait=False, timeout=_REFRESH_TIMEOUT):
+        future = self.send(_cmd_clear)
+        refreshed = self.update(wait, timeout)
+        return refreshed if wait else future
+
+    def _refreshed(self, ack, timeout):
+        started = monotonic()
+        if self._refresh_waiter is None:
+            self._refresh_waiter = ThreadPoolExecutor(1, thread_name_prefix="epd-refresh")
+        return self._refresh_waiter.submit(self._wait_refresh, ack, started, timeout)
+
+    def _wait_refresh(self, ack, started, timeout):
+        deadline = started + timeout
+        if ack is not None:
+            ack.result(timeout)  # raises the EPDError if the update failed
+        sleep(max(started + self.refresh_time * _REFRESH_EARLY - monotonic(), 0))
+        if not self.wait_ready(max(deadline - monotonic(), 0)):
+            raise TimeoutError("EPD not ready %g seconds after update" % timeout)
+        took = monotonic() - started
+        self.refresh_time += _REFRESH_LEARN * (took - self.refresh_time)
+        return took
+
+    def set_baud(self, baud_rate):  # 1200, 2400, 4800, 9600, 19200, 38400, 57600, 115200
+        """Change the baud rate and reconnect, True once the EPD answers"""
+        if getattr(self.soc, "fixed_rate", False):
+            self.log.warning("Do not change baud rate when using WiFi relay, or the WiFi module and the EPD "
+                             "will have different baud rates and stop understanding each other.")
+            return False
+        if baud_rate not in _BAUD_RATES:
+            self.log.warning("Invalid baud rate. Pick from %s", _BAUD_RATES)
+            return False
+        self.send(_enc_set_baud(baud_rate))
+        self.flush()
+        self.log.info("Releasing current serial connection...")
+        self.disconnect()
+        self.log.info("Reconnecting with baud rate %d ...", baud_rate)
+        self.connect(rate=baud_rate)
+        self.log.info("Waiting for the EPD to re-initiate with new baud rate...")
+        if self.wait_ready(_BAUD_SWITCH_TIMEOUT):
+            return True
+        self.log.warning("EPD not answering at %d baud", baud_rate)
+        return False
+
+    def read_baud(self):
+        """The EPD's baud rate, None if it does not answer"""
+        reply, = self._exchange(_cmd_read_baud)
+        if isinstance(reply, str) and reply.isdigit():
+            self.log.info("EPD baud rate: %s", reply)
+            return int(reply)
+        self.log.warning("No baud rate from EPD: %s", reply)
+        return None
+
+    def _exchange(self, frame, count=1, timeout=_RESPONSE_TIMEOUT):
+        # write frame count times straight away and collect the replies:
+        # a string, an EPDError or None when none came in time
+        with self._lock:
+            self.flush()
+            if self.soc is None:
+                return [None] * count
+            deadline = monotonic() + timeout
+            if self._reader is not None:
+                futures = [self._track(frame) for _ in range(count)]
+                self.soc.write(frame * count)
+                replies = []
+                for future in futures:
+                    try:
+                        replies.append(future.result(max(deadline - monotonic(), 0)))
+                    except Exception as e:
+                        replies.append(e if isinstance(e, EPDError) else None)
+                return replies
+            reset = getattr(self.soc, "reset_input", None)
+            if reset is not None:
+                reset()  # replies to frames sent before were never read
+            self.soc.write(frame * count)
+            replies = []
+            while len(replies) < count and monotonic() < deadline:
+                line = self.soc.readline()
+                if line:
+                    replies.append(_parse_reply(line))
+            return replies + [None] * (count - len(replies))
+
+    def wait_ready(self, timeout=_RESPONSE_TIMEOUT):
+        """Handshake until the EPD answers, False if it did not in time"""
+        deadline = monotonic() + timeout
+        while self.soc is not None:
+            if self._exchange(_cmd_handshake, timeout=min(1, max(deadline - monotonic(), 0)))[0] == "OK":
+                return True
+            if monotonic() >= deadline:
+                break
+            sleep(_READY_POLL)
+        return False
+
+    def probe(self, count=_PROBE_FRAMES):
+        """Measure the link with a burst of handshakes
+
+        Every handshake is checked by the EPD and must be answered OK.
+        Returns the bytes/s of frames and replies, also kept in
+        throughput by baud rate, or None when any of them failed.
+        """
+        size = count * (len(_cmd_handshake) + len(b"OK\r\n"))
+        # the burst takes its wire time, 10 bits a byte, on top of the usual wait
+        start = monotonic()
+        replies = self._exchange(_cmd_handshake, count, _RESPONSE_TIMEOUT + size * 10 / self.baud_rate)
+        elapsed = monotonic() - start
+        if replies.count("OK") != count:
+            self.log.warning("%d of %d handshakes failed at %d baud",
+                             count - replies.count("OK"), count, self.baud_rate)
+            return None
+        rate = size / elapsed
+        self.throughput[self.baud_rate] = rate
+        self.log.info("%d baud: %d bytes/s", self.baud_rate, rate)
+        return rate
+
+    def detect_baud(self, rates=None):
+        """Find the baud rate the EPD is at by handshaking at each one"""
+        rates = sorted(rates or _BAUD_RATES, reverse=True)
+        if self.baud_rate in rates:
+            rates.remove(self.baud_rate)
+            rates.insert(0, self.baud_rate)
+        for rate in rates:
+            self.disconnect()
+            self.connect(rate=rate)
+            if self.wait_ready(timeout=1):
+                return rate
+        return None
+
+    def autotune(self, rates=None, count=_PROBE_FRAMES, persist=True):
+        """Move the EPD to the highest baud rate that holds up
+
+        Finds the rate the EPD is at, then tries the faster ones from
+        the top, keeping the first where a probe() passes. The chosen
+        rate is saved for this device unless persist is False, and
+        returned; None if the EPD could not be found.
+        """
+        if getattr(self.soc, "fixed_rate", False):
+            self.log.info("The baud rate of a relay is set on the relay")
+            return None
+        rates = sorted(rates or _BAUD_RATES)
+        found = self.detect_baud(rates)
+        if found is None:
+            self.log.warning("EPD not answering at any baud rate")
+            return None
+        self.probe(count)
+        for rate in reversed(rates):
+            if rate <= found:
+                if self.baud_rate != found:
+                    self.set_baud(found)
+                break
+            if self.set_baud(rate) and self.probe(count) is not None:
+                break
+            if self.detect_baud(rates) is None:
+                self.log.warning("Lost the EPD while trying %d baud", rate)
+                return None
+        if persist:
+            _store_baud_rate(self.dev, self.baud_rate)
+        return self.baud_rate
+
+    def set_memory_nand(self):
+        future = self.send(_cmd_use_nand)
+        self.flush()
+        return future
+
+    def set_memory_sd(self):
+        future = self.send(_cmd_use_sd)
+        self.flush()
+        return future
+
+    def sleep(self):
+        self.log.info("EPD sleep")
+        future = self.send(_cmd_stopmode)
+        self.flush()
+        return future
+
+    def screen_normal(self):
+        future = self.send(_cmd_screen_normal)
+        self.update()
+        return future
+
+    def screen_invert(self):
+        future = self.send(_cmd_screen_invert)
+        self.update()
+        return future
+
+    def import_font(self):
+        future = self.send(_cmd_import_font)
+        self.flush()
+        return future
+
+    def import_pic(self):
+        future = self.send(_cmd_import_pic)
+        self.flush()
+        return future
+
+    def set_color(self, fg, bg):
+        if fg in _COLORS and bg in _COLORS:
+            return self.send(_enc_set_color(_COLORS[fg], _COLORS[bg]))
+
+    def set_en_font(self, en_size):
+        return self.send(_enc_en_font(_hex_byte(en_size)))
+
+    def set_ch_font(self, ch_size):
+        return self.send(_enc_ch_font(_hex_byte(ch_size)))
+
+    # drawing
+
+    def pixel(self, x0, y0):
+        return self.send(_enc_pixel(x0, y0))
+
+    def line(self, x0, y0, x1, y1):
+        return self.send(_enc_line(x0, y0, x1, y1))
+
+    def rect(self, x0, y0, x1, y1):
+        return self.send(_enc_rect(x0, y0, x1, y1))
+
+    def fill_rect(self, x0, y0, x1, y1):
+        return self.send(_enc_fill_rect(x0, y0, x1, y1))
+
+    def circle(self, x0, y0, r):
+        return self.send(_enc_circle(x0, y0, r))
+
+    def fill_circle(self, x0, y0, r):
+        return self.send(_enc_fill_circle(x0, y0, r))
+
+    def triangle(self, x0, y0, x1, y1, x2, y2):
+        return self.send(_enc_triangle(x0, y0, x1, y1, x2, y2))
+
+    def fill_triangle(self, x0, y0, x1, y1, x2, y2):
+        return self.send(_enc_fill_triangle(x0, y0, x1, y1, x2, y2))
+
+    # many shapes at once, from NumPy arrays of one row per shape. see epd_bulk
+
+    def pixels(self, points):  # rows of x, y
+        from epd_bulk import pixels_frames
+        return self._send_frames(*pixels_frames(points))
+
+    def lines(self, lines):  # rows of x0, y0, x1, y1
+        from epd_bulk import lines_frames
+        return self._send_frames(*lines_frames(lines))
+
+    def fill_rects(self, rects):  # rows of x0, y0, x1, y1
+        from epd_bulk import fill_rects_frames
+        return self._send_frames(*fill_rects_frames(rects))
+
+    def fill_triangles(self, triangles):  # rows of x0, y0, x1, y1, x2, y2
+        from epd_bulk import fill_triangles_frames
+        return self._send_frames(*fill_triangles_frames(triangles))
+
+    def ascii(self, x0, y0, txt):
+        frame = _ascii_frame(x0, y0, txt)
+        if frame is not None:
+            return self.send(frame)
+
+    # Not tested
+    def chinese(self, x0, y0, gb2312_hex):  # "hello world" in Chinese: C4E3 BAC3 CAC0 BDE7
+        frame = _chinese_frame(x0, y0, gb2312_hex)
+        if frame is not None:
+            return self.send(frame)
+
+    def bitmap(self, x0, y0, name):  # e.g. "PIC7.BMP", "pic7" works too, see pic_name()
+        frame = _bitmap_frame(x0, y0, name)
+        if frame is not None:
+            return self.send(frame)
+
+    def lcd_digit(self, x, y, d, scale=LCD_MD):
+        self._send_all(_lcd_digit_frames(x, y, d, scale))
+
+    def lcd_digits(self, x, y, digits, scale=LCD_MD):
+        if digits == '':
+            return
+        self._send_all(_lcd_digits_frames(x, y, digits, scale))
+        self.update()
+
+    def block_digit(self, x, y, d, scale=BLOCK_SM):
+        self._send_all(_block_digit_frames(x, y, d, scale))
+
+    def block_digits(self, x, y, digits, scale=BLOCK_SM):
+        if digits == '':
+            return
+        self._send_all(_block_digits_frames(x, y, digits, scale))
+
+    def wrap_ascii(self, x, y, txt, limit=800, size=32, max_height=None):
+        # the widths of sizes 48 and 64 are estimates, see epd_metrics.set_widths()
+        self._send_all(_wrap_ascii_frames(x, y, txt, limit, size, max_height))
+
+
+class EPDGroup:
+    """Several EPDs driven in parallel on a thread pool
+
+    Calling an EPD method on the group calls it on every panel and
+    returns the results in panel order, e.g.
+
+        wall = EPDGroup([EPD("/dev/ttyUSB0"), EPD("/dev/ttyUSB1")])
+        wall.connect()
+        wall.clear()
+        wall.map(lambda epd, txt: epd.ascii(0, 0, txt), ["left", "right"])
+        wall.update()
+    """
+
+    def __init__(self, panels, max_workers=None):
+        self.panels = list(panels)
+        self._pool = ThreadPoolExecutor(max_workers or len(self.panels) or 1, thread_name_prefix="epd-group")
+
+    def run(self, fn, *args, **kwargs):
+        """Call fn(panel, *args, **kwargs) for every panel at once"""
+        futures = [self._pool.submit(fn, panel, *args, **kwargs) for panel in self.panels]
+        return [f.result() for f in futures]
+
+    def map(self, fn, per_panel):
+        """Call fn(panel, arg) with a different argument for each panel"""
+        futures = [self._pool.submit(fn, panel, arg) for panel, arg in zip(self.panels, per_panel)]
+        return [f.result() for f in futures]
+
+    def __getattr__(self, name):
+        if not callable(getattr(EPD, name, None)):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self.run(getattr(EPD, name), *args, **kwargs)
+
+    def close(self):
+        self.run(EPD.disconnect)
+        self._pool.shutdown()
+
+
+# the instance behind the epd_* functions
+_default = EPD()
+
+
+def send(cmd):
+    return _default.send(cmd)
+
+
+def epd_flush():
+    """Write all buffered frames to the EPD"""
+    _default.flush()
+
+
+def epd_batch():
+    """Hold back writes until the end of the block, see EPD.batch()"""
+    return _default.batch()
+
+
+def epd_device_limits(max_commands=None, max_bytes=None, refresh_wait=None):
+    """Set how many commands/bytes the EPD buffers between updates, see EPD.device_limits()"""
+    return _default.device_limits(max_commands, max_bytes, refresh_wait)
+
+
+def epd_device_stats(reset=False):
+    """Forced updates, peak commands/bytes between updates, redundant state commands"""
+    return _default.device_stats(reset)
+
+
+def epd_frame():
+    """Draw a whole screen, sending only what changed, see EPD.frame()"""
+    return _default.frame()
+
+
+def epd_instrument(enable=True):
+    """Count what is sent, see EPD.instrument()"""
+    return _default.instrument(enable)
+
+
+def epd_responses(enable=True, window=None, callback=None):
+    """Read the EPD's replies in the background, see EPD.responses()"""
+    _default.responses(enable, window, callback)
+
+
+def epd_connect(url=None, rate=None):
+    global BAUD_RATE
+    _default.connect(url, rate)
+    BAUD_RATE = _default.baud_rate
 
 
 def epd_debug(v):
     """Print responses of requests"""
-    global _DEBUG
-    if v:
-        _DEBUG = True
-    else:
-        _DEBUG = False
+    _default.debug = bool(v)
 
 
 def epd_handshake():
-    print("> EPD handshake")
-    send("A5000900CC33C33CAC")
-    # send(_cmd_handshake)
+    return _default.handshake()
 
 
 def epd_disconnect():
-    global soc
-    if soc is not None:
-        soc.close()
-    print("> EPD connection closed.")
+    _default.disconnect()
 
 
-def epd_update():
-    send(_cmd_update)
+def epd_update(wait=False, timeout=_REFRESH_TIMEOUT):
+    return _default.update(wait, timeout)
 
 
-def epd_clear():
-    send(_cmd_clear)
-    epd_update()
+def epd_clear(wait=False, timeout=_REFRESH_TIMEOUT):
+    return _default.clear(wait, timeout)
 
 
 def reset_baud_rate():
-    BAUD_RATE = _BAUD_RATE_DEFAULT
+    global BAUD_RATE
+    BAUD_RATE = _default.baud_rate = _BAUD_RATE_DEFAULT
 
 
 def epd_set_baud(baud_rate):  # 1200, 2400, 4800, 9600, 19200, 38400, 57600, 115200
     global BAUD_RATE
-    if type(soc) == socket.socket(socket.AF_INET, socket.SOCK_STREAM):
-        print("> Do not change baud rate when using WiFi relay, or the WiFi module and the EPD will have different baud"
-              " rates and stop understanding each other.")
-        return
-    if baud_rate in _BAUD_RATES:
-        hex_rate = ('0000000' + hex(baud_rate)[2:])[-8:]
-        _cmd = _FRAME_BEGIN + "000D" + _CMD_SET_BAUD + hex_rate + _FRAME_END
-        send(_cmd)
-        print("> Releasing current serial connection...")
-        epd_disconnect()
-        print("> Waiting for the EPD to re-initiate with new baud rate...")
-        sleep(5)
-        print("> Reconnecting with baud rate %d ..." % baud_rate)
-        epd_connect(rate=baud_rate)
-    else:
-        print("> Invalid baud rate. Pick from", _BAUD_RATES)
+    ready = _default.set_baud(baud_rate)
+    BAUD_RATE = _default.baud_rate
+    return ready
 
 
 def epd_read_baud():
-    print("> EPD baud rate:")
-    send(_cmd_read_baud)
+    return _default.read_baud()
+
+
+def epd_wait_ready(timeout=_RESPONSE_TIMEOUT):
+    return _default.wait_ready(timeout)
+
+
+def epd_probe(count=_PROBE_FRAMES):
+    return _default.probe(count)
+
+
+def epd_autotune(rates=None, count=_PROBE_FRAMES, persist=True):
+    global BAUD_RATE
+    rate = _default.autotune(rates, count, persist)
+    BAUD_RATE = _default.baud_rate
+    return rate
 
 
 def epd_set_memory_nand():
-    send(_cmd_use_nand)
+    return _default.set_memory_nand()
 
 
 def epd_set_memory_sd():
-    send(_cmd_use_sd)
+    return _default.set_memory_sd()
 
 
 def epd_sleep():
-    print("> EPD sleep")
-    send(_cmd_stopmode)
+    return _default.sleep()
 
 
 def epd_screen_normal():
-    _cmd = _FRAME_BEGIN + "000A" + _CMD_SCREEN_ROTATION + _EPD_NORMAL + _FRAME_END
-    _cmd += _verify(_cmd)
-    send(_cmd)
-    epd_update()
+    return _default.screen_normal()
 
 
 def epd_screen_invert():
-    _cmd = _FRAME_BEGIN + "000A" + _CMD_SCREEN_ROTATION + _EPD_INVERSION + _FRAME_END
-    _cmd += _verify(_cmd)
-    send(_cmd)
-    epd_update()
+    return _default.screen_invert()
 
 
 def epd_import_font():
-    send(_cmd_import_font)
+    return _default.import_font()
 
 
 def epd_import_pic():
-    send(_cmd_import_pic)
+    return _default.import_pic()
 
 
 def epd_set_color(fg, bg):
-    if fg in [BLACK, DARK_GRAY, GRAY, WHITE] and bg in [BLACK, DARK_GRAY, GRAY, WHITE]:
-        _cmd = _FRAME_BEGIN + "000B" + _CMD_SET_COLOR + fg + bg + _FRAME_END
-        _cmd += _verify(_cmd)
-        send(_cmd)
+    return _default.set_color(fg, bg)
 
 
 def epd_set_en_font(en_size):
-    _cmd = _FRAME_BEGIN + "000A" + _CMD_SET_EN_FONT + en_size + _FRAME_END
-    _cmd += _verify(_cmd)
-    send(_cmd)
+    return _default.set_en_font(en_size)
 
 
 def epd_set_ch_font(ch_size):
-    _cmd = _FRAME_BEGIN + "000A" + _CMD_SET_CH_FONT + ch_size + _FRAME_END
-    _cmd += _verify(_cmd)
-    send(_cmd)
+    return _default.set_ch_font(ch_size)
 
 
 def epd_pixel(x0, y0):
-    print("> EPD Pixel")
-    hex_x0 = "0" + str(((x0 >> 8) & 0xFF)) + ("0" + str(hex(x0 & 0xFF)[2:]))[-2:]
-    hex_y0 = "0" + str(((y0 >> 8) & 0xFF)) + ("0" + str(hex(y0 & 0xFF)[2:]))[-2:]
-
-    _cmd = _FRAME_BEGIN + "000D" + _CMD_DRAW_PIXEL + hex_x0 + hex_y0 + _FRAME_END
-    _cmd += _verify(_cmd)
-    send(_cmd)
+    return _default.pixel(x0, y0)
 
 
 def epd_line(x0, y0, x1, y1):
-    hex_x0 = "0" + str(((x0 >> 8) & 0xFF)) + ("0" + str(hex(x0 & 0xFF)[2:]))[-2:]
-    hex_y0 = "0" + str(((y0 >> 8) & 0xFF)) + ("0" + str(hex(y0 & 0xFF)[2:]))[-2:]
-    hex_x1 = "0" + str(((x1 >> 8) & 0xFF)) + ("0" + str(hex(x1 & 0xFF)[2:]))[-2:]
-    hex_y1 = "0" + str(((y1 >> 8) & 0xFF)) + ("0" + str(hex(y1 & 0xFF)[2:]))[-2:]
-    _cmd = _FRAME_BEGIN + "0011" + _CMD_DRAW_LINE + hex_x0 + hex_y0 + hex_x1 + hex_y1 + _FRAME_END
-    _cmd += _verify(_cmd)
-    send(_cmd)
+    return _default.line(x0, y0, x1, y1)
 
 
 def epd_rect(x0, y0, x1, y1):
-    hex_x0 = "0" + str(((x0 >> 8) & 0xFF)) + ("0" + str(hex(x0 & 0xFF)[2:]))[-2:]
-    hex_y0 = "0" + str(((y0 >> 8) & 0xFF)) + ("0" + str(hex(y0 & 0xFF)[2:]))[-2:]
-    hex_x1 = "0" + str(((x1 >> 8) & 0xFF)) + ("0" + str(hex(x1 & 0xFF)[2:]))[-2:]
-    hex_y1 = "0" + str(((y1 >> 8) & 0xFF)) + ("0" + str(hex(y1 & 0xFF)[2:]))[-2:]
-    _cmd = _FRAME_BEGIN + "0011" + _CMD_DRAW_RECT + hex_x0 + hex_y0 + hex_x1 + hex_y1 + _FRAME_END
-    _cmd += _verify(_cmd)
-    send(_cmd)
+    return _default.rect(x0, y0, x1, y1)
 
 
 def epd_fill_rect(x0, y0, x1, y1):
-    hex_x0 = "0" + str(((x0 >> 8) & 0xFF)) + ("0" + str(hex(x0 & 0xFF)[2:]))[-2:]
-    hex_y0 = "0" + str(((y0 >> 8) & 0xFF)) + ("0" + str(hex(y0 & 0xFF)[2:]))[-2:]
-    hex_x1 = "0" + str(((x1 >> 8) & 0xFF)) + ("0" + str(hex(x1 & 0xFF)[2:]))[-2:]
-    hex_y1 = "0" + str(((y1 >> 8) & 0xFF)) + ("0" + str(hex(y1 & 0xFF)[2:]))[-2:]
-    _cmd = _FRAME_BEGIN + "0011" + _CMD_FILL_RECT + hex_x0 + hex_y0 + hex_x1 + hex_y1 + _FRAME_END
-    _cmd += _verify(_cmd)
-    send(_cmd)
+    return _default.fill_rect(x0, y0, x1, y1)
 
 
 def epd_circle(x0, y0, r):
-    hex_x0 = "0" + str(((x0 >> 8) & 0xFF)) + ("0" + str(hex(x0 & 0xFF)[2:]))[-2:]
-    hex_y0 = "0" + str(((y0 >> 8) & 0xFF)) + ("0" + str(hex(y0 & 0xFF)[2:]))[-2:]
-    hex_r = "0" + str(((r >> 8) & 0xFF)) + ("0" + str(hex(r & 0xFF)[2:]))[-2:]
-    _cmd = _FRAME_BEGIN + "000F" + _CMD_DRAW_CIRCLE + hex_x0 + hex_y0 + hex_r + _FRAME_END
-    _cmd += _verify(_cmd)
-    send(_cmd)
+    return _default.circle(x0, y0, r)
 
 
 def epd_fill_circle(x0, y0, r):
-    hex_x0 = "0" + str(((x0 >> 8) & 0xFF)) + ("0" + str(hex(x0 & 0xFF)[2:]))[-2:]
-    hex_y0 = "0" + str(((y0 >> 8) & 0xFF)) + ("0" + str(hex(y0 & 0xFF)[2:]))[-2:]
-    hex_r = "0" + str(((r >> 8) & 0xFF)) + ("0" + str(hex(r & 0xFF)[2:]))[-2:]
-    _cmd = _FRAME_BEGIN + "000F" + _CMD_FILL_CIRCLE + hex_x0 + hex_y0 + hex_r + _FRAME_END
-    _cmd += _verify(_cmd)
-    send(_cmd)
+    return _default.fill_circle(x0, y0, r)
 
 
 def epd_triangle(x0, y0, x1, y1, x2, y2):
-    hex_x0 = "0" + str(((x0 >> 8) & 0xFF)) + ("0" + str(hex(x0 & 0xFF)[2:]))[-2:]
-    hex_y0 = "0" + str(((y0 >> 8) & 0xFF)) + ("0" + str(hex(y0 & 0xFF)[2:]))[-2:]
-    hex_x1 = "0" + str(((x1 >> 8) & 0xFF)) + ("0" + str(hex(x1 & 0xFF)[2:]))[-2:]
-    hex_y1 = "0" + str(((y1 >> 8) & 0xFF)) + ("0" + str(hex(y1 & 0xFF)[2:]))[-2:]
-    hex_x2 = "0" + str(((x2 >> 8) & 0xFF)) + ("0" + str(hex(x2 & 0xFF)[2:]))[-2:]
-    hex_y2 = "0" + str(((y2 >> 8) & 0xFF)) + ("0" + str(hex(y2 & 0xFF)[2:]))[-2:]
-    _cmd = _FRAME_BEGIN + "0015" + _CMD_DRAW_TRIANGLE + hex_x0 + hex_y0 + hex_x1 + hex_y1 + hex_x2 + hex_y2 + _FRAME_END
-    _cmd += _verify(_cmd)
-    send(_cmd)
+    return _default.triangle(x0, y0, x1, y1, x2, y2)
 
 
 def epd_fill_triangle(x0, y0, x1, y1, x2, y2):
-    hex_x0 = "0" + str(((x0 >> 8) & 0xFF)) + ("0" + str(hex(x0 & 0xFF)[2:]))[-2:]
-    hex_y0 = "0" + str(((y0 >> 8) & 0xFF)) + ("0" + str(hex(y0 & 0xFF)[2:]))[-2:]
-    hex_x1 = "0" + str(((x1 >> 8) & 0xFF)) + ("0" + str(hex(x1 & 0xFF)[2:]))[-2:]
-    hex_y1 = "0" + str(((y1 >> 8) & 0xFF)) + ("0" + str(hex(y1 & 0xFF)[2:]))[-2:]
-    hex_x2 = "0" + str(((x2 >> 8) & 0xFF)) + ("0" + str(hex(x2 & 0xFF)[2:]))[-2:]
-    hex_y2 = "0" + str(((y2 >> 8) & 0xFF)) + ("0" + str(hex(y2 & 0xFF)[2:]))[-2:]
-    _cmd = _FRAME_BEGIN + "0015" + _CMD_FILL_TRIANGLE + hex_x0 + hex_y0 + hex_x1 + hex_y1 + hex_x2 + hex_y2 + _FRAME_END
-    _cmd += _verify(_cmd)
-    send(_cmd)
+    return _default.fill_triangle(x0, y0, x1, y1, x2, y2)
+
+
+def epd_pixels(points):
+    return _default.pixels(points)
+
+
+def epd_lines(lines):
+    return _default.lines(lines)
+
+
+def epd_fill_rects(rects):
+    return _default.fill_rects(rects)
+
+
+def epd_fill_triangles(triangles):
+    return _default.fill_triangles(triangles)
 
 
 def epd_ascii(x0, y0, txt):
-    if len(txt) <= _MAX_STRING_LEN:
-        size = len(txt) + 14
-        hex_x0 = "0" + str(((x0 >> 8) & 0xFF)) + ("0" + str(hex(x0 & 0xFF)[2:]))[-2:]
-        hex_y0 = "0" + str(((y0 >> 8) & 0xFF)) + ("0" + str(hex(y0 & 0xFF)[2:]))[-2:]
-        hex_txt = a2h(txt)
-        hex_size = "0" + str(((size >> 8) & 0xFF)) + ("0" + str(hex(size & 0xFF)[2:]))[-2:]
-        _cmd = _FRAME_BEGIN + hex_size + _CMD_DRAW_STRING + hex_x0 + hex_y0 + hex_txt + _FRAME_END
-        _cmd += _verify(_cmd)
-        send(_cmd)
-    else:
-        print("> Too many characters. Max length =", _MAX_STRING_LEN)
+    return _default.ascii(x0, y0, txt)
 
 
-# Not tested, not modified
 def epd_chinese(x0, y0, gb2312_hex):  # "hello world" in Chinese: C4E3 BAC3 CAC0 BDE7
-    gb2312_hex = gb2312_hex.replace(" ", "") + "00"
-    if len(gb2312_hex) / 2 <= _MAX_STRING_LEN:
-        hex_x0 = "0" + str(((x0 >> 8) & 0xFF)) + ("0" + str(hex(x0 & 0xFF)[2:]))[-2:]
-        hex_y0 = "0" + str(((y0 >> 8) & 0xFF)) + ("0" + str(hex(y0 & 0xFF)[2:]))[-2:]
-        hex_size = ("000" + hex(13 + len(gb2312_hex) / 2)[2:])[-4:]
-        _cmd = _FRAME_BEGIN + hex_size + _CMD_DRAW_STRING + hex_x0 + hex_y0 + gb2312_hex + _FRAME_END
-        _cmd += _verify(_cmd)
-        send(_cmd)
-    else:
-        print("> Too many characters. Max length =", _MAX_STRING_LEN)
+    return _default.chinese(x0, y0, gb2312_hex)
+
+
+def epd_bitmap(x0, y0, name):  # e.g. "PIC7.BMP", "pic7" works too, see pic_name()
+    return _default.bitmap(x0, y0, name)
+
+
+def _lcd_digit(x, y, d, scale=LCD_MD):
+    _default.lcd_digit(x, y, d, scale)
+
+
+def epd_lcd_digits(x, y, digits, scale=LCD_MD):
+    _default.lcd_digits(x, y, digits, scale)
+
+
+def block_digit(x, y, d, scale=BLOCK_SM):
+    _default.block_digit(x, y, d, scale)
+
+
+def epd_block_digits(x, y, digits, scale=BLOCK_SM):
+    _default.block_digits(x, y, digits, scale)
 
 
-def epd_bitmap(x0, y0, name):  # file names must be all capitals and <10 letters including '.'
-    size = len(name) + 14
-    hex_x0 = "0" + str(((x0 >> 8) & 0xFF)) + ("0" + str(hex(x0 & 0xFF)[2:]))[-2:]
-    hex_y0 = "0" + str(((y0 >> 8) & 0xFF)) + ("0" + str(hex(y0 & 0xFF)[2:]))[-2:]
-    hex_name = a2h(name)
-    hex_size = "0" + str(((size >> 8) & 0xFF)) + ("0" + str(hex(size & 0xFF)[2:]))[-2:]
-    _cmd = _FRAME_BEGIN + hex_size + _CMD_DRAW_BITMAP + hex_x0 + hex_y0 + hex_name + _FRAME_END
-    _cmd += _verify(_cmd)
-    send(_cmd)
+def wrap_ascii(x, y, txt, limit=800, size=32, max_height=None):
+    # the widths of sizes 48 and 64 are estimates, see epd_metrics.set_widths()
+    _default.wrap_ascii(x, y, txt, limit, size, max_height)
 
 
 def get_width(txt, size=32):  # size in [32,48,64]
-    # characters in size 32 are manually measured so their
-    # widths are accurate. font size 48 and 64 are assumed
-    # widths based on simple calculation for rough estimates.
-    if size not in [32, 48, 64]:
-        print("> Error: size must be in [32,48,64]")
+    # see epd_metrics for the widths and how to measure 48 and 64
+    if size not in SIZES:
+        _log.warning("Error: size must be in [32,48,64]")
+        return
+    return metrics(size).width(txt)
+
+
+def _wrap_ascii_frames(x, y, txt, limit=800, size=32, max_height=None):
+    # txt is a string or an iterable of strings, e.g. a log tail
+    if isinstance(txt, str):
+        txt = [txt.strip()]
+    if max_height is None:
+        max_height = 600 - y  # nothing below the screen is shown anyway
+    runs = list(layout(txt, x, y, limit, size, max_height))
+    if not runs:
         return
-    width = 0
-    for c in txt:
-        if c in "'":
-            width += 5
-        elif c in "ijl|":
-            width += 6
-        elif c in "f":
-            width += 7
-        elif c in " It![].,;:/\\":
-            width += 8
-        elif c in "r-`(){}":
-            width += 9
-        elif c in '"':
-            width += 10
-        elif c in "*":
-            width += 11
-        elif c in "x^":
-            width += 12
-        elif c in "Jvz":
-            width += 13
-        elif c in "cksy":
-            width += 14
-        elif c in "Labdeghnopqu$#?_1234567890":
-            width += 15
-        elif c in "T+<>=~":
-            width += 16
-        elif c in "FPVXZ":
-            width += 17
-        elif c in "ABEKSY&":
-            width += 18
-        elif c in "HNUw":
-            width += 19
-        elif c in "CDR":
-            width += 20
-        elif c in "GOQ":
-            width += 21
-        elif c in "m":
-            width += 22
-        elif c in "M":
-            width += 23
-        elif c in "%":
-            width += 24
-        elif c in "@":
-            width += 27
-        elif c in "W":
-            width += 28
-        else:  # non-ascii or Chinese character
-            width += 32
-    return int(width * (size / 32.0))
-
-
-def wrap_ascii(x, y, txt, limit=800, size=32):  # does not work well with size 48 or 64
-    DELIMITER = " "
-    DELIMITER_WIDTH = get_width(DELIMITER, size)
-    WHITE_WIDTH = get_width(" ", size)
-    lines = txt.strip().split("\n")
-    y_offset = 0
-    for l in lines:
-        words = l.strip().split(DELIMITER)
-        line = ""
-        line_width = 0
-        for word in words:
-            word_width = get_width(word, size)
-            if line_width + DELIMITER_WIDTH + word_width <= limit:
-                line += DELIMITER + word
-                line_width += DELIMITER_WIDTH + word_width
-            else:
-                # clear line up to the whole line width
-                epd_set_color(WHITE, WHITE)
-                epd_fill_rect(x, y + y_offset, x + limit, y + y_offset + size)
-                epd_set_color(BLACK, WHITE)
-                epd_ascii(x, y + y_offset, line.strip(DELIMITER))
-                y_offset += size
-                line = word
-                line_width = word_width
-        if line != "":
-            # clear line up to the whole line width
-            epd_set_color(WHITE, WHITE)
-            epd_fill_rect(x, y + y_offset, x + limit, y + y_offset + size)
-            epd_set_color(BLACK, WHITE)
-            epd_ascii(x, y + y_offset, line.strip(DELIMITER))
-            y_offset += size
+
+    # clear the whole paragraph, then write all lines, so colours are
+    # switched only twice
+    yield _enc_set_color(_COLORS[WHITE], _COLORS[WHITE])
+    yield _enc_fill_rect(x, y, x + limit, y + len(runs) * size)
+    yield _enc_set_color(_COLORS[BLACK], _COLORS[WHITE])
+    for x0, y0, line in runs:
+        if line:
+            frame = _ascii_frame(x0, y0, line)
+            if frame is not None:
+                yield frame
 
 
 def print_help():  # list all available functions
     print("""\
-epd_connect()                           # opens a connection to EPD (TCP/IP or USB serial)
+# every epd_xxx() function below is also a method EPD.xxx() of the EPD
+# class, for driving more than one panel. EPDGroup([EPD(...), ...]) calls
+# methods on all its panels in parallel
+
+epd_connect(url=None,rate=None)         # opens a connection to EPD (TCP/IP or USB serial)
+                                        # url e.g. serial:///dev/ttyUSB0?baud=115200 or
+                                        # tcp://host:port, see epd_transport
 epd_handshake()                         # check if EPD is ready via serial connection
 epd_disconnect()                        # close serial connection to EPD
+epd_flush()                             # write buffered commands to EPD now
+with epd_batch(): ...                   # send a group of commands in one uninterrupted write
 epd_debug(True|False)                 # enable/disable(default) DEBUG serial communication (SLOW!)
+epd_instrument(True|False)              # count commands, bytes, write times and EPD errors. returns
+                                        # Instruments with .snapshot() and .prometheus()
+                                        # messages go to logging.getLogger("epd")
+epd_responses(True|False,window,callback)
+                                        # read EPD replies in the background, commands return
+                                        # Futures resolving to "OK" or raising EPDError
 epd_sleep()                              # put EPD to sleep. to wake up pin by physical pin only
 
-epd_read_baud()                         # read EPD serial connection baud rate
+epd_read_baud()                         # read EPD serial connection baud rate, returned as int
 epd_set_baud(int)                       # set EPD serial baud rate & restart & reconnect
+epd_wait_ready(timeout=5)               # handshake until the EPD answers, True if it did
+epd_probe(count=64)                     # bytes/s of a burst of handshakes, None if any failed
+epd_autotune(rates=None,count=64,persist=True)
+                                        # find the EPD's baud rate and move it to the fastest
+                                        # that passes epd_probe(). remembered for the device
 
 epd_set_memory_nand()                   # use internal memory (default)
 epd_set_memory_sd()                     # use SD card
@@ -742,8 +1982,16 @@ epd_set_en_font(ASCII32|ASCII48|ASCII64)# set ASCII font size
 
 epd_screen_normal()                     # flip EPD screen back to normal
 epd_screen_invert()                     # flip EPD screen 180 degrees
-epd_clear()                             # clear display
-epd_update()                            # update screen with buffered commands
+epd_clear(wait=False)                   # clear display. with wait, returns a Future resolving
+                                        # once the EPD is ready again, like epd_update()
+with epd_frame(): ...                   # draw a whole screen, sending only what changed since the
+                                        # last one and nothing if it is the same
+epd_update(wait=False,timeout=15)       # update screen with buffered commands (flushes them first)
+                                        # with wait, returns a Future resolving to the seconds the
+                                        # refresh took, as soon as the EPD is ready for more
+epd_device_limits(cmds,bytes,wait)      # commands/bytes the EPD takes between updates
+epd_device_stats()                      # forced updates, peak commands/bytes between updates and
+                                        # colour/font/mode commands left out as redundant
 
 epd_lcd_digits(x,y,"digits string",scale=LCD_SM|LCD_MD|LCD_LG|<num>)
                                         # display digits including colon in LCD-digit font
@@ -754,8 +2002,11 @@ epd_block_digits(x,y,"digits string",scale=BLOCK_SM|BLOCK_MD|BLOCK_LG|<num>)
 epd_ascii(x,y,"ascii string")           # display ascii string
 epd_chinese(x,y,"hex code of Chinese")  # display Chinese string
 
-wrap_ascii(x,y,txt,limit=800,size=32)   # auto-wraps a paragraph of ascii texts and displays
-                                        # from origin x,y with optional width limit and font size
+wrap_ascii(x,y,txt,limit=800,size=32,max_height=None)
+                                        # auto-wraps a paragraph of ascii texts and displays
+                                        # from origin x,y with optional width limit and font size.
+                                        # txt may be an iterable of strings, e.g. a log tail.
+                                        # text past max_height is cut off with "..."
 
 epd_pixel(x,y)                          # draw a pixel
 epd_line(x0,y0,x1,y1)                   # draw a line
@@ -766,5 +2017,14 @@ epd_fill_circle(x,y,radius)             # draw a filled circle
 epd_triangle(x0,y0,x1,y1,x2,y2)         # draw a triangle
 epd_fill_triangle(x0,y0,x1,y1,x2,y2)    # draw a filled triangle
 
-epd_bitmap(x,y,"image file name")       # display image
+epd_pixels(points)                      # many shapes from a NumPy array, one row per shape:
+epd_lines(lines)                        # x,y for pixels, x0,y0,x1,y1 for lines and rectangles,
+epd_fill_rects(rects)                   # x0,y0,x1,y1,x2,y2 for triangles. clipped to the
+epd_fill_triangles(triangles)           # screen and encoded at once, see epd_bulk (needs NumPy)
+
+epd_bitmap(x,y,"image file name")       # display image, e.g. "PIC7.BMP" or "pic7". names are
+                                        # capitals and digits, at most 6 before .BMP
+pic_name("pic7")                        # the name the EPD has a picture under, None if invalid
+                                        # epd_assets keeps track of the pictures and fonts on
+                                        # each EPD and imports only when they changed
 """)
@@ -0,0 +1,170 @@
+"""Keep track of the pictures and fonts in each EPD's NandFlash
+
+epd_import_pic() and epd_import_font() wipe what the EPD has and copy
+everything on the SD card again, which takes minutes and blanks the
+panel. Assets remembers a hash of every file imported into each EPD, so
+the import is only done when the wanted files differ from what is there:
+
+    import epd, epd_assets
+    assets = epd_assets.Assets()            # the default EPD, or Assets(panel)
+    todo = assets.plan(pictures=glob("art/*.bmp"), fonts=["files/GBK32.FON"])
+    if todo:
+        assets.stage(todo, "/media/sdcard")  # copy them onto the SD card
+        # put the SD card in the EPD, then
+        assets.install(todo)                 # import and remember
+
+Picture files are named as the EPD has them (see epd.pic_name()), names
+it could not find are refused before anything is copied. Fonts must be
+one of epd.FONT_FILES. What was imported is kept in ~/.epd_assets.json
+per device.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+import epd as _epd
+
+_MANIFEST = os.path.join(os.path.expanduser("~"), ".epd_assets.json")
+_IMPORT_TIMEOUT = 600  # seconds an import may keep the EPD busy
+KINDS = ("pictures", "fonts")
+_log = logging.getLogger("epd.assets")
+
+
+def _digest(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 16), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _named(paths, name_of):
+    # {name on the EPD: path}, ValueError naming every file that has none
+    named = {}
+    bad = []
+    for path in paths:
+        name = name_of(os.path.basename(path))
+        if name is None:
+            bad.append(path)
+        elif named.setdefault(name, path) != path:
+            bad.append("%s (%s again)" % (path, name))
+    if bad:
+        raise ValueError("no valid EPD name for %s" % ", ".join(bad))
+    return named
+
+
+def _font_name(name):
+    name = name.upper()
+    return name if name in _epd.FONT_FILES else None
+
+
+class Assets:
+    """What was imported into panel (the default EPD if None)
+
+    The manifest is keyed by the panel's device, so every EPD on a
+    machine has its own record.
+    """
+
+    def __init__(self, panel=None, manifest=_MANIFEST):
+        self.panel = _epd._default if panel is None else panel
+        self.manifest = manifest
+
+    def _load(self):
+        try:
+            with open(self.manifest) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    @property
+    def installed(self):
+        """{kind: {name: sha256}} imported into the panel, see KINDS"""
+        entry = self._load().get(self.panel.dev or "", {})
+        return {kind: entry.get(kind, {}) for kind in KINDS}
+
+    def has_picture(self, name):
+        """Whether the picture name was imported into the panel"""
+        return _epd.pic_name(name) in self.installed["pictures"]
+
+    def plan(self, pictures=None, fonts=None):
+        """Kinds whose wanted files differ from what the panel has
+
+        pictures and fonts are the paths of every file the panel should
+        hold, None leaves that kind alone. Returns {kind: {name: (path,
+        sha256)}} with the whole wanted set of each kind to import again,
+        empty when nothing changed. Raises ValueError for files the EPD
+        could not find by their name.
+        """
+        wanted = {}
+        if pictures is not None:
+            wanted["pictures"] = _named(pictures, _epd.pic_name)
+        if fonts is not None:
+            wanted["fonts"] = _named(fonts, _font_name)
+        installed = self.installed
+        todo = {}
+        for kind, named in wanted.items():
+            files = {name: (path, _digest(path)) for name, path in named.items()}
+            if {name: digest for name, (_, digest) in files.items()} != installed[kind]:
+                todo[kind] = files
+        return todo
+
+    def stage(self, todo, sd_root, clean=True):
+        """Copy the files of plan() to the top of the SD card at sd_root
+
+        The EPD imports every file of a kind it finds there, so with
+        clean other pictures or fonts are removed first, else they end up
+        in the NandFlash without being in the manifest.
+        """
+        for kind, files in todo.items():
+            name_of = _epd.pic_name if kind == "pictures" else _font_name
+            for entry in os.listdir(sd_root):
+                if entry not in files and name_of(entry) == entry:
+                    if clean:
+                        os.remove(os.path.join(sd_root, entry))
+                    else:
+                        _log.warning("%s on the SD card will be imported too", entry)
+            for name, (path, _) in files.items():
+                _log.info("%s -> %s", path, name)
+                shutil.copyfile(path, os.path.join(sd_root, name))
+
+    def install(self, todo, timeout=_IMPORT_TIMEOUT):
+        """Import the kinds of plan() from the SD card and remember them
+
+        Returns the kinds imported. Raises TimeoutError when the EPD is
+        not ready again in timeout seconds, the manifest then keeps what
+        was there before.
+        """
+        imports = {"pictures": self.panel.import_pic, "fonts": self.panel.import_font}
+        done = []
+        self.panel.set_memory_sd()
+        try:
+            for kind in KINDS:
+                if kind not in todo:
+                    continue
+                _log.info("EPD importing %s, this takes a while", kind)
+                imports[kind]()
+                if not self.panel.wait_ready(timeout):
+                    raise TimeoutError("EPD not ready %g seconds after importing %s" % (timeout, kind))
+                self._remember(kind, {name: digest for name, (_, digest) in todo[kind].items()})
+                done.append(kind)
+        finally:
+            self.panel.set_memory_nand()
+        return done
+
+    def _remember(self, kind, files):
+        manifest = self._load()
+        manifest.setdefault(self.panel.dev or "", {})[kind] = files
+        try:
+            with open(self.manifest, "w") as f:
+                json.dump(manifest, f, indent=1, sort_keys=True)
+        except OSError as e:
+            _log.warning("Unable to save asset manifest: %s", e)
+
+    def forget(self):
+        """Drop the panel's record, e.g. after importing by hand"""
+        manifest = self._load()
+        if manifest.pop(self.panel.dev or "", None) is not None:
+            with open(self.manifest, "w") as f:
+                json.dump(manifest, f, indent=1, sort_keys=True)
@@ -0,0 +1,327 @@
+"""asyncio client for the EPD
+
+Same drawing surface as epd.py, as coroutines over asyncio streams, so
+an event loop never blocks on the serial port or on a wait for the EPD.
+
+    epd = await open_tcp("192.168.1.50", 8899)
+    await epd.clear()
+    await epd.ascii(100, 100, "Hello world")
+    await epd.update()
+    await epd.close()
+
+Serial ports need pyserial-asyncio.
+"""
+import asyncio
+from collections import deque
+
+import epd as _epd
+
+
+async def open_serial(port=_epd._DEV, baudrate=_epd.BAUD_RATE, responses=False):
+    """Connect to the EPD over a serial port"""
+    import serial_asyncio
+
+    async def opener(rate):
+        return await serial_asyncio.open_serial_connection(url=port, baudrate=rate)
+
+    client = AsyncEPD(opener, baudrate, responses)
+    await client.connect()
+    return client
+
+
+async def open_tcp(host, port, responses=False):
+    """Connect to the EPD through a WiFi relay"""
+
+    async def opener(rate):
+        return await asyncio.open_connection(host, port)
+
+    client = AsyncEPD(opener, None, responses)
+    await client.connect()
+    return client
+
+
+class AsyncEPD:
+    """EPD connection driven from an event loop
+
+    Frames are buffered as in epd.EPD and written by update(), flush()
+    or once the buffer passes flush_threshold bytes. Updates are forced
+    before the EPD's own buffer would overflow (see
+    epd.EPD.device_limits()), waiting with asyncio.sleep, and colour,
+    font and mode commands are left out when redundant. With
+    responses=True, replies are read by a task and every command
+    returns an asyncio Future of its reply.
+    """
+
+    def __init__(self, opener, baudrate=None, responses=False):
+        self._opener = opener
+        self.baudrate = baudrate
+        self.responses = responses
+        self._reader = None
+        self._writer = None
+        self._read_task = None
+        self.flush_threshold = _epd._FLUSH_THRESHOLD
+        self._buffer = bytearray()
+        self.max_commands = _epd._DEVICE_MAX_COMMANDS
+        self.max_bytes = _epd._DEVICE_MAX_BYTES
+        self.refresh_wait = _epd._DEVICE_REFRESH_WAIT
+        self._pending_commands = 0
+        self._pending_bytes = 0
+        self._state = {}
+        self.response_window = _epd._RESPONSE_WINDOW
+        self._inflight = deque()
+        self._abandoned = 0  # frames at the head of _inflight given up on
+        self._window = None
+
+    async def connect(self):
+        self._reader, self._writer = await self._opener(self.baudrate)
+        self._pending_commands = self._pending_bytes = 0
+        self._state.clear()
+        if self.responses:
+            self._window = asyncio.Semaphore(self.response_window)
+            self._read_task = asyncio.ensure_future(self._read_replies())
+
+    async def close(self):
+        if self._writer is None:
+            return
+        await self.flush()
+        if self._read_task is not None:
+            self._read_task.cancel()
+            try:
+                await self._read_task
+            except asyncio.CancelledError:
+                pass
+            self._read_task = None
+        while self._inflight:
+            _, future = self._inflight.popleft()
+            if not future.done():
+                future.set_exception(ConnectionError("EPD connection closed"))
+        self._abandoned = 0
+        self._writer.close()
+        await self._writer.wait_closed()
+        self._writer = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def _read_replies(self):
+        while True:
+            line = await self._reader.readline()
+            if not line:
+                break
+            reply = _epd._parse_reply(line)
+            if not self._inflight:
+                continue
+            _, future = self._inflight.popleft()
+            if self._abandoned:
+                # a late reply to a frame given up on, its slot was passed on
+                self._abandoned -= 1
+                continue
+            self._window.release()
+            if future.done():
+                continue
+            if isinstance(reply, BaseException):
+                future.set_exception(reply)
+            else:
+                future.set_result(reply)
+
+    async def _track(self, cmd):
+        if self._read_task is None:
+            return None
+        if self._window.locked():
+            # replies only come for frames that were actually written
+            await self.flush()
+        try:
+            await asyncio.wait_for(self._window.acquire(), _epd._RESPONSE_TIMEOUT)
+        except asyncio.TimeoutError:
+            # give up on the oldest frame instead of stalling forever. it
+            # stays in flight so its reply, should it come, is thrown away,
+            # but its slot in the window goes to this frame
+            _, future = self._inflight[self._abandoned]
+            self._abandoned += 1
+            if not future.done():
+                future.set_exception(TimeoutError("no reply from EPD"))
+        future = asyncio.get_running_loop().create_future()
+        self._inflight.append((cmd[3], future))
+        return future
+
+    async def send(self, cmd):
+        """Queue a frame, see epd.send()"""
+        if isinstance(cmd, str):
+            cmd = bytes.fromhex(cmd)
+        if self._writer is None:
+            raise ConnectionError("EPD not connected")
+        if cmd[3] in _epd._STATE_COMMANDS:
+            if self._state.get(cmd[3]) == cmd[4:-5]:
+                return self._done()
+            self._state[cmd[3]] = cmd[4:-5]
+        elif cmd[3] == _epd._CMD_CLEAR:
+            self._state.clear()
+        if cmd[3] == _epd._CMD_UPDATE:
+            future = await self._track(cmd)
+            self._buffer.extend(cmd)
+            await self.flush()
+            self._pending_commands = self._pending_bytes = 0
+            return future
+        if self._pending_commands and (self._pending_commands >= self.max_commands
+                                       or self._pending_bytes + len(cmd) > self.max_bytes):
+            # let the EPD draw what it has before it starts dropping commands
+            await self.send(_epd._cmd_update)
+            await asyncio.sleep(self.refresh_wait)
+        future = await self._track(cmd)
+        self._buffer.extend(cmd)
+        self._pending_commands += 1
+        self._pending_bytes += len(cmd)
+        if len(self._buffer) >= self.flush_threshold:
+            await self.flush()
+        return future
+
+    def _done(self):
+        # reply to a command that did not need sending
+        if self._read_task is None:
+            return None
+        future = asyncio.get_running_loop().create_future()
+        future.set_result("OK")
+        return future
+
+    async def _send_all(self, frames):
+        for frame in frames:
+            await self.send(frame)
+
+    async def flush(self):
+        """Write all buffered frames to the EPD"""
+        if self._buffer:
+            self._writer.write(bytes(self._buffer))
+            del self._buffer[:]
+        await self._writer.drain()
+
+    async def handshake(self):
+        future = await self.send(_epd._cmd_handshake)
+        await self.flush()
+        return future
+
+    async def update(self):
+        return await self.send(_epd._cmd_update)
+
+    async def clear(self):
+        future = await self.send(_epd._cmd_clear)
+        await self.update()
+        return future
+
+    async def set_baud(self, baud_rate, wait=5):
+        """Change the EPD's baud rate and reconnect at the new rate"""
+        if self.baudrate is None:
+            raise ValueError("baud rate of a WiFi relay cannot be changed")
+        if baud_rate not in _epd._BAUD_RATES:
+            raise ValueError("invalid baud rate, pick from %s" % _epd._BAUD_RATES)
+        await self.send(_epd._enc_set_baud(baud_rate))
+        await self.close()
+        # the EPD restarts with the new rate
+        await asyncio.sleep(wait)
+        self.baudrate = baud_rate
+        await self.connect()
+
+    async def read_baud(self):
+        future = await self.send(_epd._cmd_read_baud)
+        await self.flush()
+        return future
+
+    async def set_memory_nand(self):
+        future = await self.send(_epd._cmd_use_nand)
+        await self.flush()
+        return future
+
+    async def set_memory_sd(self):
+        future = await self.send(_epd._cmd_use_sd)
+        await self.flush()
+        return future
+
+    async def sleep(self):
+        future = await self.send(_epd._cmd_stopmode)
+        await self.flush()
+        return future
+
+    async def screen_normal(self):
+        future = await self.send(_epd._cmd_screen_normal)
+        await self.update()
+        return future
+
+    async def screen_invert(self):
+        future = await self.send(_epd._cmd_screen_invert)
+        await self.update()
+        return future
+
+    async def import_font(self):
+        future = await self.send(_epd._cmd_import_font)
+        await self.flush()
+        return future
+
+    async def import_pic(self):
+        future = await self.send(_epd._cmd_import_pic)
+        await self.flush()
+        return future
+
+    async def set_color(self, fg, bg):
+        if fg in _epd._COLORS and bg in _epd._COLORS:
+            return await self.send(_epd._enc_set_color(_epd._COLORS[fg], _epd._COLORS[bg]))
+
+    async def set_en_font(self, en_size):
+        return await self.send(_epd._enc_en_font(_epd._hex_byte(en_size)))
+
+    async def set_ch_font(self, ch_size):
+        return await self.send(_epd._enc_ch_font(_epd._hex_byte(ch_size)))
+
+    async def pixel(self, x0, y0):
+        return await self.send(_epd._enc_pixel(x0, y0))
+
+    async def line(self, x0, y0, x1, y1):
+        return await self.send(_epd._enc_line(x0, y0, x1, y1))
+
+    async def rect(self, x0, y0, x1, y1):
+        return await self.send(_epd._enc_rect(x0, y0, x1, y1))
+
+    async def fill_rect(self, x0, y0, x1, y1):
+        return await self.send(_epd._enc_fill_rect(x0, y0, x1, y1))
+
+    async def circle(self, x0, y0, r):
+        return await self.send(_epd._enc_circle(x0, y0, r))
+
+    async def fill_circle(self, x0, y0, r):
+        return await self.send(_epd._enc_fill_circle(x0, y0, r))
+
+    async def triangle(self, x0, y0, x1, y1, x2, y2):
+        return await self.send(_epd._enc_triangle(x0, y0, x1, y1, x2, y2))
+
+    async def fill_triangle(self, x0, y0, x1, y1, x2, y2):
+        return await self.send(_epd._enc_fill_triangle(x0, y0, x1, y1, x2, y2))
+
+    async def ascii(self, x0, y0, txt):
+        frame = _epd._ascii_frame(x0, y0, txt)
+        if frame is not None:
+            return await self.send(frame)
+
+    async def chinese(self, x0, y0, gb2312_hex):
+        frame = _epd._chinese_frame(x0, y0, gb2312_hex)
+        if frame is not None:
+            return await self.send(frame)
+
+    async def bitmap(self, x0, y0, name):
+        frame = _epd._bitmap_frame(x0, y0, name)
+        if frame is not None:
+            return await self.send(frame)
+
+    async def lcd_digits(self, x, y, digits, scale=_epd.LCD_MD):
+        if digits == '':
+            return
+        await self._send_all(_epd._lcd_digits_frames(x, y, digits, scale))
+        await self.update()
+
+    async def block_digits(self, x, y, digits, scale=_epd.BLOCK_SM):
+        if digits == '':
+            return
+        await self._send_all(_epd._block_digits_frames(x, y, digits, scale))
+
+    async def wrap_ascii(self, x, y, txt, limit=800, size=32, max_height=None):
+        await self._send_all(_epd._wrap_ascii_frames(x, y, txt, limit, size, max_height))
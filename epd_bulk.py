@@ -0,0 +1,145 @@
+"""Encode many frames of one primitive at once with NumPy
+
+The epd_lines(), epd_fill_rects(), epd_pixels() and epd_fill_triangles()
+functions take arrays of coordinates, one row per shape, e.g. a
+sparkline of thousands of segments:
+
+    ys = 300 - values * 100
+    xs = np.arange(len(ys))
+    epd.epd_lines(np.column_stack((xs[:-1], ys[:-1], xs[1:], ys[1:])))
+
+Shapes are clipped to the 800x600 screen, shapes entirely off it are
+left out. All frames are encoded together into one buffer, checksums
+included, without a Python call per shape.
+
+Needs NumPy.
+"""
+import numpy as np
+
+import epd as _epd
+
+WIDTH = 800
+HEIGHT = 600
+
+_END = np.frombuffer(_epd._FRAME_END.to_bytes(4, "big"), np.uint8)
+
+
+def encode(cmd, coords):
+    """Frames of cmd, one per row of coords, back to back in bytes
+
+    Returns (data, frame size).
+    """
+    coords = np.asarray(coords)
+    n, k = coords.shape
+    size = _epd._FRAME_OVERHEAD + 2 * k
+    out = np.empty((n, size), np.uint8)
+    out[:, 0] = _epd._FRAME_BEGIN
+    out[:, 1] = size >> 8
+    out[:, 2] = size & 0xFF
+    out[:, 3] = cmd
+    out[:, 4:4 + 2 * k] = (coords.astype(np.int64) & 0xFFFF).astype(">u2").view(np.uint8).reshape(n, 2 * k)
+    out[:, 4 + 2 * k:size - 1] = _END
+    out[:, size - 1] = np.bitwise_xor.reduce(out[:, :size - 1], axis=1)
+    return out.tobytes(), size
+
+
+def _rows(arr, k):
+    arr = np.asarray(arr)
+    if arr.size == 0:
+        return np.empty((0, k), np.int64)
+    return np.rint(arr).astype(np.int64).reshape(-1, k)
+
+
+def clip_pixels(points):
+    """Points inside the screen, rows of (x, y)"""
+    p = _rows(points, 2)
+    inside = (p[:, 0] >= 0) & (p[:, 0] < WIDTH) & (p[:, 1] >= 0) & (p[:, 1] < HEIGHT)
+    return p[inside]
+
+
+def clip_rects(rects):
+    """Rectangles cut to the screen, rows of (x0, y0, x1, y1)"""
+    r = _rows(rects, 4)
+    x0, x1 = np.minimum(r[:, 0], r[:, 2]), np.maximum(r[:, 0], r[:, 2])
+    y0, y1 = np.minimum(r[:, 1], r[:, 3]), np.maximum(r[:, 1], r[:, 3])
+    keep = (x1 >= 0) & (x0 < WIDTH) & (y1 >= 0) & (y0 < HEIGHT)
+    out = np.stack((np.clip(x0, 0, WIDTH - 1), np.clip(y0, 0, HEIGHT - 1),
+                    np.clip(x1, 0, WIDTH - 1), np.clip(y1, 0, HEIGHT - 1)), axis=1)
+    return out[keep]
+
+
+def clip_lines(lines):
+    """Lines cut to the screen (Liang-Barsky), rows of (x0, y0, x1, y1)"""
+    seg = _rows(lines, 4).astype(np.float64)
+    x0, y0 = seg[:, 0], seg[:, 1]
+    dx, dy = seg[:, 2] - x0, seg[:, 3] - y0
+    t0 = np.zeros(len(seg))
+    t1 = np.ones(len(seg))
+    keep = np.ones(len(seg), bool)
+    for p, q in ((-dx, x0), (dx, WIDTH - 1 - x0), (-dy, y0), (dy, HEIGHT - 1 - y0)):
+        keep &= (p != 0) | (q >= 0)  # parallel to an edge and outside it
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = q / p
+        t0 = np.where(p < 0, np.maximum(t0, t), t0)
+        t1 = np.where(p > 0, np.minimum(t1, t), t1)
+    keep &= t0 <= t1
+    out = np.stack((x0 + t0 * dx, y0 + t0 * dy, x0 + t1 * dx, y0 + t1 * dy), axis=1)[keep]
+    out = np.rint(out).astype(np.int64)
+    np.clip(out[:, 0::2], 0, WIDTH - 1, out=out[:, 0::2])
+    np.clip(out[:, 1::2], 0, HEIGHT - 1, out=out[:, 1::2])
+    return out
+
+
+def _clip_polygon(points):
+    # Sutherland-Hodgman against the 4 screen edges
+    for axis, limit, inside in ((0, 0, np.greater_equal), (0, WIDTH - 1, np.less_equal),
+                                (1, 0, np.greater_equal), (1, HEIGHT - 1, np.less_equal)):
+        clipped = []
+        for i, cur in enumerate(points):
+            prev = points[i - 1]
+            cur_in, prev_in = inside(cur[axis], limit), inside(prev[axis], limit)
+            if cur_in != prev_in:
+                t = (limit - prev[axis]) / (cur[axis] - prev[axis])
+                clipped.append(tuple(p + t * (c - p) for p, c in zip(prev, cur)))
+            if cur_in:
+                clipped.append(cur)
+        points = clipped
+        if not points:
+            break
+    return points
+
+
+def clip_triangles(triangles):
+    """Triangles cut to the screen, rows of (x0, y0, x1, y1, x2, y2)
+
+    A triangle across an edge of the screen becomes the triangles of a
+    fan over the part on it.
+    """
+    t = _rows(triangles, 6)
+    xs, ys = t[:, 0::2], t[:, 1::2]
+    inside = (xs.min(1) >= 0) & (xs.max(1) < WIDTH) & (ys.min(1) >= 0) & (ys.max(1) < HEIGHT)
+    outside = (xs.max(1) < 0) | (xs.min(1) >= WIDTH) | (ys.max(1) < 0) | (ys.min(1) >= HEIGHT)
+    fans = []
+    for row in t[~inside & ~outside].tolist():
+        poly = _clip_polygon([(float(row[i]), float(row[i + 1])) for i in (0, 2, 4)])
+        for i in range(1, len(poly) - 1):
+            fans.append(poly[0] + poly[i] + poly[i + 1])
+    if not fans:
+        return t[inside]
+    return np.concatenate((t[inside], np.rint(np.array(fans)).astype(np.int64)))
+
+
+def pixels_frames(points):
+    return encode(_epd._CMD_DRAW_PIXEL, clip_pixels(points))
+
+
+def lines_frames(lines):
+    return encode(_epd._CMD_DRAW_LINE, clip_lines(lines))
+
+
+def fill_rects_frames(rects):
+    return encode(_epd._CMD_FILL_RECT, clip_rects(rects))
+
+
+def fill_triangles_frames(triangles):
+    return encode(_epd._CMD_FILL_TRIANGLE, clip_triangles(triangles))
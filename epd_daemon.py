@@ -0,0 +1,367 @@
+"""One process owning the EPD, drawing for many clients
+
+Only one process can hold the serial port. The daemon holds it and
+takes batches of drawing from other processes over a Unix socket:
+
+    python epd_daemon.py --url serial:///dev/ttyUSB0 --socket /tmp/epd.sock
+
+Clients draw with the usual EPD methods into a batch, which is sent
+when the block ends:
+
+    import epd_daemon
+    client = epd_daemon.Client("/tmp/epd.sock", name="clock")
+    with client.batch(region="clock") as b:
+        b.lcd_digits(20, 20, time.strftime("%H:%M"))
+    b.result()          # {"latency": 1.92, "superseded": False}
+
+A batch tagged with a region replaces a batch for the same region that
+is still waiting, which is then answered as superseded: only the last
+clock is drawn. Batches waiting together are drawn with one update,
+lowest priority first so the highest ends up on top. Updates are at
+least min_interval seconds apart, gathering batches that arrive in the
+meantime, unless a batch has priority URGENT or more. Updates sent by
+clients are left out, the daemon does its own. Batches may only draw
+and set colours and fonts: one with any other command, e.g. clearing
+the screen, changing the baud rate or importing pictures, is answered
+with an error and not drawn.
+
+Client.stats() gives each client's batches, superseded batches and
+latency, from receiving a batch to the end of the update showing it.
+"""
+import argparse
+import json
+import os
+import socket
+import socketserver
+import struct
+import tempfile
+import threading
+from concurrent.futures import Future
+from time import monotonic
+
+import epd as _epd
+
+_SOCKET = os.path.join(tempfile.gettempdir(), "epd.sock")
+_MIN_INTERVAL = 2  # seconds from the end of one update to the next
+_COALESCE = 0.2  # seconds to wait for more batches once one arrives
+URGENT = 100  # batches of this priority or more are drawn straight away
+
+# a message is the lengths of a JSON header and of the frames following it
+_MESSAGE = struct.Struct(">II")
+
+# commands a client may send, nothing that changes the panel for the
+# other clients. updates are left out of batches rather than refused
+_ALLOWED = frozenset((_epd._CMD_SET_COLOR, _epd._CMD_SET_EN_FONT, _epd._CMD_SET_CH_FONT,
+                      _epd._CMD_DRAW_PIXEL, _epd._CMD_DRAW_LINE, _epd._CMD_FILL_RECT, _epd._CMD_DRAW_RECT,
+                      _epd._CMD_DRAW_CIRCLE, _epd._CMD_FILL_CIRCLE, _epd._CMD_DRAW_TRIANGLE,
+                      _epd._CMD_FILL_TRIANGLE, _epd._CMD_DRAW_STRING, _epd._CMD_DRAW_BITMAP, _epd._CMD_UPDATE))
+
+
+def _read_exactly(f, n):
+    data = f.read(n)
+    if len(data) < n:
+        raise EOFError
+    return data
+
+
+def _read_message(f):
+    head, size = _MESSAGE.unpack(_read_exactly(f, _MESSAGE.size))
+    return json.loads(_read_exactly(f, head)), _read_exactly(f, size) if size else b""
+
+
+def _split_frames(data):
+    # the frames of a batch, ValueError if it is not whole frames of
+    # allowed commands
+    frames = []
+    at = 0
+    while at < len(data):
+        size = int.from_bytes(data[at + 1:at + 3], "big") if len(data) - at >= 3 else 0
+        if data[at] != _epd._FRAME_BEGIN or size < _epd._FRAME_OVERHEAD or at + size > len(data):
+            raise ValueError("malformed frame at byte %d" % at)
+        if data[at + 3] not in _ALLOWED:
+            raise ValueError("command %s at byte %d is not allowed"
+                             % (_epd._COMMAND_NAMES.get(data[at + 3], "0x%02x" % data[at + 3]), at))
+        frames.append(data[at:at + size])
+        at += size
+    return frames
+
+
+class _Batch:
+    def __init__(self, client, frames, region, priority):
+        self.client = client
+        self.frames = frames
+        self.region = region
+        self.priority = priority
+        self.received = monotonic()
+        self.future = Future()
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Draws the batches of clients on panel"""
+
+    daemon_threads = True
+
+    def __init__(self, panel, path=_SOCKET, min_interval=_MIN_INTERVAL, coalesce=_COALESCE):
+        self.panel = panel
+        self.min_interval = min_interval
+        self.coalesce = coalesce
+        self._pending = []
+        self._cond = threading.Condition()
+        self._last_update = 0
+        self._stats = {}
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except OSError:
+                os.remove(path)  # left over from a daemon that did not stop cleanly
+            else:
+                raise OSError("an EPD daemon is listening on %s already" % path)
+            finally:
+                probe.close()
+        super().__init__(path, _Handler)
+        self._scheduler = threading.Thread(target=self._schedule, name="epd-scheduler", daemon=True)
+        self._scheduler.start()
+
+    def submit(self, client, frames, region=None, priority=0):
+        """Queue a batch, returns a Future of its result"""
+        batch = _Batch(client, [f for f in frames if f[3] != _epd._CMD_UPDATE], region, priority)
+        with self._cond:
+            if region is not None:
+                for old in self._pending:
+                    if old.region == region:
+                        self._pending.remove(old)
+                        self._finish(old, superseded=True)
+                        break
+            self._pending.append(batch)
+            self._cond.notify()
+        return batch.future
+
+    def _schedule(self):
+        while True:
+            batches = []
+            try:
+                with self._cond:
+                    while not self._pending:
+                        self._cond.wait()
+                    # gather batches until the deadline, an urgent one ends the wait
+                    deadline = max(monotonic() + self.coalesce, self._last_update + self.min_interval)
+                    while not any(b.priority >= URGENT for b in self._pending):
+                        left = deadline - monotonic()
+                        if left <= 0:
+                            break
+                        self._cond.wait(left)
+                    batches, self._pending = self._pending, []
+                self._draw(sorted(batches, key=lambda b: b.priority))
+            except Exception as e:
+                # answer the batches at fault and keep scheduling the others
+                self.panel.log.warning("EPD daemon scheduling failed: %s", e)
+                with self._cond:
+                    if not batches:
+                        batches, self._pending = self._pending, []
+                for batch in batches:
+                    if not batch.future.done():
+                        self._finish(batch, error=str(e))
+
+    def _draw(self, batches):
+        panel = self.panel
+        try:
+            with panel.batch():
+                for batch in batches:
+                    # each client draws from the defaults, not from what the batch before left
+                    panel.set_color(_epd.BLACK, _epd.WHITE)
+                    panel.set_en_font(_epd.ASCII32)
+                    panel.set_ch_font(_epd.GBK32)
+                    for frame in batch.frames:
+                        panel.send(frame)
+                done = panel.update(wait=True)
+            if done is not None:
+                done.result()
+        except Exception as e:
+            panel.log.warning("Drawing %d batches failed: %s", len(batches), e)
+            for batch in batches:
+                self._finish(batch, error=str(e))
+            return
+        finally:
+            self._last_update = monotonic()
+        for batch in batches:
+            self._finish(batch)
+
+    def _finish(self, batch, superseded=False, error=None):
+        latency = monotonic() - batch.received
+        with self._cond:
+            stats = self._stats.setdefault(batch.client, {"batches": 0, "superseded": 0, "errors": 0,
+                                                          "latency_total": 0, "latency_max": 0})
+            stats["batches"] += 1
+            if superseded:
+                stats["superseded"] += 1
+            elif error is not None:
+                stats["errors"] += 1
+            else:
+                stats["latency_total"] += latency
+                stats["latency_max"] = max(stats["latency_max"], latency)
+        result = {"latency": latency, "superseded": superseded}
+        if error is not None:
+            result["error"] = error
+        batch.future.set_result(result)
+
+    def stats(self):
+        """Per client: batches, superseded, errors, latency_avg and latency_max"""
+        with self._cond:
+            result = {}
+            for client, s in self._stats.items():
+                drawn = s["batches"] - s["superseded"] - s["errors"]
+                result[client] = {"batches": s["batches"], "superseded": s["superseded"], "errors": s["errors"],
+                                  "latency_avg": s["latency_total"] / drawn if drawn else None,
+                                  "latency_max": s["latency_max"]}
+            return result
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        lock = threading.Lock()
+
+        def reply(message):
+            with lock:
+                try:
+                    self.wfile.write(json.dumps(message).encode() + b"\n")
+                    self.wfile.flush()
+                except OSError:
+                    pass  # the client went away
+
+        while True:
+            try:
+                header, data = _read_message(self.rfile)
+            except (EOFError, OSError, ValueError):
+                return
+            reply_id = header.get("id")
+            if header.get("type") == "stats":
+                reply({"id": reply_id, "stats": self.server.stats()})
+                continue
+            try:
+                frames = _split_frames(data)
+            except ValueError as e:
+                reply({"id": reply_id, "error": str(e)})
+                continue
+            priority = header.get("priority", 0)
+            if not isinstance(priority, int) or isinstance(priority, bool):
+                reply({"id": reply_id, "error": "priority must be an integer, not %r" % (priority,)})
+                continue
+            future = self.server.submit(header.get("client", "?"), frames, header.get("region"), priority)
+            future.add_done_callback(lambda f, i=reply_id: reply(dict(f.result(), id=i)))
+
+
+class Batch(_epd.EPD):
+    """Drawing surface of a Client, everything drawn is kept for the daemon"""
+
+    def __init__(self, client, region=None, priority=0):
+        super().__init__("daemon:%s" % client.path, baud_rate=_epd.BAUD_RATE)
+        self._capture = []
+        self.region = region
+        self.priority = priority
+        self.future = None
+
+    def result(self, timeout=None):
+        """The daemon's answer, {"latency": seconds, "superseded": bool}"""
+        return self.future.result(timeout)
+
+
+class Client:
+    """Connection to a daemon, name tells clients apart in its stats"""
+
+    def __init__(self, path=_SOCKET, name=None):
+        self.path = path
+        self.name = name or "pid%d" % os.getpid()
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(path)
+        self._file = self._sock.makefile("rb")
+        self._lock = threading.Lock()
+        self._waiting = {}
+        self._next_id = 0
+        self._reader = threading.Thread(target=self._read_replies, name="epd-client", daemon=True)
+        self._reader.start()
+
+    def _read_replies(self):
+        for line in self._file:
+            reply = json.loads(line)
+            with self._lock:
+                future = self._waiting.pop(reply.pop("id", None), None)
+            if future is not None:
+                if "error" in reply and "latency" not in reply:
+                    future.set_exception(ValueError(reply["error"]))
+                else:
+                    future.set_result(reply.get("stats", reply))
+        with self._lock:
+            waiting, self._waiting = self._waiting, {}
+        for future in waiting.values():
+            future.set_exception(ConnectionError("EPD daemon closed the connection"))
+
+    def _request(self, header, data=b""):
+        future = Future()
+        with self._lock:
+            self._next_id += 1
+            header = dict(header, id=self._next_id, client=self.name)
+            self._waiting[self._next_id] = future
+            head = json.dumps(header).encode()
+            self._sock.sendall(_MESSAGE.pack(len(head), len(data)) + head + data)
+        return future
+
+    def submit(self, frames, region=None, priority=0):
+        """Send frames to be drawn, returns a Future of the result"""
+        return self._request({"type": "draw", "region": region, "priority": priority}, b"".join(frames))
+
+    def batch(self, region=None, priority=0):
+        """A Batch to draw on, sent at the end of a with block"""
+        return _BatchContext(self, Batch(self, region, priority))
+
+    def stats(self):
+        """Per client stats of the daemon, see Server.stats()"""
+        return self._request({"type": "stats"}).result()
+
+    def close(self):
+        self._sock.close()
+
+
+class _BatchContext:
+    def __init__(self, client, batch):
+        self.client = client
+        self.batch = batch
+
+    def __enter__(self):
+        return self.batch
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            b = self.batch
+            b.future = self.client.submit(b._capture, b.region, b.priority)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Own the EPD and draw for clients on a Unix socket")
+    parser.add_argument("--url", help="EPD to connect to, see epd_transport")
+    parser.add_argument("--socket", default=_SOCKET, help="default %(default)s")
+    parser.add_argument("--min-interval", type=float, default=_MIN_INTERVAL,
+                        help="seconds between updates, default %(default)s")
+    args = parser.parse_args(argv)
+    panel = _epd.EPD(args.url)
+    panel.connect()
+    if panel.soc is None:
+        return
+    server = Server(panel, args.socket, args.min_interval)
+    panel.log.info("EPD daemon listening on %s", args.socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        panel.disconnect()
+
+
+if __name__ == "__main__":
+    main()
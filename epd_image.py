@@ -0,0 +1,254 @@
+"""Convert images to the EPD's 4-grey BMP files
+
+Does what mspaint and uC-GUI-BitmapConvert.exe do in the README: the
+image is scaled to fit the screen, mapped to the four grey levels
+(BLACK, DARK_GRAY, GRAY, WHITE) with dithering and written as the
+4 bpp BMP with a 4-colour palette the EPD reads.
+
+    python epd_image.py photo.jpg -o PHOTO.BMP
+    python epd_image.py photos/ -o sdcard/ --dither ordered
+
+Needs NumPy. BMP, PGM and PPM files are read as they are, other formats
+need Pillow.
+"""
+import argparse
+import os
+import re
+import struct
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+WIDTH = 800
+HEIGHT = 600
+# the EPD only finds pictures named in capitals and digits, no more than
+# 10 characters including ".BMP", as epd.pic_name(). not imported from
+# epd, which asks for the serial port on some platforms
+_NAME_LEN = 10 - len(".BMP")
+
+# 8-bit grey of each level, BLACK .. WHITE as in epd.py
+GREYS = (0x00, 0x55, 0xAA, 0xFF)
+
+DITHERS = ("floyd", "ordered", "none")
+
+
+def _bayer(n):
+    # n x n ordered dither thresholds in [0, 1)
+    m = np.zeros((1, 1))
+    while len(m) < n:
+        m = np.block([[4 * m, 4 * m + 2], [4 * m + 3, 4 * m + 1]])
+    return (m + 0.5) / m.size
+
+
+_BAYER8 = _bayer(8)
+
+
+def _luma(rgb):
+    return rgb[..., 0] * 0.299 + rgb[..., 1] * 0.587 + rgb[..., 2] * 0.114
+
+
+def _read_bmp(data):
+    offset, = struct.unpack_from("<I", data, 10)
+    header, width, height, _, bpp, compression = struct.unpack_from("<IiiHHI", data, 14)
+    if compression not in (0, 3):
+        raise ValueError("compressed BMP")
+    stride = (width * bpp + 31) // 32 * 4
+    rows = np.frombuffer(data, np.uint8, stride * abs(height), offset).reshape(abs(height), stride)
+    if bpp in (24, 32):
+        # pixels are BGR(A)
+        grey = _luma(rows[:, :width * bpp // 8].reshape(abs(height), width, bpp // 8)[..., 2::-1])
+    else:
+        colors, = struct.unpack_from("<I", data, 46)
+        palette = np.frombuffer(data, np.uint8, (colors or 1 << bpp) * 4, 14 + header).reshape(-1, 4)
+        bits = np.unpackbits(rows, axis=1)[:, :width * bpp].reshape(abs(height), width, bpp)
+        index = (bits * (1 << np.arange(bpp - 1, -1, -1, dtype=np.uint8))).sum(axis=2)
+        grey = _luma(palette[:, 2::-1].astype(np.float32))[index]
+    return grey[::-1] if height > 0 else grey  # positive height is stored bottom-up
+
+
+def _read_pnm(data):
+    # binary PGM (P5) or PPM (P6) with 8-bit samples
+    fields = re.match(rb"(P[56])\s+(?:#.*\s+)*(\d+)\s+(?:#.*\s+)*(\d+)\s+(?:#.*\s+)*(\d+)\s", data)
+    if fields is None or int(fields.group(4)) > 255:
+        raise ValueError("unsupported PNM")
+    width, height = int(fields.group(2)), int(fields.group(3))
+    channels = 1 if fields.group(1) == b"P5" else 3
+    pixels = np.frombuffer(data, np.uint8, width * height * channels, fields.end())
+    if channels == 1:
+        return pixels.reshape(height, width).astype(np.float32)
+    return _luma(pixels.reshape(height, width, 3).astype(np.float32))
+
+
+def load(path):
+    """Grey levels 0..255 of an image file as a float array"""
+    with open(path, "rb") as f:
+        data = f.read()
+    if data[:2] == b"BM":
+        return _read_bmp(data).astype(np.float32)
+    if data[:2] in (b"P5", b"P6"):
+        return _read_pnm(data)
+    from PIL import Image
+    with Image.open(path) as img:
+        return np.asarray(img.convert("L"), dtype=np.float32)
+
+
+def resize(grey, width, height):
+    """Scale grey to width x height, averaging the pixels each one covers"""
+    for axis, size in ((0, height), (1, width)):
+        n = grey.shape[axis]
+        if n == size:
+            continue
+        bounds = np.arange(size + 1) * n // size
+        lo, hi = bounds[:-1], np.maximum(bounds[1:], bounds[:-1] + 1)
+        sums = np.cumsum(grey, axis=axis, dtype=np.float64)
+        sums = np.insert(sums, 0, 0, axis=axis)
+        grey = (np.take(sums, hi, axis=axis) - np.take(sums, lo, axis=axis))
+        grey = (grey / np.expand_dims(hi - lo, 1 - axis)).astype(np.float32)
+    return grey
+
+
+def fit(grey, width=WIDTH, height=HEIGHT, enlarge=False):
+    """Scale grey to fit in width x height, keeping its proportions"""
+    h, w = grey.shape
+    scale = min(width / w, height / h)
+    if scale >= 1 and not enlarge:
+        return grey
+    return resize(grey, max(int(w * scale), 1), max(int(h * scale), 1))
+
+
+def quantize(grey, dither="floyd"):
+    """Map grey levels 0..255 to the levels 0 (BLACK) .. 3 (WHITE)
+
+    dither is "floyd" for Floyd-Steinberg error diffusion, "ordered"
+    for an 8x8 Bayer matrix or "none" for the nearest level.
+    """
+    q = np.clip(grey, 0, 255) * (3 / 255)
+    if dither == "none":
+        return np.rint(q).astype(np.uint8)
+    if dither == "ordered":
+        h, w = q.shape
+        threshold = np.tile(_BAYER8, (h // 8 + 1, w // 8 + 1))[:h, :w]
+        return np.clip(np.floor(q + threshold), 0, 3).astype(np.uint8)
+    if dither == "floyd":
+        return _diffuse(q)
+    raise ValueError("dither must be one of %s" % (DITHERS,))
+
+
+def _diffuse(q):
+    # a pixel takes error from its left neighbour and the 3 pixels above,
+    # so all pixels on a line x + 2y = t can be done at once, in order of t
+    h, w = q.shape
+    e = np.zeros((h + 1, w + 2), np.float32)
+    e[:h, 1:w + 1] = q
+    out = np.empty((h, w), np.uint8)
+    for t in range(w + 2 * h - 2):
+        ys = np.arange(max(0, (t - w + 2) // 2), min(h - 1, t // 2) + 1)
+        xs = t - 2 * ys
+        old = e[ys, xs + 1]
+        new = np.clip(np.rint(old), 0, 3)
+        out[ys, xs] = new
+        err = old - new
+        # one statement per neighbour, each writes every pixel only once
+        e[ys, xs + 2] += err * (7 / 16)
+        e[ys + 1, xs] += err * (3 / 16)
+        e[ys + 1, xs + 1] += err * (5 / 16)
+        e[ys + 1, xs + 2] += err * (1 / 16)
+    return out
+
+
+def write_bmp(path, levels):
+    """Write levels 0..3 as the EPD's 4 bpp, 4-colour BMP"""
+    h, w = levels.shape
+    stride = (w * 4 + 31) // 32 * 4
+    rows = np.zeros((h, stride), np.uint8)
+    packed = levels.astype(np.uint8)
+    if w % 2:
+        packed = np.pad(packed, ((0, 0), (0, 1)))
+    rows[:, :(w + 1) // 2] = packed[:, 0::2] << 4 | packed[:, 1::2]
+    palette = b"".join(bytes((g, g, g, 0)) for g in GREYS)
+    offset = 14 + 40 + len(palette)
+    with open(path, "wb") as f:
+        f.write(struct.pack("<2sIHHI", b"BM", offset + rows.size, 0, 0, offset))
+        f.write(struct.pack("<IiiHHIIiiII", 40, w, h, 1, 4, 0, 0, 0, 0, len(GREYS), 0))
+        f.write(palette)
+        f.write(rows[::-1].tobytes())  # bottom-up
+
+
+def convert(src, dst, width=WIDTH, height=HEIGHT, dither="floyd"):
+    """Convert the image file src to the EPD BMP dst, returns dst"""
+    write_bmp(dst, quantize(fit(load(src), width, height), dither))
+    return dst
+
+
+def bmp_name(path, taken=()):
+    """A picture name the EPD accepts for path, not one of taken"""
+    stem = re.sub(r"[^A-Z0-9]", "", os.path.splitext(os.path.basename(path))[0].upper()) or "PIC"
+    name = stem[:_NAME_LEN]
+    n = 0
+    while name + ".BMP" in taken:
+        n += 1
+        suffix = str(n)
+        name = stem[:_NAME_LEN - len(suffix)] + suffix
+    return name + ".BMP"
+
+
+def convert_dir(src_dir, dst_dir, workers=None, taken=None, **kwargs):
+    """Convert every image in src_dir into dst_dir on a process pool
+
+    Returns {source file: BMP name}. Names in the set taken, e.g. of
+    other files written to dst_dir, are not used and the new ones are
+    added to it. Files that cannot be converted are reported and left
+    out.
+    """
+    os.makedirs(dst_dir, exist_ok=True)
+    taken = set() if taken is None else taken
+    names = {}
+    for entry in sorted(os.listdir(src_dir)):
+        path = os.path.join(src_dir, entry)
+        if os.path.isfile(path):
+            names[path] = bmp_name(entry, taken)
+            taken.add(names[path])
+    done = {}
+    with ProcessPoolExecutor(workers) as pool:
+        jobs = {path: pool.submit(convert, path, os.path.join(dst_dir, name), **kwargs)
+                for path, name in names.items()}
+        for path, job in jobs.items():
+            try:
+                job.result()
+                done[path] = names[path]
+            except Exception as e:
+                print(">> Unable to convert %s: %s" % (path, e))
+    return done
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert images to 4-grey BMP files for the EPD")
+    parser.add_argument("source", nargs="+", help="image files or directories")
+    parser.add_argument("-o", "--output", default=".", help="BMP file, or directory for several")
+    parser.add_argument("--dither", choices=DITHERS, default="floyd")
+    parser.add_argument("--size", default="%dx%d" % (WIDTH, HEIGHT), help="largest WIDTHxHEIGHT")
+    parser.add_argument("--workers", type=int, help="processes for directories")
+    args = parser.parse_args(argv)
+    width, height = (int(v) for v in args.size.lower().split("x"))
+    options = dict(width=width, height=height, dither=args.dither)
+
+    if len(args.source) == 1 and os.path.isfile(args.source[0]) and not os.path.isdir(args.output):
+        dst = os.path.join(os.path.dirname(args.output), bmp_name(args.output))
+        if dst != args.output:
+            print(">> The EPD would not find %s, writing %s" % (args.output, dst))
+        print("> %s -> %s" % (args.source[0], convert(args.source[0], dst, **options)))
+        return
+    taken = set()  # names of the whole run, so no file overwrites another
+    for src in args.source:
+        if os.path.isdir(src):
+            for path, name in convert_dir(src, args.output, args.workers, taken, **options).items():
+                print("> %s -> %s" % (path, name))
+        else:
+            os.makedirs(args.output, exist_ok=True)
+            name = bmp_name(src, taken)
+            taken.add(name)
+            print("> %s -> %s" % (src, convert(src, os.path.join(args.output, name), **options)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""Counters and histograms of what an EPD connection sends
+
+EPD.instrument() attaches an Instruments to the send path. Detached,
+which is the default, send() pays for one attribute check:
+
+    stats = epd.epd_instrument()
+    ...
+    stats.snapshot()            # dict of everything counted so far
+    print(stats.prometheus())   # Prometheus text exposition format
+
+Counted are frames and bytes per command, the time each write to the
+transport took and how much it wrote, write failures and the errors
+the EPD replied with (only seen with epd_responses() on).
+"""
+from bisect import bisect_left
+from collections import Counter
+from threading import Lock
+
+# upper bounds of the histogram buckets, the last one catches the rest
+WRITE_SECONDS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+FLUSH_BYTES = (64, 256, 1024, 4096, 16384, 65536)
+
+
+class Histogram:
+    """Observations counted in buckets of upper bounds"""
+
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        buckets = dict(zip(self.bounds, self.counts))
+        buckets["+Inf"] = self.counts[-1]
+        return {"buckets": buckets, "sum": self.sum, "count": self.count}
+
+
+class Instruments:
+    """What one EPD sent, fed by EPD.send() and EPD.flush()
+
+    names maps command bytes to names, labels are added to every
+    Prometheus sample, e.g. {"device": "/dev/ttyUSB0"}.
+    """
+
+    def __init__(self, names, labels=None):
+        self.names = names
+        self.labels = dict(labels or {})
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.commands = Counter()
+            self.command_bytes = Counter()
+            self.write_seconds = Histogram(WRITE_SECONDS)
+            self.flush_bytes = Histogram(FLUSH_BYTES)
+            self.write_errors = 0
+            self.device_errors = Counter()
+            self.timeouts = 0
+
+    # hooks
+
+    def sent(self, frame):
+        # snapshot() iterates the Counters from other threads
+        with self._lock:
+            self.commands[frame[3]] += 1
+            self.command_bytes[frame[3]] += len(frame)
+
+    def sent_many(self, cmd, count, size):
+        with self._lock:
+            self.commands[cmd] += count
+            self.command_bytes[cmd] += size
+
+    def flushed(self, size, seconds):
+        with self._lock:
+            self.write_seconds.observe(seconds)
+            self.flush_bytes.observe(size)
+
+    def write_failed(self):
+        with self._lock:
+            self.write_errors += 1
+
+    def replied(self, reply):
+        # EPDError, TimeoutError and ConnectionError fail a Future
+        if isinstance(reply, TimeoutError):
+            with self._lock:
+                self.timeouts += 1
+        elif hasattr(reply, "code"):
+            with self._lock:
+                self.device_errors[reply.code] += 1
+
+    # export
+
+    def _name(self, cmd):
+        return self.names.get(cmd, "0x%02x" % cmd)
+
+    def snapshot(self):
+        """Everything counted, as a dict of plain values"""
+        with self._lock:
+            return {
+                "commands": {self._name(c): n for c, n in self.commands.items()},
+                "bytes": {self._name(c): n for c, n in self.command_bytes.items()},
+                "bytes_total": sum(self.command_bytes.values()),
+                "write_seconds": self.write_seconds.snapshot(),
+                "flush_bytes": self.flush_bytes.snapshot(),
+                "write_errors": self.write_errors,
+                "device_errors": dict(self.device_errors),
+                "timeouts": self.timeouts,
+            }
+
+    def prometheus(self):
+        """The counters in Prometheus text format, see prometheus()"""
+        return prometheus([self])
+
+
+def _labels(labels, **more):
+    items = dict(labels, **more)
+    if not items:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in items.values())
+    return "{%s}" % ",".join('%s="%s"' % (k, v) for k, v in zip(items, escaped))
+
+
+def _histogram(lines, name, labels, hist):
+    cumulative = 0
+    for bound, count in hist["buckets"].items():
+        cumulative += count
+        lines.append("%s_bucket%s %d" % (name, _labels(labels, le=bound), cumulative))
+    lines.append("%s_sum%s %r" % (name, _labels(labels), float(hist["sum"])))
+    lines.append("%s_count%s %d" % (name, _labels(labels), hist["count"]))
+
+
+_METRICS = (
+    ("epd_commands_total", "counter", "Frames sent per command"),
+    ("epd_bytes_total", "counter", "Bytes sent per command"),
+    ("epd_write_seconds", "histogram", "Time taken by each write to the transport"),
+    ("epd_flush_bytes", "histogram", "Bytes written to the transport at a time"),
+    ("epd_write_errors_total", "counter", "Writes to the transport that failed"),
+    ("epd_device_errors_total", "counter", "Error replies from the EPD per error code"),
+    ("epd_reply_timeouts_total", "counter", "Frames the EPD did not reply to in time"),
+)
+
+
+def prometheus(instruments):
+    """Prometheus text of several Instruments, told apart by their labels"""
+    samples = {name: [] for name, _, _ in _METRICS}
+    for inst in instruments:
+        stats = inst.snapshot()
+        for cmd, n in stats["commands"].items():
+            samples["epd_commands_total"].append("epd_commands_total%s %d" % (_labels(inst.labels, command=cmd), n))
+        for cmd, n in stats["bytes"].items():
+            samples["epd_bytes_total"].append("epd_bytes_total%s %d" % (_labels(inst.labels, command=cmd), n))
+        _histogram(samples["epd_write_seconds"], "epd_write_seconds", inst.labels, stats["write_seconds"])
+        _histogram(samples["epd_flush_bytes"], "epd_flush_bytes", inst.labels, stats["flush_bytes"])
+        samples["epd_write_errors_total"].append(
+            "epd_write_errors_total%s %d" % (_labels(inst.labels), stats["write_errors"]))
+        for code, n in stats["device_errors"].items():
+            samples["epd_device_errors_total"].append(
+                "epd_device_errors_total%s %d" % (_labels(inst.labels, code=code), n))
+        samples["epd_reply_timeouts_total"].append(
+            "epd_reply_timeouts_total%s %d" % (_labels(inst.labels), stats["timeouts"]))
+    lines = []
+    for name, kind, help_text in _METRICS:
+        lines.append("# HELP %s %s" % (name, help_text))
+        lines.append("# TYPE %s %s" % (name, kind))
+        lines.extend(samples[name])
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,178 @@
+"""Widths of text in the EPD's English fonts
+
+Every font size has a FontMetrics with a width per character, so that
+measuring a string is a table lookup per character instead of a search:
+
+    from epd_metrics import metrics
+    metrics(32).width("Hello world")        # 133 pixels
+    metrics(32).fit("Hello world", 100)     # 7 characters fit in 100 pixels
+
+Size 32 was measured on the panel. Sizes 48 and 64 are estimates, size
+32 scaled, until widths measured on the panel are given to set_widths().
+"""
+from bisect import bisect_left
+from functools import lru_cache
+from itertools import accumulate, repeat
+
+# widths of the characters in size 32, manually measured
+_WIDTHS_32 = {
+    5: "'",
+    6: "ijl|",
+    7: "f",
+    8: " It![].,;:/\\",
+    9: "r-`(){}",
+    10: '"',
+    11: "*",
+    12: "x^",
+    13: "Jvz",
+    14: "cksy",
+    15: "Labdeghnopqu$#?_1234567890",
+    16: "T+<>=~",
+    17: "FPVXZ",
+    18: "ABEKSY&",
+    19: "HNUw",
+    20: "CDR",
+    21: "GOQ",
+    22: "m",
+    23: "M",
+    24: "%",
+    27: "@",
+    28: "W",
+}
+
+SIZES = (32, 48, 64)
+
+
+class FontMetrics:
+    """Character widths of one font size
+
+    widths maps characters to their width in pixels. Characters missing
+    from it (non-ASCII or Chinese) are default wide, the size of the
+    font. Widths may be fractions, a string is as wide as the integer
+    part of their sum.
+    """
+
+    def __init__(self, widths, default):
+        self.widths = dict(widths)
+        self.default = default
+        self.width = lru_cache(maxsize=1024)(self._width)
+        self._prefix = lru_cache(maxsize=64)(self._prefix_widths)
+
+    def _width(self, txt):
+        return int(sum(map(self.widths.get, txt, repeat(self.default))))
+
+    def char_width(self, c):
+        return self.widths.get(c, self.default)
+
+    def _prefix_widths(self, txt):
+        # the width of the first i characters at i
+        return [0] + list(accumulate(map(self.widths.get, txt, repeat(self.default))))
+
+    def fit(self, txt, pixels, start=0):
+        """Number of characters of txt from start that fit in pixels"""
+        prefix = self._prefix(txt)
+        return bisect_left(prefix, prefix[start] + pixels + 1) - 1 - start
+
+
+def _scaled(size):
+    widths = {c: w * size / 32 for w, chars in _WIDTHS_32.items() for c in chars}
+    return FontMetrics(widths, size)
+
+
+_METRICS = {size: _scaled(size) for size in SIZES}
+
+
+def metrics(size):
+    """FontMetrics of an English font size, see SIZES"""
+    if size not in _METRICS:
+        raise ValueError("size must be in %s" % sorted(_METRICS))
+    return _METRICS[size]
+
+
+def set_widths(size, widths):
+    """Use widths measured on the panel, {character: pixels}, for size
+
+    Characters missing from widths are default wide, the size of the
+    font.
+    """
+    if size not in SIZES:
+        raise ValueError("size must be in %s" % list(SIZES))
+    _METRICS[size] = FontMetrics(widths, size)
+
+
+def _words(chunks):
+    # words of the text, "\n" at line breaks. a word may go on in the
+    # next chunk, so the last one of each chunk is held back
+    pending = ""
+    for chunk in chunks:
+        lines = (pending + chunk).split("\n")
+        for i, line in enumerate(lines):
+            if i:
+                yield "\n"
+            words = line.split(" ")
+            if i == len(lines) - 1:
+                pending = words.pop()
+            yield from words
+    yield pending
+
+
+def wrap(chunks, limit, size=32):
+    """Break text into lines of at most limit pixels
+
+    chunks is an iterable of strings that are read one at a time, the
+    text may be split anywhere, e.g. the lines of a log. Lines break
+    between words and at newlines, a word wider than limit is broken
+    where it has to be. Yields the lines.
+    """
+    m = metrics(size)
+    space = m.width(" ")
+    line = []
+    width = 0
+    for word in _words(chunks):
+        if word == "\n":
+            yield " ".join(line)
+            line = []
+            width = 0
+            continue
+        w = m.width(word)
+        if line and width + space + w <= limit:
+            line.append(word)
+            width += space + w
+            continue
+        if line:
+            yield " ".join(line)
+        while w > limit and len(word) > 1:
+            n = max(m.fit(word, limit), 1)
+            yield word[:n]
+            word = word[n:]
+            w = m.width(word)
+        line = [word]
+        width = w
+    if line:
+        yield " ".join(line)
+
+
+def layout(chunks, x, y, limit, size=32, max_height=None, ellipsis="..."):
+    """Position the lines of wrap() from (x, y) down, size pixels apart
+
+    Yields (x, y, line). Lines are not read past max_height pixels, the
+    last line shown ends with ellipsis when text was cut off. Nothing is
+    yielded when max_height is less than a line.
+    """
+    max_lines = None if max_height is None else max_height // size
+    if max_lines is not None and max_lines < 1:
+        return
+    lines = wrap(chunks, limit, size)
+    line = next(lines, None)
+    count = 0
+    for following in lines:
+        if count + 1 == max_lines:
+            m = metrics(size)
+            n = m.fit(line, limit - m.width(ellipsis))
+            yield x, y + count * size, line[:n].rstrip() + ellipsis
+            return
+        yield x, y + count * size, line
+        count += 1
+        line = following
+    if line is not None:
+        yield x, y + count * size, line
@@ -0,0 +1,115 @@
+"""Draw images without importing them, as filled rectangles
+
+epd_bitmap() only shows pictures imported into the EPD's storage.
+raster() draws a NumPy array of the grey levels 0 (BLACK) .. 3 (WHITE)
+with fill_rect commands instead, e.g. a chart rendered on the host:
+
+    import epd, epd_image, epd_raster
+    levels = epd_image.quantize(chart, "none")
+    report = epd_raster.raster(levels, 0, 0)
+    epd.epd_update()
+    print(report["commands"], report["bytes"])
+
+The most common level is filled as one rectangle first. Every other
+level is split into horizontal runs, and runs of the same columns in
+consecutive rows are merged into rectangles (or the same with vertical
+runs, whichever takes fewer). A run may go over pixels of levels painted
+later, so levels are painted in the order that needs the fewest
+rectangles. Flat images such as charts, text and diagrams take
+few commands, while dithered photos take many.
+
+Needs NumPy.
+"""
+from itertools import permutations
+
+import numpy as np
+
+import epd as _epd
+
+_LEVEL_COLORS = (_epd.BLACK, _epd.DARK_GRAY, _epd.GRAY, _epd.WHITE)
+
+
+def _runs(allowed, needed):
+    # runs of allowed pixels in each row holding at least one needed
+    # pixel, as arrays of row, first and last column
+    h, w = allowed.shape
+    edges = np.diff(np.pad(allowed, ((0, 0), (1, 1))).astype(np.int8), axis=1)
+    rows, starts = np.nonzero(edges == 1)
+    _, ends = np.nonzero(edges == -1)
+    counts = np.pad(np.cumsum(needed, axis=1), ((0, 0), (1, 0)))
+    keep = counts[rows, ends] > counts[rows, starts]
+    return rows[keep], starts[keep], ends[keep] - 1
+
+
+def _rectangles(rows, x0, x1):
+    # merge runs of the same columns in consecutive rows, (x0, y0, x1, y1)
+    if not len(rows):
+        return np.empty((0, 4), np.intp)
+    order = np.lexsort((rows, x1, x0))
+    rows, x0, x1 = rows[order], x0[order], x1[order]
+    first = np.ones(len(rows), bool)
+    first[1:] = (x0[1:] != x0[:-1]) | (x1[1:] != x1[:-1]) | (rows[1:] != rows[:-1] + 1)
+    starts = np.flatnonzero(first)
+    last = np.append(starts[1:], len(rows)) - 1
+    return np.stack((x0[starts], rows[starts], x1[starts], rows[last]), axis=1)
+
+
+def decompose(levels):
+    """Rectangles drawing levels, as [(level, array of x0, y0, x1, y1)]
+
+    The rectangles are inclusive of their last row and column, as
+    fill_rect is, and are to be drawn in the order given.
+    """
+    levels = np.asarray(levels, np.uint8)
+    h, w = levels.shape
+    present = [int(v) for v in np.flatnonzero(np.bincount(levels.ravel(), minlength=4))]
+    if not present:
+        return []
+    background = max(present, key=lambda v: np.count_nonzero(levels == v))
+    rest = [v for v in present if v != background]
+    best = None
+    for order in permutations(rest):
+        plan = [(background, np.array([[0, 0, w - 1, h - 1]]))]
+        for i, level in enumerate(order):
+            allowed = np.isin(levels, order[i:])
+            rects = _rectangles(*_runs(allowed, levels == level))
+            # or columns merged across, better for e.g. vertical bars
+            rows, y0, y1 = _runs(allowed.T, (levels == level).T)
+            columns = _rectangles(rows, y0, y1)[:, [1, 0, 3, 2]]
+            plan.append((level, rects if len(rects) <= len(columns) else columns))
+        if best is None or sum(len(r) for _, r in plan) < sum(len(r) for _, r in best):
+            best = plan
+    return best
+
+
+def _plan_frames(plan, x, y):
+    for level, rects in plan:
+        if not len(rects):
+            continue
+        yield _epd._enc_set_color(_epd._COLORS[_LEVEL_COLORS[level]], _epd._COLORS[_epd.WHITE])
+        for x0, y0, x1, y1 in (rects + (x, y, x, y)).tolist():
+            yield _epd._enc_fill_rect(x0, y0, x1, y1)
+    yield _epd._enc_set_color(_epd._COLORS[_epd.BLACK], _epd._COLORS[_epd.WHITE])
+
+
+def raster_frames(levels, x=0, y=0):
+    """Frames drawing levels with its top left corner at (x, y)"""
+    return _plan_frames(decompose(levels), x, y)
+
+
+def raster(levels, x=0, y=0, panel=None):
+    """Draw levels on panel (the default EPD if None) at (x, y)
+
+    Frames go through send(), so updates are forced when the EPD's
+    buffer fills up. Returns a report of the commands and bytes sent
+    and the rectangles drawn per level.
+    """
+    if panel is None:
+        panel = _epd._default
+    plan = decompose(levels)
+    report = {"commands": 0, "bytes": 0, "rects": {level: len(rects) for level, rects in plan}}
+    for frame in _plan_frames(plan, x, y):
+        panel.send(frame)
+        report["commands"] += 1
+        report["bytes"] += len(frame)
+    return report
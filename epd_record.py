@@ -0,0 +1,245 @@
+"""Record what is drawn to a file and replay it later
+
+Everything sent inside record() is written to a file instead of the
+EPD, exactly as it would go over the wire. Nothing needs to be
+connected, so screens can be built once on a fast machine:
+
+    import epd, epd_record
+    with epd_record.record("menu.epdr"):
+        epd.epd_clear()
+        epd.epd_ascii(20, 20, "Main menu")
+        epd.epd_update()
+
+and shown on another without encoding anything:
+
+    epd.epd_connect()
+    epd_record.replay("menu.epdr")
+
+or from the command line, python epd_record.py menu.epdr --url tcp://...
+
+The file holds a header, the frames and an index of segments, each
+ending with an update (the last one may not). Replaying maps the file
+into memory and writes each segment in large slices of it, waiting for
+the EPD after every update as send() does. Updates forced by the EPD's
+buffer limits (see epd_device_limits()) are recorded where they fell,
+so the limits in effect while recording apply.
+"""
+import argparse
+import mmap
+import struct
+from contextlib import contextmanager
+from time import perf_counter, sleep
+
+import epd as _epd
+
+_MAGIC = b"EPDR"
+_VERSION = 1
+# magic, version, flags, bytes of frames, segments
+_HEADER = struct.Struct("<4sHHQI")
+_OPEN_END = 0x01  # flag: the last segment does not end with an update
+# offset where a segment ends in the frames, frames in it
+_SEGMENT = struct.Struct("<QI")
+_CHUNK = 1 << 16  # bytes written to the transport at a time
+
+
+class _RecordingTransport:
+    # stands in for the connection while recording, keeps what is
+    # written in a file and notes where each update ends
+    fixed_rate = True
+
+    def __init__(self, f):
+        self._file = f
+        self.size = 0
+        self.segments = []
+        self._frames = 0
+        self._partial = bytearray()
+
+    def __repr__(self):
+        return "recording to %s" % self._file.name
+
+    def write(self, data):
+        self._file.write(data)
+        self._partial += data
+        at = 0
+        while len(self._partial) - at >= 4:
+            size = int.from_bytes(self._partial[at + 1:at + 3], "big")
+            if size < _epd._FRAME_OVERHEAD:
+                # not a frame header, e.g. from a raw send(): the rest is
+                # kept as one frame, parsing picks up with the next write
+                size = len(self._partial) - at
+            elif len(self._partial) - at < size:
+                break
+            self._frames += 1
+            if self._partial[at + 3] == _epd._CMD_UPDATE:
+                self.segments.append((self.size + at + size, self._frames))
+                self._frames = 0
+            at += size
+        self.size += at
+        del self._partial[:at]
+
+    def writev(self, buffers):
+        for data in buffers:
+            self.write(data)
+
+    def readline(self):
+        sleep(1)  # nothing will ever reply
+        return b""
+
+    def reset_input(self):
+        pass
+
+    def close(self):
+        pass
+
+    def finish(self):
+        flags = 0
+        if self._frames:
+            self.segments.append((self.size, self._frames))
+            flags |= _OPEN_END
+        for end, frames in self.segments:
+            self._file.write(_SEGMENT.pack(end, frames))
+        self._file.seek(0)
+        self._file.write(_HEADER.pack(_MAGIC, _VERSION, flags, self.size, len(self.segments)))
+
+
+@contextmanager
+def record(path, panel=None):
+    """Write what panel (the default EPD if None) sends in the block to path
+
+    Recording starts from a blank state, nothing about colours, fonts or
+    the previous frame() screen is assumed. What the panel knows about
+    the real EPD is left as it was.
+    """
+    if panel is None:
+        panel = _epd._default
+    with panel._lock:
+        panel.flush()
+        saved = (panel.soc, panel.refresh_wait, panel._state, panel._shadow,
+                 panel._pending_commands, panel._pending_bytes)
+        with open(path, "wb") as f:
+            f.write(_HEADER.pack(_MAGIC, _VERSION, 0, 0, 0))
+            recorder = _RecordingTransport(f)
+            panel.soc = recorder
+            panel.refresh_wait = 0  # waits are replayed, not recorded
+            panel._state = {}
+            panel._shadow = None
+            panel._pending_commands = panel._pending_bytes = 0
+            try:
+                yield recorder
+                panel.flush()
+            finally:
+                del panel._buffer[:]
+                (panel.soc, panel.refresh_wait, panel._state, panel._shadow,
+                 panel._pending_commands, panel._pending_bytes) = saved
+            recorder.finish()
+
+
+class Recording:
+    """A recorded file mapped into memory
+
+    len() is the number of segments, segment(i) the frames of one as a
+    memoryview into the file. open_end is set when the last segment
+    does not end with an update.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, flags, self.size, count = _HEADER.unpack_from(self._map)
+        self.open_end = bool(flags & _OPEN_END)
+        if magic != _MAGIC or version != _VERSION:
+            self._map.close()
+            raise ValueError("%s is not an EPD recording" % path)
+        self._view = memoryview(self._map)
+        self.frames = self._view[_HEADER.size:_HEADER.size + self.size]
+        index = _HEADER.size + self.size
+        self.segments = [_SEGMENT.unpack_from(self._map, index + i * _SEGMENT.size) for i in range(count)]
+
+    def __len__(self):
+        return len(self.segments)
+
+    def segment(self, i):
+        start = self.segments[i - 1][0] if i else 0
+        return self.frames[start:self.segments[i][0]]
+
+    def close(self):
+        self.frames.release()
+        self._view.release()
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def replay(self, panel=None, segments=None, chunk=_CHUNK):
+        """Send segments (all if None) to panel (the default EPD if None)
+
+        Replies to replayed frames are not tracked, so replay with
+        epd_responses() off.
+        """
+        if panel is None:
+            panel = _epd._default
+        if panel.soc is None:
+            panel.log.warning("EPD not connected. Try epd_connect()")
+            return
+        indices = list(range(len(self)) if segments is None else segments)
+        with panel._lock:
+            panel.flush()
+            if panel._pending_commands:
+                # what was sent before may not fit with what is replayed
+                panel.send(_epd._cmd_update)
+                sleep(panel.refresh_wait)
+            for n, i in enumerate(indices):
+                if n:
+                    sleep(panel.refresh_wait)  # the previous segment ended with an update
+                data = self.segment(i)
+                for start in range(0, len(data), chunk):
+                    self._write(panel, data[start:start + chunk])
+                data.release()
+            # the recording started from a blank state and ends with unknown
+            # colours and fonts
+            panel._state.clear()
+            panel._shadow = None
+            panel._pending_commands = panel._pending_bytes = 0
+            if indices and self.open_end and indices[-1] == len(self) - 1:
+                # the EPD holds the frames of the open segment until an update
+                panel._pending_commands = self.segments[-1][1]
+                panel._pending_bytes = len(self.segment(len(self) - 1))
+
+    @staticmethod
+    def _write(panel, data):
+        if panel.instruments is None:
+            panel.soc.write(data)
+            return
+        start = perf_counter()
+        try:
+            panel.soc.write(data)
+        except Exception:
+            panel.instruments.write_failed()
+            raise
+        panel.instruments.flushed(len(data), perf_counter() - start)
+
+
+def replay(path, panel=None, segments=None):
+    """Send the recording at path to panel (the default EPD if None)"""
+    with Recording(path) as rec:
+        rec.replay(panel, segments)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a recording to the EPD")
+    parser.add_argument("recording")
+    parser.add_argument("--url", help="EPD to connect to, see epd_transport")
+    parser.add_argument("--segment", type=int, action="append", help="segment to replay, all by default")
+    args = parser.parse_args(argv)
+    panel = _epd.EPD(args.url)
+    panel.connect()
+    if panel.soc is not None:
+        replay(args.recording, panel, args.segment)
+        panel.disconnect()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+"""Retained screens: widgets compiled to frames once and kept
+
+A Scene holds widgets in drawing order. Each widget compiles to frames
+with the same encoders as the epd_* functions and keeps them until one
+of its properties changes, so a dashboard where a few of many widgets
+change per tick only compiles those:
+
+    from epd_scene import Scene, Text, LCDDigits
+    scene = Scene()
+    clock = scene.add(LCDDigits(20, 20, "12:00"))
+    status = scene.add(Text(20, 300, "Status: OK"))
+    scene.render()                  # the default EPD, or render(panel)
+    ...
+    clock.digits = time.strftime("%H:%M")
+    scene.render()
+
+render() draws the scene inside EPD.frame(), so only areas that look
+different on the panel are redrawn, and nothing is sent when nothing
+changed. Text is compared by value, set it to a str or a list of
+strings, not an iterator.
+"""
+import epd as _epd
+
+_EN_FONTS = {32: _epd.ASCII32, 48: _epd.ASCII48, 64: _epd.ASCII64}
+_UNSET = object()
+
+
+class Widget:
+    """Something drawn on the screen, compiled to frames when needed
+
+    Subclasses set their properties in __init__ and yield their frames
+    from _compile(). Setting a property to a different value drops the
+    compiled frames. A widget with visible False draws nothing.
+    """
+
+    visible = True
+
+    def __setattr__(self, name, value):
+        if not name.startswith("_") and getattr(self, name, _UNSET) != value:
+            self.__dict__["_frames"] = None
+        object.__setattr__(self, name, value)
+
+    @property
+    def compiled(self):
+        """Whether the frames are compiled and up to date"""
+        return self.__dict__.get("_frames") is not None
+
+    def frames(self):
+        """The widget's frames, compiled again only after a change"""
+        if not self.compiled:
+            self._frames = list(self._compile()) if self.visible else []
+        return self._frames
+
+    def _compile(self):
+        return ()
+
+    def _colors(self):
+        return _epd._enc_set_color(_epd._COLORS[self.fg], _epd._COLORS[self.bg])
+
+
+class Text(Widget):
+    """One line of ASCII text, size 32, 48 or 64"""
+
+    def __init__(self, x, y, txt, size=32, fg=_epd.BLACK, bg=_epd.WHITE):
+        self.x, self.y, self.txt, self.size, self.fg, self.bg = x, y, txt, size, fg, bg
+
+    def _compile(self):
+        frame = _epd._ascii_frame(self.x, self.y, self.txt)
+        if frame is not None:
+            yield self._colors()
+            yield _epd._enc_en_font(_epd._hex_byte(_EN_FONTS[self.size]))
+            yield frame
+
+
+class Paragraph(Widget):
+    """Text wrapped to limit pixels wide, as wrap_ascii() or EPD.wrap_ascii()"""
+
+    def __init__(self, x, y, txt, limit=800, size=32, max_height=None):
+        self.x, self.y, self.txt, self.limit, self.size, self.max_height = x, y, txt, limit, size, max_height
+
+    def _compile(self):
+        yield _epd._enc_en_font(_epd._hex_byte(_EN_FONTS[self.size]))
+        yield from _epd._wrap_ascii_frames(self.x, self.y, self.txt, self.limit, self.size, self.max_height)
+
+
+class LCDDigits(Widget):
+    """Digits and colons in the LCD font, as epd_lcd_digits()"""
+
+    def __init__(self, x, y, digits, scale=_epd.LCD_MD):
+        self.x, self.y, self.digits, self.scale = x, y, digits, scale
+
+    def _compile(self):
+        if self.digits:
+            yield from _epd._lcd_digits_frames(self.x, self.y, self.digits, self.scale)
+
+
+class BlockDigits(Widget):
+    """Digits and colons in the block font, as epd_block_digits()"""
+
+    def __init__(self, x, y, digits, scale=_epd.BLOCK_SM):
+        self.x, self.y, self.digits, self.scale = x, y, digits, scale
+
+    def _compile(self):
+        if self.digits:
+            yield from _epd._block_digits_frames(self.x, self.y, self.digits, self.scale)
+
+
+class Line(Widget):
+    def __init__(self, x0, y0, x1, y1, fg=_epd.BLACK, bg=_epd.WHITE):
+        self.points, self.fg, self.bg = (x0, y0, x1, y1), fg, bg
+
+    def _compile(self):
+        yield self._colors()
+        yield _epd._enc_line(*self.points)
+
+
+class Rect(Widget):
+    def __init__(self, x0, y0, x1, y1, fill=False, fg=_epd.BLACK, bg=_epd.WHITE):
+        self.points, self.fill, self.fg, self.bg = (x0, y0, x1, y1), fill, fg, bg
+
+    def _compile(self):
+        yield self._colors()
+        yield (_epd._enc_fill_rect if self.fill else _epd._enc_rect)(*self.points)
+
+
+class Circle(Widget):
+    def __init__(self, x, y, r, fill=False, fg=_epd.BLACK, bg=_epd.WHITE):
+        self.x, self.y, self.r, self.fill, self.fg, self.bg = x, y, r, fill, fg, bg
+
+    def _compile(self):
+        yield self._colors()
+        yield (_epd._enc_fill_circle if self.fill else _epd._enc_circle)(self.x, self.y, self.r)
+
+
+class Triangle(Widget):
+    def __init__(self, x0, y0, x1, y1, x2, y2, fill=False, fg=_epd.BLACK, bg=_epd.WHITE):
+        self.points, self.fill, self.fg, self.bg = (x0, y0, x1, y1, x2, y2), fill, fg, bg
+
+    def _compile(self):
+        yield self._colors()
+        yield (_epd._enc_fill_triangle if self.fill else _epd._enc_triangle)(*self.points)
+
+
+class Bitmap(Widget):
+    """A picture imported into the EPD, as epd_bitmap()"""
+
+    def __init__(self, x, y, name):
+        self.x, self.y, self.name = x, y, name
+
+    def _compile(self):
+        frame = _epd._bitmap_frame(self.x, self.y, self.name)
+        if frame is not None:
+            yield frame
+
+
+class Scene:
+    """Widgets drawn in the order they were added"""
+
+    def __init__(self, widgets=()):
+        self.widgets = list(widgets)
+        self.stats = {"compiled": 0, "cached": 0}
+
+    def add(self, widget):
+        """Add widget on top of the others, returns it"""
+        self.widgets.append(widget)
+        return widget
+
+    def remove(self, widget):
+        self.widgets.remove(widget)
+
+    def frames(self):
+        """The frames drawing the scene, without repeated colours and fonts"""
+        state = {}
+        for widget in self.widgets:
+            self.stats["cached" if widget.compiled else "compiled"] += 1
+            for frame in widget.frames():
+                if frame[3] in _epd._STATE_COMMANDS:
+                    if state.get(frame[3]) == frame[4:-5]:
+                        continue
+                    state[frame[3]] = frame[4:-5]
+                yield frame
+
+    def render(self, panel=None):
+        """Draw the scene on panel (the default EPD if None) and update it"""
+        if panel is None:
+            panel = _epd._default
+        with panel.frame():
+            panel._send_all(self.frames())
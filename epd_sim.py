@@ -0,0 +1,383 @@
+"""Virtual EPD for running without hardware
+
+VirtualEPD decodes the frames epd.py sends and draws them into an
+800x600 framebuffer of the 4 grey levels (0 BLACK .. 3 WHITE), like the
+panel does. It stands in for the serial port:
+
+    import epd, epd_sim
+    sim = epd_sim.attach()          # the epd_* functions now draw on sim
+    epd.epd_fill_circle(400, 300, 100)
+    epd.epd_update()
+    sim.save_png("circle.png")
+
+Strings are only recorded in VirtualEPD.texts since the panel's fonts
+are not available, unless text_boxes is set, which fills the area the
+text would cover. Bitmaps are read from bitmap_dir when given.
+
+Needs NumPy.
+"""
+import os
+import struct
+import threading
+import zlib
+from collections import deque
+
+import numpy as np
+
+import epd as _epd
+
+WIDTH = 800
+HEIGHT = 600
+
+# 8-bit grey of each level, for snapshots
+_GREYS = np.array([0x00, 0x55, 0xAA, 0xFF], dtype=np.uint8)
+
+_FONT_SIZES = {1: 32, 2: 48, 3: 64}
+
+
+def attach(panel=None, **kwargs):
+    """Make panel (the default EPD if None) draw on a new VirtualEPD"""
+    sim = VirtualEPD(**kwargs)
+    if panel is None:
+        panel = _epd._default
+    panel.soc = sim
+    return sim
+
+
+class VirtualEPD:
+    """In-memory EPD with the serial port interface epd.EPD uses
+
+    canvas holds what has been drawn, screen what was shown by the
+    last update.
+    """
+
+    def __init__(self, bitmap_dir=None, text_boxes=False, replies=True, timeout=1):
+        self.canvas = np.full((HEIGHT, WIDTH), 3, dtype=np.uint8)
+        self.screen = self.canvas.copy()
+        self.bitmap_dir = bitmap_dir
+        self.text_boxes = text_boxes
+        self.replies = replies
+        self.timeout = timeout
+        self.fg = 0
+        self.bg = 3
+        self.en_font = 32
+        self.ch_font = 32
+        self.memory = _epd._MEM_NAND
+        self.rotation = _epd._EPD_NORMAL
+        self.baud_rate = _epd.BAUD_RATE
+        self.texts = []
+        self.frames = 0
+        self.updates = 0
+        self.errors = 0
+        self._pending = bytearray()
+        self._replies = deque(maxlen=65536)
+        self._replies_cond = threading.Condition()
+        self._handlers = {
+            _epd._CMD_HANDSHAKE: self._handshake,
+            _epd._CMD_SET_BAUD: self._set_baud,
+            _epd._CMD_READ_BAUD: self._read_baud,
+            _epd._CMD_MEMORYMODE: self._memory_mode,
+            _epd._CMD_STOPMODE: self._ok,
+            _epd._CMD_UPDATE: self._update,
+            _epd._CMD_SCREEN_ROTATION: self._rotation,
+            _epd._CMD_LOAD_FONT: self._ok,
+            _epd._CMD_LOAD_PIC: self._ok,
+            _epd._CMD_SET_COLOR: self._set_color,
+            _epd._CMD_SET_EN_FONT: self._set_en_font,
+            _epd._CMD_SET_CH_FONT: self._set_ch_font,
+            _epd._CMD_DRAW_PIXEL: self._pixel,
+            _epd._CMD_DRAW_LINE: self._line,
+            _epd._CMD_FILL_RECT: self._fill_rect,
+            _epd._CMD_DRAW_RECT: self._rect,
+            _epd._CMD_DRAW_CIRCLE: self._circle,
+            _epd._CMD_FILL_CIRCLE: self._fill_circle,
+            _epd._CMD_DRAW_TRIANGLE: self._triangle,
+            _epd._CMD_FILL_TRIANGLE: self._fill_triangle,
+            _epd._CMD_CLEAR: self._clear,
+            _epd._CMD_DRAW_STRING: self._string,
+            _epd._CMD_DRAW_BITMAP: self._bitmap,
+        }
+
+    # serial port interface
+
+    def write(self, data):
+        self._pending += data
+        self._run()
+        return len(data)
+
+    def readline(self):
+        with self._replies_cond:
+            if not self._replies:
+                self._replies_cond.wait(self.timeout)
+            if self._replies:
+                return self._replies.popleft()
+        return b""
+
+    def reset_input(self):
+        with self._replies_cond:
+            self._replies.clear()
+
+    def close(self):
+        pass
+
+    # frame decoding
+
+    def _reply(self, reply):
+        if self.replies:
+            with self._replies_cond:
+                self._replies.append(reply.encode("ascii") + b"\r\n")
+                self._replies_cond.notify()
+
+    def _error(self, code):
+        self.errors += 1
+        self._reply("Error:%d" % code)
+
+    def _run(self):
+        buf = self._pending
+        pos = 0
+        while len(buf) - pos >= 3:
+            if buf[pos] != _epd._FRAME_BEGIN:
+                # resynchronise on the next frame header
+                nxt = buf.find(_epd._FRAME_BEGIN, pos + 1)
+                self._error(21)
+                pos = len(buf) if nxt < 0 else nxt
+                continue
+            size = (buf[pos + 1] << 8) | buf[pos + 2]
+            if size < _epd._FRAME_OVERHEAD:
+                self._error(21)
+                pos += 1
+                continue
+            if len(buf) - pos < size:
+                break
+            frame = bytes(buf[pos:pos + size])
+            pos += size
+            self.execute(frame)
+        del buf[:pos]
+
+    def execute(self, frame):
+        """Run one complete frame"""
+        self.frames += 1
+        if struct.unpack_from(">I", frame, len(frame) - 5)[0] != _epd._FRAME_END:
+            return self._error(21)
+        if _epd._checksum(frame) != 0:  # checksum XORs the whole frame to 0
+            return self._error(20)
+        handler = self._handlers.get(frame[3])
+        if handler is None:
+            return self._error(0)
+        args = frame[4:-5]
+        try:
+            reply = handler(args)
+        except _epd.EPDError as e:
+            return self._error(e.code)
+        except (struct.error, ValueError, IndexError):
+            return self._error(2)
+        self._reply("OK" if reply is None else reply)
+
+    @staticmethod
+    def _coords(args, n):
+        return struct.unpack_from(">%dH" % n, args)
+
+    # state commands
+
+    def _ok(self, args):
+        pass
+
+    def _handshake(self, args):
+        pass
+
+    def _set_baud(self, args):
+        self.baud_rate = struct.unpack(">I", args)[0]
+
+    def _read_baud(self, args):
+        return str(self.baud_rate)
+
+    def _memory_mode(self, args):
+        self.memory = args[0]
+
+    def _update(self, args):
+        if self.rotation == _epd._EPD_INVERSION:
+            self.screen = self.canvas[::-1, ::-1].copy()
+        else:
+            self.screen = self.canvas.copy()
+        self.updates += 1
+
+    def _rotation(self, args):
+        self.rotation = args[0]
+
+    def _set_color(self, args):
+        self.fg, self.bg = args[0] & 3, args[1] & 3
+
+    def _set_en_font(self, args):
+        self.en_font = _FONT_SIZES.get(args[0], 32)
+
+    def _set_ch_font(self, args):
+        self.ch_font = _FONT_SIZES.get(args[0], 32)
+
+    def _clear(self, args):
+        self.canvas[:] = self.bg
+        del self.texts[:]
+
+    # drawing
+
+    def _span(self, a, b, limit):
+        # inclusive range a..b as a slice clipped to the panel
+        if a > b:
+            a, b = b, a
+        return slice(max(a, 0), min(b + 1, limit))
+
+    def _plot(self, xs, ys):
+        keep = (xs >= 0) & (xs < WIDTH) & (ys >= 0) & (ys < HEIGHT)
+        self.canvas[ys[keep], xs[keep]] = self.fg
+
+    def _pixel(self, args):
+        x, y = self._coords(args, 2)
+        if x < WIDTH and y < HEIGHT:
+            self.canvas[y, x] = self.fg
+
+    def _draw_line(self, x0, y0, x1, y1):
+        n = max(abs(x1 - x0), abs(y1 - y0)) + 1
+        xs = np.rint(np.linspace(x0, x1, n)).astype(np.intp)
+        ys = np.rint(np.linspace(y0, y1, n)).astype(np.intp)
+        self._plot(xs, ys)
+
+    def _line(self, args):
+        self._draw_line(*self._coords(args, 4))
+
+    def _fill_rect(self, args):
+        x0, y0, x1, y1 = self._coords(args, 4)
+        self.canvas[self._span(y0, y1, HEIGHT), self._span(x0, x1, WIDTH)] = self.fg
+
+    def _rect(self, args):
+        x0, y0, x1, y1 = self._coords(args, 4)
+        xs, ys = self._span(x0, x1, WIDTH), self._span(y0, y1, HEIGHT)
+        for y in (y0, y1):
+            if y < HEIGHT:
+                self.canvas[y, xs] = self.fg
+        for x in (x0, x1):
+            if x < WIDTH:
+                self.canvas[ys, x] = self.fg
+
+    def _circle(self, args):
+        cx, cy, r = self._coords(args, 3)
+        # one octant, mirrored 8 ways
+        a = np.arange(int(np.ceil(r / np.sqrt(2))) + 1)
+        b = np.rint(np.sqrt(np.maximum(r * r - a * a, 0))).astype(np.intp)
+        xs = np.concatenate((a, b, -a, -b, a, b, -a, -b)) + cx
+        ys = np.concatenate((b, a, b, a, -b, -a, -b, -a)) + cy
+        self._plot(xs, ys)
+
+    def _fill_spans(self, ys, lo, hi):
+        # fill row ys.start + i from column lo[i] to hi[i], both included
+        xs = self._span(int(lo.min()), int(hi.max()), WIDTH)
+        if xs.start >= xs.stop:
+            return
+        xx = np.arange(xs.start, xs.stop)
+        inside = (xx >= lo[:, None]) & (xx <= hi[:, None])
+        self.canvas[ys, xs][inside] = self.fg
+
+    def _fill_circle(self, args):
+        cx, cy, r = self._coords(args, 3)
+        ys = self._span(cy - r, cy + r, HEIGHT)
+        if ys.start >= ys.stop:
+            return
+        dy = np.arange(ys.start, ys.stop) - cy
+        dx = np.floor(np.sqrt(r * r - dy * dy))
+        self._fill_spans(ys, cx - dx, cx + dx)
+
+    def _triangle(self, args):
+        x0, y0, x1, y1, x2, y2 = self._coords(args, 6)
+        self._draw_line(x0, y0, x1, y1)
+        self._draw_line(x1, y1, x2, y2)
+        self._draw_line(x2, y2, x0, y0)
+
+    def _fill_triangle(self, args):
+        x0, y0, x1, y1, x2, y2 = self._coords(args, 6)
+        ys = self._span(min(y0, y1, y2), max(y0, y1, y2), HEIGHT)
+        if ys.start >= ys.stop:
+            return
+        rows = np.arange(ys.start, ys.stop)
+        lo = np.full(len(rows), np.inf)
+        hi = np.full(len(rows), -np.inf)
+        # each row is filled between the leftmost and rightmost edge crossing
+        for (xa, ya), (xb, yb) in (((x0, y0), (x1, y1)), ((x1, y1), (x2, y2)), ((x2, y2), (x0, y0))):
+            if ya == yb:
+                on = rows == ya
+                lo[on] = np.minimum(lo[on], min(xa, xb))
+                hi[on] = np.maximum(hi[on], max(xa, xb))
+                continue
+            t = (rows - ya) / (yb - ya)
+            on = (t >= 0) & (t <= 1)
+            x = xa + t * (xb - xa)
+            lo = np.where(on, np.minimum(lo, x), lo)
+            hi = np.where(on, np.maximum(hi, x), hi)
+        self._fill_spans(ys, np.rint(lo), np.rint(hi))
+
+    def _string(self, args):
+        x, y = self._coords(args, 2)
+        txt = bytes(args[4:]).split(b"\x00", 1)[0].decode("latin-1")
+        self.texts.append((x, y, txt, self.en_font))
+        if self.text_boxes and txt:
+            w = _epd.get_width(txt, self.en_font)
+            self.canvas[self._span(y, y + self.en_font - 1, HEIGHT), self._span(x, x + w - 1, WIDTH)] = self.fg
+
+    def _bitmap(self, args):
+        x, y = self._coords(args, 2)
+        name = bytes(args[4:]).split(b"\x00", 1)[0].decode("latin-1")
+        if self.bitmap_dir is None:
+            return
+        path = os.path.join(self.bitmap_dir, name)
+        if not os.path.exists(path):
+            raise _epd.EPDError(4)  # file not found, as the EPD replies
+        img = read_bmp(path)
+        h, w = img.shape
+        ys, xs = self._span(y, y + h - 1, HEIGHT), self._span(x, x + w - 1, WIDTH)
+        self.canvas[ys, xs] = img[:ys.stop - ys.start, :xs.stop - xs.start]
+
+    # snapshots
+
+    def image(self, shown=True):
+        """8-bit grey image of the screen, or of the canvas if not shown"""
+        return _GREYS[self.screen if shown else self.canvas]
+
+    def save_pgm(self, path, shown=True):
+        img = self.image(shown)
+        with open(path, "wb") as f:
+            f.write(b"P5\n%d %d\n255\n" % (img.shape[1], img.shape[0]))
+            f.write(img.tobytes())
+
+    def save_png(self, path, shown=True):
+        img = self.image(shown)
+        h, w = img.shape
+        # every scanline starts with filter type 0
+        raw = np.hstack((np.zeros((h, 1), dtype=np.uint8), img)).tobytes()
+
+        def chunk(kind, data):
+            return (struct.pack(">I", len(data)) + kind + data
+                    + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF))
+
+        with open(path, "wb") as f:
+            f.write(b"\x89PNG\r\n\x1a\n")
+            f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", w, h, 8, 0, 0, 0, 0)))
+            f.write(chunk(b"IDAT", zlib.compress(raw)))
+            f.write(chunk(b"IEND", b""))
+
+
+def read_bmp(path):
+    """Read an uncompressed 1/2/4/8 bpp palette BMP as grey levels 0..3"""
+    with open(path, "rb") as f:
+        data = f.read()
+    offset, = struct.unpack_from("<I", data, 10)
+    header, width, height, _, bpp = struct.unpack_from("<IiiHH", data, 14)
+    colors, = struct.unpack_from("<I", data, 46)
+    colors = colors or 1 << bpp
+    palette = np.frombuffer(data, np.uint8, colors * 4, 14 + header).reshape(-1, 4)
+    # palette entries are BGR0
+    luma = palette[:, 2] * 0.299 + palette[:, 1] * 0.587 + palette[:, 0] * 0.114
+    levels = np.rint(luma / 85).astype(np.uint8)
+
+    stride = (width * bpp + 31) // 32 * 4
+    rows = np.frombuffer(data, np.uint8, stride * abs(height), offset).reshape(abs(height), stride)
+    bits = np.unpackbits(rows, axis=1)[:, :width * bpp].reshape(abs(height), width, bpp)
+    index = (bits * (1 << np.arange(bpp - 1, -1, -1, dtype=np.uint8))).sum(axis=2)
+    img = levels[index]
+    return img[::-1] if height > 0 else img  # positive height is stored bottom-up
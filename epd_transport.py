@@ -0,0 +1,227 @@
+"""Connections to the EPD
+
+A transport carries frames to the EPD and its replies back. Each one
+holds a single connection for its lifetime and offers
+
+    write(data)         send bytes, a bytearray or memoryview without copying
+    writev(buffers)     send several buffers in one go
+    readline()          the next reply line, b"" after a timeout
+    reset_input()       drop replies not read yet
+    close()
+
+open_transport() picks one by URL:
+
+    serial:///dev/ttyUSB0?baud=115200   USB serial, the default for a bare path
+    tcp://192.168.1.50:8899             WiFi relay
+    unix:///run/epd.sock                relay on the same machine
+    loop://                             in memory, for tests and benchmarks
+"""
+import socket
+import threading
+from collections import deque
+from urllib.parse import parse_qs, urlsplit
+
+_TIMEOUT = 1  # seconds readline() waits for a reply
+
+
+class SerialTransport:
+    """USB serial port, needs pyserial"""
+
+    fixed_rate = False  # the EPD's baud rate can be changed over it
+
+    def __init__(self, port, baud_rate, timeout=_TIMEOUT):
+        import serial
+        self.port = port
+        self.baud_rate = baud_rate
+        self._serial = serial.Serial(port=port, baudrate=baud_rate, timeout=timeout)
+
+    def __repr__(self):
+        return "serial port %s" % self.port
+
+    def write(self, data):
+        self._serial.write(data)
+
+    def writev(self, buffers):
+        self._serial.write(b"".join(buffers))
+
+    def readline(self):
+        return self._serial.readline()
+
+    def reset_input(self):
+        self._serial.reset_input_buffer()
+
+    def close(self):
+        self._serial.close()
+
+
+class _SocketTransport:
+    # a relay passes bytes on at its own baud rate
+    fixed_rate = True
+
+    def __init__(self, sock, timeout=_TIMEOUT):
+        self._sock = sock
+        self._timeout = timeout
+        self._sock.settimeout(timeout)
+        self._lines = bytearray()
+
+    def write(self, data):
+        self._sock.sendall(data)
+
+    def writev(self, buffers):
+        if not hasattr(self._sock, "sendmsg"):  # Windows
+            self._sock.sendall(b"".join(buffers))
+            return
+        views = [memoryview(b).cast("B") for b in buffers]
+        while views:
+            sent = self._sock.sendmsg(views)
+            while views and sent >= len(views[0]):
+                sent -= len(views.pop(0))
+            if sent:
+                views[0] = views[0][sent:]
+
+    def readline(self):
+        # socket files cannot be read again after a timeout, so lines
+        # are split here
+        while b"\n" not in self._lines:
+            try:
+                data = self._sock.recv(4096)
+            except socket.timeout:
+                return b""
+            if not data:
+                raise ConnectionError("EPD relay closed the connection")
+            self._lines += data
+        end = self._lines.index(b"\n") + 1
+        line = bytes(self._lines[:end])
+        del self._lines[:end]
+        return line
+
+    def reset_input(self):
+        del self._lines[:]
+        self._sock.setblocking(False)
+        try:
+            while self._sock.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        finally:
+            self._sock.settimeout(self._timeout)
+
+    def close(self):
+        self._sock.close()
+
+
+class TCPTransport(_SocketTransport):
+    """WiFi relay, or anything else listening on a TCP port"""
+
+    def __init__(self, host, port, timeout=_TIMEOUT):
+        self.address = (host, port)
+        sock = socket.create_connection(self.address, timeout=5)
+        # frames are batched before writing, no need to wait for more
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        super().__init__(sock, timeout)
+
+    def __repr__(self):
+        return "TCP %s:%d" % self.address
+
+
+class UnixTransport(_SocketTransport):
+    """Relay listening on a Unix socket"""
+
+    def __init__(self, path, timeout=_TIMEOUT):
+        self.path = path
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+        except OSError:
+            sock.close()
+            raise
+        super().__init__(sock, timeout)
+
+    def __repr__(self):
+        return "Unix socket %s" % self.path
+
+
+class LoopbackTransport:
+    """In memory, what is written is kept in sent
+
+    With replies set every complete frame is answered "OK", as the EPD
+    does, so code waiting for replies can run without one.
+    """
+
+    fixed_rate = True
+
+    def __init__(self, replies=False, timeout=_TIMEOUT):
+        self.sent = bytearray()
+        self.replies = replies
+        self.timeout = timeout
+        self._unanswered = 0  # offset in sent of the first frame not yet answered
+        self._replies = deque()
+        self._replies_cond = threading.Condition()
+
+    def __repr__(self):
+        return "loopback"
+
+    def write(self, data):
+        self.sent += data
+        if self.replies:
+            self._answer()
+
+    def writev(self, buffers):
+        for data in buffers:
+            self.sent += data
+        if self.replies:
+            self._answer()
+
+    def _answer(self):
+        frames = 0
+        # frames start with 0xA5 and a 2-byte length of the whole frame
+        while len(self.sent) - self._unanswered >= 3:
+            size = int.from_bytes(self.sent[self._unanswered + 1:self._unanswered + 3], "big")
+            if size < 3 or len(self.sent) - self._unanswered < size:
+                break
+            self._unanswered += size
+            frames += 1
+        if frames:
+            with self._replies_cond:
+                self._replies.extend([b"OK\r\n"] * frames)
+                self._replies_cond.notify()
+
+    def readline(self):
+        with self._replies_cond:
+            if not self._replies:
+                self._replies_cond.wait(self.timeout)
+            if self._replies:
+                return self._replies.popleft()
+        return b""
+
+    def reset_input(self):
+        with self._replies_cond:
+            self._replies.clear()
+
+    def clear(self):
+        """Forget what was sent"""
+        del self.sent[:]
+        self._unanswered = 0
+
+    def close(self):
+        pass
+
+
+def open_transport(url, baud_rate=None):
+    """Open a transport by URL, see the module docstring
+
+    baud_rate overrides the baud parameter of a serial URL.
+    """
+    parts = urlsplit(url)
+    if parts.scheme in ("", "serial"):
+        rate = baud_rate or int(parse_qs(parts.query).get("baud", [115200])[0])
+        return SerialTransport(parts.path, rate)
+    if parts.scheme == "tcp":
+        if parts.port is None:
+            raise ValueError("no port in %s" % url)
+        return TCPTransport(parts.hostname, parts.port)
+    if parts.scheme == "unix":
+        return UnixTransport(parts.path)
+    if parts.scheme == "loop":
+        return LoopbackTransport(replies=parse_qs(parts.query).get("replies", ["0"])[0] == "1")
+    raise ValueError("unknown EPD transport %s" % url)